@@ -1,10 +1,43 @@
 import json
+import mmap
+import os
 import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
 import hashlib
-from typing import Annotated
+from functools import partial
+from itertools import chain, count, islice
+from typing import (
+    TYPE_CHECKING,
+    Annotated,
+    Any,
+    IO,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+)
 
-from jsonpath_ng import parse as jsonparse
+# Modules that only some runs need, such as asyncio, sqlite3, jsonpath_ng
+# and the compression and profiling modules, are imported where they are
+# used to keep the start-up of short runs cheap
+if TYPE_CHECKING:
+    import socket
+    import tracemalloc
+    from concurrent.futures import Executor
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 JsonPathStr = Annotated[
     str, "A string formatted as a JSONPath expression from jsonpath_ng."
@@ -14,185 +47,4559 @@ JsonPathStr = Annotated[
 REGEX_STR = r"!ND=([\w\-]*)"
 DEVICE_PATTERN_ND = re.compile(r"!ND=([\w\-]+)")
 DEVICE_PATTERN_PLAIN = re.compile(r"^[\w\-]+$")
+DEFAULT_DEVICE_CHARS = r"[\w\-]"
+# Only start markers contain this, so it is searched for in raw bytes first
+START_MARKER_SIGNATURE = b'"marker_type":"start"'
+# Pointers made only of plain dotted keys are nullified natively; anything
+# else is handed to jsonpath_ng
+SIMPLE_POINTER_PATTERN = re.compile(
+    r"^[A-Za-z_][A-Za-z0-9_\-]*(?:\.[A-Za-z_][A-Za-z0-9_\-]*)*$"
+)
+JSONPATH_KEYWORDS = frozenset({"this", "parent", "where", "wherenot"})
+# Fields are only nullified below this key, so lines without it skip
+# nullification
+NULLIFY_ROOT_KEY = "object_data"
+# Integers this long may not fit in 64 bits, which orjson decodes as floats
+LONG_DIGITS_PATTERN = re.compile(r"\d{19}")
+# Compressed files are recognised by their magic bytes or their suffix
+COMPRESSION_MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+}
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+DEFAULT_COMPRESS_LEVELS = {"gzip": 6, "bz2": 9, "xz": 6}
+JSONL_SUFFIXES = (".json", ".jsonl")
+# Records the inputs a batch run has mangled into an output directory
+BATCH_MANIFEST = ".filter_json_manifest.json"
+# Upper bound on the input handled by one task in parallel mode
+PARALLEL_CHUNK_SIZE = 32 * 1024 * 1024
+# Lines per batch and batches per queue in pipeline mode
+PIPELINE_BATCH_LINES = 1000
+PIPELINE_QUEUE_SIZE = 4
+# Profiling keeps this many runs and this many rows per report
+DEFAULT_PROFILE_KEEP = 20
+PROFILE_REPORT_ROWS = 40
+# Names of the run directories `profile_run` creates, the only ones pruned
+PROFILE_RUN_PATTERN = re.compile(r"^\d{8}T\d{6}-\d+-\d{4,}-.+$")
+# Frames kept per allocation, enough to reach a filter_json caller from
+# the json module or a file object. Tracing slows down with every frame.
+PROFILE_TRACE_FRAMES = 5
+# Device path syntax: "[]" steps into each list item, "*" into each value
+# of an object. The empty key marks the end of a path in a compiled trie.
+DEVICE_PATH_TOKEN_PATTERN = re.compile(r"\[\]|[^.\[\]]+")
+PATH_EACH_ITEM = "[]"
+PATH_EACH_VALUE = "*"
+PATH_END = ""
+DEFAULT_LEARN_LINES = 10000
+# Result cache defaults and the block size inputs are hashed in
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+CACHE_ENTRY_SUFFIX = ".out"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Bytes hashed at each end of the processed part of a tailed file
+TAIL_FINGERPRINT_BYTES = 4096
+# Sharded outputs are named <stem>-00000.jsonl next to <stem>.index.json
+SHARD_NAME_GLOB = "-[0-9][0-9][0-9][0-9][0-9].jsonl"
+SHARD_INDEX_SUFFIX = ".index.json"
+WINDOW_INDEX_SUFFIX = ".windows.json"
+END_MARKER_SIGNATURE = b'"marker_type":"end"'
+# Hexadecimal digits kept from the hash of a device name in its alias
+DEFAULT_ALIAS_WIDTH = 12
+# Nullify plans a server keeps compiled, one per pointer set
+DEFAULT_MAX_PLANS = 64
+# Bytes buffered before streamed output is written and flushed
+DEFAULT_FLUSH_BYTES = 64 * 1024
+# Milliseconds a server holds back mangled lines while a client is idle
+DEFAULT_SERVER_FLUSH_MS = 50
+# The input or output path that stands for stdin or stdout
+STDIO_PATH = "-"
+# Device names are only replaced when they are not part of a longer name
+DEVICE_BOUNDARY_START = r"(?<![\w\-])"
+DEVICE_BOUNDARY_END = r"(?![\w\-])"
+DEVICE_CHAR_PATTERN = re.compile(r"[\w\-]")
+
+
+def hash_string(s: str, /) -> str:
+    """Returns a SHA-256 hash of the input string.
+
+    Args:
+        s (str): The input string to hash.
+
+    Returns:
+        str: The SHA-256 hash of the input string in hexadecimal format.
+    """
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+
+def tail_fingerprint(file: str, offset: int) -> str:
+    """Fingerprint the part of a file that a tail has processed.
+
+    Only the first and last `TAIL_FINGERPRINT_BYTES` before the offset are
+    hashed, so a file rewritten in place can be told apart from one that
+    was appended to without reading it all again.
+
+    Args:
+        file (str): The path to the file.
+        offset (int): The byte offset up to which the file was processed.
+
+    Returns:
+        str: The fingerprint in hexadecimal format.
+    """
+    head = hash_file(file, 0, min(offset, TAIL_FINGERPRINT_BYTES))
+    tail = hash_file(file, max(0, offset - TAIL_FINGERPRINT_BYTES), offset)
+    return hash_string(head + tail)
+
+
+def hash_file(file: str, start: int = 0, end: Optional[int] = None) -> str:
+    """Returns a SHA-256 hash of a file's raw bytes, read in chunks.
+
+    Args:
+        file (str): The path to the file.
+        start (int): The byte offset to start hashing at.
+        end (Optional[int]): The byte offset to stop hashing at. Defaults to
+                             the end of the file.
+
+    Returns:
+        str: The SHA-256 hash of the bytes in hexadecimal format.
+    """
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        f.seek(start)
+        if end is None:
+            end = os.fstat(f.fileno()).st_size
+        remaining = end - start
+        while remaining > 0 and (
+            chunk := f.read(min(HASH_CHUNK_SIZE, remaining))
+        ):
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+class MarkerLine(NamedTuple):
+    """A marker line found by a raw-bytes scan of a JSONL file.
+
+    Attributes:
+        offset (int): The byte offset at which the line starts.
+        length (int): The length of the line in bytes, including its newline.
+        entry (dict): The decoded marker.
+    """
+
+    offset: int
+    length: int
+    entry: dict
+
+
+def detect_compression(file: str, mode: str = "r") -> Optional[str]:
+    """Detect the compression format of a file.
+
+    Files opened for reading are identified by their magic bytes, falling
+    back to their suffix. Files opened for writing are identified by their
+    suffix only.
+
+    Args:
+        file (str): The path to the file.
+        mode (str): The mode the file will be opened in.
+
+    Returns:
+        Optional[str]: "gzip", "bz2" or "xz", or None if not compressed.
+    """
+    if mode.startswith("r"):
+        try:
+            with open(file, "rb") as f:
+                head = f.read(6)
+        except FileNotFoundError:
+            head = b""
+        for magic, compression in COMPRESSION_MAGIC.items():
+            if head.startswith(magic):
+                return compression
+        if head:
+            return None
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(str(file))[1])
+
+
+def open_jsonl(
+    file: str, mode: str = "r", compresslevel: Optional[int] = None
+) -> IO:
+    """Open a JSONL file, transparently decompressing or compressing it.
+
+    Args:
+        file (str): The path to the file.
+        mode (str): "r", "w" or "a", optionally with "b" for binary mode.
+        compresslevel (Optional[int]): The compression level for writing.
+            Defaults to `DEFAULT_COMPRESS_LEVELS` for the format.
+
+    Returns:
+        IO: The opened file object.
+    """
+    compression = detect_compression(file, mode)
+    if compression is None:
+        return open(file, mode)
+    if "b" not in mode:
+        mode += "t"
+    kwargs = {} if "b" in mode else {"encoding": "utf-8"}
+    if mode[0] in "wa":
+        if compresslevel is None:
+            compresslevel = DEFAULT_COMPRESS_LEVELS[compression]
+        if compression == "xz":
+            kwargs["preset"] = compresslevel
+        else:
+            kwargs["compresslevel"] = compresslevel
+    if compression == "gzip":
+        import gzip as module
+    elif compression == "bz2":
+        import bz2 as module
+    else:
+        import lzma as module
+    return module.open(file, mode, **kwargs)
+
+
+def is_jsonl_file(file: str) -> bool:
+    """Check whether a file name has a JSON or JSONL suffix, optionally
+    followed by a compression suffix.
+
+    Args:
+        file (str): The path to the file.
+
+    Returns:
+        bool: True if the file should be mangled.
+    """
+    root, suffix = os.path.splitext(str(file))
+    if suffix in COMPRESSION_SUFFIXES:
+        suffix = os.path.splitext(root)[1]
+    return suffix in JSONL_SUFFIXES
+
+
+class JsonCodec(NamedTuple):
+    """A JSON backend used to decode input lines and encode output lines.
+
+    Attributes:
+        name (str): The name of the backend.
+        loads (Callable[[str], Any]): Decodes a JSON document.
+        dumps (Callable[[Any], str]): Encodes an object as compact JSON.
+    """
+
+    name: str
+    loads: Callable[[str], Any]
+    dumps: Callable[[Any], str]
+
+
+def _make_json_codec() -> JsonCodec:
+    """Build the codec backed by the standard library json module."""
+    return JsonCodec(
+        "json", json.loads, partial(json.dumps, separators=(",", ":"))
+    )
+
+
+def _make_orjson_codec() -> JsonCodec:
+    """Build the codec backed by orjson.
+
+    orjson rejects some documents the json module accepts, such as NaN
+    values, so those fall back to json. It also decodes integers wider than
+    64 bits as floats instead of failing, so lines with a long run of
+    digits are decoded with json as well. Unlike json, it writes non-ASCII
+    characters unescaped.
+    """
+    import orjson
+
+    stdlib = _make_json_codec()
+
+    def loads(s):
+        if LONG_DIGITS_PATTERN.search(s):
+            return stdlib.loads(s)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return stdlib.loads(s)
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except orjson.JSONEncodeError:
+            return stdlib.dumps(obj)
+
+    return JsonCodec("orjson", loads, dumps)
+
+
+JSON_CODECS = {
+    "json": _make_json_codec,
+    "orjson": _make_orjson_codec,
+}
+_codec_cache: dict[str, JsonCodec] = {}
+
+
+def get_json_codec(name: str = "json") -> JsonCodec:
+    """Get a JSON codec by name.
+
+    The default is json, so the output (ASCII escapes, number formatting)
+    does not depend on the libraries that happen to be installed. orjson is
+    faster but has to be asked for, and writes non-ASCII characters
+    unescaped.
+
+    Args:
+        name (str): One of the names in `JSON_CODECS`.
+
+    Returns:
+        JsonCodec: The codec.
+
+    Raises:
+        ValueError: If the name is not a known codec.
+        ImportError: If the backend library is not installed.
+    """
+    if name not in JSON_CODECS:
+        raise ValueError(
+            f"Unknown JSON codec '{name}', "
+            f"expected one of {list(JSON_CODECS)}"
+        )
+    if name not in _codec_cache:
+        _codec_cache[name] = JSON_CODECS[name]()
+    return _codec_cache[name]
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Get the peak resident set size of this process or any of its children.
+
+    Returns:
+        Optional[int]: The peak RSS in bytes, or None if the platform does
+                       not report it.
+    """
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _prometheus_label(value: str) -> str:
+    """Escape a string for use as a Prometheus label value."""
+    return (
+        value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+@dataclass
+class MangleStats:
+    """Counters and timings collected while mangling.
+
+    Stage timings from parallel workers are summed, so they can add up to
+    more than the wall-clock "total".
+
+    Attributes:
+        counts (Counter): Lines and bytes read and written, start markers
+            found, and lines that were copied or decoded.
+        timings (Counter): Seconds spent in each stage, and in the whole run
+                           under "total".
+        replacements (Counter): Device names replaced, per mangled name.
+        nullified (Counter): Fields nullified, per pointer.
+        first_output_at (Optional[float]): The wall-clock time at which the
+            first output line was written, if any was.
+    """
+
+    counts: Counter = field(default_factory=Counter)
+    timings: Counter = field(default_factory=Counter)
+    replacements: Counter = field(default_factory=Counter)
+    nullified: Counter = field(default_factory=Counter)
+    first_output_at: Optional[float] = None
+
+    def merge(self, other: "MangleStats") -> "MangleStats":
+        """Add the counters and timings of another instance to this one."""
+        self.counts.update(other.counts)
+        self.timings.update(other.timings)
+        self.replacements.update(other.replacements)
+        self.nullified.update(other.nullified)
+        self.record_output(other.first_output_at)
+        return self
+
+    def record_output(self, written_at: Optional[float] = None) -> None:
+        """Record that output was written, by default now, keeping the
+        earliest time."""
+        if written_at is None:
+            if self.first_output_at is not None:
+                return
+            written_at = time.time()
+        if self.first_output_at is None or written_at < self.first_output_at:
+            self.first_output_at = written_at
+
+    def as_dict(self) -> dict:
+        """Get the stats as a JSON-serializable dictionary."""
+        return {
+            "counts": dict(self.counts),
+            "timings": {
+                stage: round(seconds, 6)
+                for stage, seconds in self.timings.items()
+            },
+            "replacements": dict(self.replacements),
+            "nullified": dict(self.nullified),
+            "first_output_at": self.first_output_at,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+
+    def to_prometheus(self, prefix: str = "filter_json") -> str:
+        """Format the stats in the Prometheus text exposition format.
+
+        Replacements are reported as a single total, since a label per
+        device would give one time series per device.
+
+        Args:
+            prefix (str): The prefix of every metric name.
+
+        Returns:
+            str: The metrics, one per line.
+        """
+        lines = []
+        for name, value in sorted(self.counts.items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        lines.append(f"# TYPE {prefix}_seconds_total counter")
+        lines.append(f"{prefix}_seconds_total {self.timings['total']:.6f}")
+        lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+        for stage, seconds in sorted(self.timings.items()):
+            if stage == "total":
+                continue
+            lines.append(
+                f'{prefix}_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}'
+            )
+        lines.append(f"# TYPE {prefix}_replacements_total counter")
+        lines.append(
+            f"{prefix}_replacements_total {sum(self.replacements.values())}"
+        )
+        lines.append(f"# TYPE {prefix}_nullified_total counter")
+        for pointer, value in sorted(self.nullified.items()):
+            label = _prometheus_label(pointer)
+            lines.append(
+                f'{prefix}_nullified_total{{pointer="{label}"}} {value}'
+            )
+        peak = peak_rss_bytes()
+        if peak is not None:
+            lines.append(f"# TYPE {prefix}_peak_rss_bytes gauge")
+            lines.append(f"{prefix}_peak_rss_bytes {peak}")
+        return "\n".join(lines) + "\n"
+
+
+def scan_lines(file: str, needle: bytes) -> Iterator[tuple[int, bytes]]:
+    """Find the lines of a file that contain a byte string.
+
+    The file is memory-mapped and searched as raw bytes, so lines that do
+    not contain the needle are never decoded. Compressed files are streamed
+    instead, and offsets refer to the decompressed data.
+
+    Args:
+        file (str): The path to the file to scan.
+        needle (bytes): The byte string to search for.
+
+    Yields:
+        tuple[int, bytes]: The byte offset and raw bytes of the next
+                           matching line.
+    """
+    if detect_compression(file):
+        with open_jsonl(file, "rb") as f:
+            offset = 0
+            for line in f:
+                if needle in line:
+                    yield offset, line
+                offset += len(line)
+        return
+    with open(file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(needle)
+            while pos != -1:
+                start = mm.rfind(b"\n", 0, pos) + 1
+                end = mm.find(b"\n", pos)
+                end = len(mm) if end == -1 else end + 1
+                yield start, mm[start:end]
+                pos = mm.find(needle, end)
+
+
+def index_start_markers(file: str) -> list[MarkerLine]:
+    """Find the Resync start markers of a JSONL file and their offsets.
+
+    Args:
+        file (str): The path to the JSONL file.
+
+    Returns:
+        list[MarkerLine]: The start markers in file order.
+    """
+    markers = []
+    for offset, line in scan_lines(file, START_MARKER_SIGNATURE):
+        decoded = line.decode("utf-8")
+        if is_start_marker_line(decoded):
+            markers.append(MarkerLine(offset, len(line), json.loads(decoded)))
+    return markers
+
+
+def read_device_mappings(file: str) -> dict[str, str]:
+    """Read device mappings from a JSON file.
+
+    Args:
+        file (str): The path to the JSON file containing device mappings.
+
+    Returns:
+        dict[str, str]: A dictionary mapping device names
+                        to their mangled names.
+    """
+    # Get Resync Start markers from the lines mentioning ResyncMarker
+    markers = []
+    for _, line in scan_lines(file, b"ResyncMarker"):
+        entry = json.loads(line)
+        if entry.get("event", {}).get("marker_type") == "start":
+            markers.append(entry)
+
+    # Extract device mappings from markers
+    return get_device_mappings(markers)
+
+
+def read_start_markers(file: str) -> list[dict]:
+    """Get the Start markers from a JSONL file.
+
+    Args:
+        file (str): The path to the JSONL file.
+
+    Returns:
+        list[dict]: A list of dictionaries representing the start markers.
+    """
+    return [marker.entry for marker in index_start_markers(file)]
+
+
+def is_start_marker_line(line: str) -> bool:
+    """Check whether a raw JSONL line is a Resync start marker.
+
+    Args:
+        line (str): The raw line to check.
+
+    Returns:
+        bool: True if the line is a start marker.
+    """
+    return "ResyncMarker" in line and '"marker_type":"start"' in line
+
+
+def get_device_mappings(markers: list[dict]) -> dict[str, str]:
+    """Get a mapping of device names to their new mangled names.
+
+    Args:
+        markers (list[dict]): A list of dictionaries representing
+                              the start markers.
+
+    Returns:
+        dict[str, str]: A dictionary mapping device names
+                        to their mangled names.
+    """
+    return update_device_mappings({}, markers)
+
+
+class DeviceRule(NamedTuple):
+    """A rule for extracting a device name from a marker's device value.
+
+    A value such as "MD=CISCO_EPNM!ND=URDELAB080" names the device after a
+    key token, among other `!`-separated tokens.
+
+    Attributes:
+        vendor (str): The prefix the value must start with, such as
+                      "MD=CISCO_EPNM", or "" to apply to any value.
+        key (str): The token the device name follows, such as "ND".
+        chars (str): The regex character class of the device name.
+    """
+
+    vendor: str
+    key: str
+    chars: str = DEFAULT_DEVICE_CHARS
+
+
+def compile_device_rules(
+    rules: Iterable[DeviceRule], in_text: bool = False
+) -> re.Pattern:
+    """Compile extractor rules into one pattern with a group per rule.
+
+    Rules with a vendor prefix are anchored to the start of the value, so
+    they take precedence over rules for any vendor. Among rules that match
+    at the same place, the earlier one wins.
+
+    Args:
+        rules (Iterable[DeviceRule]): The rules to compile.
+        in_text (bool): Whether the pattern searches raw JSON text, where a
+                        value starts after a quote, rather than one value.
+
+    Returns:
+        re.Pattern: A pattern whose last matched group is the device name.
+    """
+    start, token = ('(?<=")', '[^!"]') if in_text else ("^", "[^!]")
+    alternatives = []
+    for rule in rules:
+        name = f"{re.escape(rule.key)}=({rule.chars}+)"
+        if rule.vendor:
+            prefix = re.escape(rule.vendor)
+            alternatives.append(f"{start}{prefix}!(?:{token}*!)*?{name}")
+        else:
+            alternatives.append(f"!{name}")
+    return re.compile("|".join(alternatives) or "(?!)")
+
+
+# Rules for extracting device names, compiled into a single pattern
+DEVICE_RULES = [DeviceRule("", "ND")]
+_device_rules_pattern = compile_device_rules(DEVICE_RULES)
+# The same rules for finding device values anywhere in a raw line
+_device_token_pattern = compile_device_rules(DEVICE_RULES, in_text=True)
+
+
+def register_device_rules(rules: Iterable[DeviceRule]) -> None:
+    """Add extractor rules to the registry and recompile its pattern.
+
+    Args:
+        rules (Iterable[DeviceRule]): The rules to add after the current
+                                      ones.
+    """
+    global _device_rules_pattern, _device_token_pattern
+    DEVICE_RULES.extend(DeviceRule(*rule) for rule in rules)
+    _device_rules_pattern = compile_device_rules(DEVICE_RULES)
+    _device_token_pattern = compile_device_rules(DEVICE_RULES, in_text=True)
+
+
+def load_device_rules(file: str) -> list[DeviceRule]:
+    """Read extractor rules from a JSON file.
+
+    The file holds a list of rules, such as
+    `[{"vendor": "MD=JUNIPER", "key": "NE", "chars": "[A-Za-z0-9_.-]"}]`,
+    where "chars" is optional.
+
+    Args:
+        file (str): The path to the JSON file.
+
+    Returns:
+        list[DeviceRule]: The rules in file order.
+
+    Raises:
+        ValueError: If a rule has no key or an invalid character class.
+    """
+    with open(file, "r") as f:
+        rules = [DeviceRule(**rule) for rule in json.load(f)]
+    for rule in rules:
+        if not rule.key:
+            raise ValueError(f"Device rule {rule} has no key")
+        try:
+            groups = re.compile(rule.chars).groups
+        except re.error as e:
+            raise ValueError(f"Device rule {rule} is invalid: {e}") from e
+        if groups:
+            raise ValueError(f"Device rule {rule} has a capturing group")
+    return rules
+
+
+def extract_device_name(device: str) -> str:
+    """Extract a device name from a marker's device value.
+
+    Args:
+        device (str): The device value, such as
+                      "MD=CISCO_EPNM!ND=URDELAB080".
+
+    Returns:
+        str: The name captured by the first matching rule of
+             `DEVICE_RULES`, or the whole value if no rule matches.
+    """
+    if match := _device_rules_pattern.search(device):
+        return match.group(match.lastindex)
+    return device
+
+
+def extract_device_names(markers: Iterable[dict]) -> Iterator[str]:
+    """Extract the device names referenced by start markers.
+
+    Args:
+        markers (Iterable[dict]): The start markers.
+
+    Yields:
+        str: The next device name, in order of appearance.
+    """
+    for marker in markers:
+        for device in _find_property_devices(marker):
+            yield extract_device_name(device)
+
+
+def _find_property_devices(node: Any) -> Iterator[Any]:
+    """Find the values of `$..properties.device` in document order, as
+    jsonpath_ng does, without building its parser."""
+    if isinstance(node, dict):
+        properties = node.get("properties")
+        if isinstance(properties, dict) and "device" in properties:
+            yield properties["device"]
+        for value in node.values():
+            yield from _find_property_devices(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from _find_property_devices(item)
+
+
+def update_device_mappings(
+    mappings: dict[str, str], markers: Iterable[dict]
+) -> dict[str, str]:
+    """Add the devices of new start markers to an existing mapping.
+
+    New devices are numbered after the ones already in the mapping, so a
+    mapping can be built up incrementally as markers arrive.
+
+    Args:
+        mappings (dict[str, str]): The mapping to extend in place.
+        markers (Iterable[dict]): The new start markers.
+
+    Returns:
+        dict[str, str]: The extended mapping.
+    """
+    return number_device_names(mappings, extract_device_names(markers))
+
+
+def number_device_names(
+    mappings: dict[str, str], device_names: Iterable[str]
+) -> dict[str, str]:
+    """Add new device names to an existing mapping, numbered in order.
+
+    Args:
+        mappings (dict[str, str]): The mapping to extend in place.
+        device_names (Iterable[str]): The device names, in order of
+                                      appearance.
+
+    Returns:
+        dict[str, str]: The extended mapping.
+    """
+    counter = len(mappings) + 1
+    for device_name in device_names:
+        # Add extracted names to mappings if not present
+        if device_name not in mappings:
+            mappings[device_name] = f"DEVICE-{counter:03}"
+            counter += 1
+    return mappings
+
+
+class DeviceMappingStore:
+    """A device mapping persisted in SQLite and shared across runs.
+
+    Aliases are numbered by insertion order in the database, so a device
+    keeps the same alias in every file and run that uses the same store.
+    Several processes may extend the store concurrently. The whole table is
+    mirrored in memory for constant-time lookups and only new rows are read
+    on refresh.
+
+    Attributes:
+        path (str): The path to the SQLite database file.
+        mappings (dict[str, str]): The in-memory mapping of device names
+                                   to their mangled names.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        """Open or create a mapping store.
+
+        Args:
+            path (str): The path to the SQLite database file.
+            timeout (float): Seconds to wait for other writers to finish.
+        """
+        self.path = path
+        self.mappings: dict[str, str] = {}
+        self._last_id = 0
+        import sqlite3
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path,
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS devices ("
+            "id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)"
+        )
+        self.refresh()
+
+    def refresh(self) -> dict[str, str]:
+        """Load devices added to the database since the last refresh.
+
+        Returns:
+            dict[str, str]: A snapshot of the updated in-memory mapping,
+                            which other threads cannot change.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, name FROM devices WHERE id > ? ORDER BY id",
+                (self._last_id,),
+            )
+            for device_id, name in rows:
+                self.mappings[name] = f"DEVICE-{device_id:03}"
+                self._last_id = device_id
+            return dict(self.mappings)
+
+    def add_devices(self, device_names: Iterable[str]) -> dict[str, str]:
+        """Assign aliases to any devices not yet in the store.
+
+        Args:
+            device_names (Iterable[str]): The device names to add.
+
+        Returns:
+            dict[str, str]: A snapshot of the updated in-memory mapping.
+        """
+        with self._lock:
+            new_names = [
+                (name,)
+                for name in dict.fromkeys(device_names)
+                if name not in self.mappings
+            ]
+            if not new_names:
+                return dict(self.mappings)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO devices (name) VALUES (?)",
+                    new_names,
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.refresh()
+
+    def add_markers(self, markers: Iterable[dict]) -> dict[str, str]:
+        """Assign aliases to the devices of new start markers.
+
+        Args:
+            markers (Iterable[dict]): The start markers.
+
+        Returns:
+            dict[str, str]: A snapshot of the updated in-memory mapping.
+        """
+        return self.add_devices(extract_device_names(markers))
+
+    def close(self) -> None:
+        """Close the database connection."""
+        self._conn.close()
+
+
+class HashMappingStore:
+    """A device mapping whose aliases are derived by hashing device names.
+
+    Each alias is a truncated SHA-256 of the device name, or an HMAC-SHA256
+    if a secret key is given, so every process assigns a device the same
+    alias on first sight without sharing any state or seeing the other
+    devices. Without a key, aliases of known device names can be reversed
+    by hashing candidates. Collisions between the devices a process has
+    seen are detected; processes that never meet cannot detect theirs, so
+    the width should leave collisions unlikely for the whole fleet.
+
+    It can be used as the `mapping_store` wherever a `DeviceMappingStore`
+    is accepted. As any device can be aliased on first sight, files are not
+    scanned ahead for their start markers. Instead, the devices of start
+    markers, and device values that match `DEVICE_RULES` anywhere, are
+    aliased as the lines are mangled. A piece of a dump that starts in the
+    middle of a Resync therefore does not leak the names its start marker
+    would have given. A bare device name is only replaced from the first
+    line that names the device in a start marker or device value.
+
+    Attributes:
+        mappings (dict[str, str]): The in-memory mapping of device names
+                                   seen so far to their mangled names.
+    """
+
+    def __init__(
+        self, key: Optional[bytes] = None, width: int = DEFAULT_ALIAS_WIDTH
+    ):
+        """Prepare to hash device names.
+
+        Args:
+            key (Optional[bytes]): The secret key of the HMAC. Plain SHA-256
+                                   is used without one.
+            width (int): The number of hexadecimal digits to keep, from 1
+                         to 64.
+
+        Raises:
+            ValueError: If the width is out of range.
+        """
+        if not 1 <= width <= 64:
+            raise ValueError(f"Alias width must be from 1 to 64, not {width}")
+        self.key = key
+        self.width = width
+        self.mappings: dict[str, str] = {}
+        self._devices: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Worker processes get a copy of the store without its lock
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def alias(self, device_name: str) -> str:
+        """Get the alias of a device name.
+
+        Args:
+            device_name (str): The device name.
+
+        Returns:
+            str: The alias, such as "DEVICE-3fa91c07b2de".
+        """
+        if self.key is None:
+            digest = hash_string(device_name)
+        else:
+            import hmac
+
+            digest = hmac.new(
+                self.key, device_name.encode("utf-8"), hashlib.sha256
+            ).hexdigest()
+        return f"DEVICE-{digest[:self.width]}"
+
+    def alias_pattern(self) -> re.Pattern:
+        """Compile a pattern matching any alias of the store, including
+        those of devices it has not seen yet.
+
+        Matches must be checked with `is_device_match`, as for
+        `compile_alias_pattern`.
+        """
+        return re.compile(
+            f"DEVICE-[0-9a-f]{{{self.width}}}{DEVICE_BOUNDARY_END}"
+        )
+
+    def refresh(self) -> dict[str, str]:
+        """Get the in-memory mapping, which has no other source to load.
+
+        Returns:
+            dict[str, str]: A snapshot of the in-memory mapping.
+        """
+        with self._lock:
+            return dict(self.mappings)
+
+    def add_devices(self, device_names: Iterable[str]) -> dict[str, str]:
+        """Assign aliases to any devices not seen yet.
+
+        Args:
+            device_names (Iterable[str]): The device names to add.
+
+        Returns:
+            dict[str, str]: A snapshot of the updated in-memory mapping.
+
+        Raises:
+            ValueError: If two devices hash to the same alias.
+        """
+        with self._lock:
+            for name in device_names:
+                if name in self.mappings:
+                    continue
+                alias = self.alias(name)
+                if (other := self._devices.get(alias, name)) != name:
+                    raise ValueError(
+                        f"Devices {other!r} and {name!r} both hash to "
+                        f"{alias}, use a larger alias width"
+                    )
+                self._devices[alias] = name
+                self.mappings[name] = alias
+            return dict(self.mappings)
+
+    def add_markers(self, markers: Iterable[dict]) -> dict[str, str]:
+        """Assign aliases to the devices of new start markers.
+
+        Args:
+            markers (Iterable[dict]): The start markers.
+
+        Returns:
+            dict[str, str]: A snapshot of the updated in-memory mapping.
+        """
+        return self.add_devices(extract_device_names(markers))
+
+    def close(self) -> None:
+        """Do nothing, as there is no connection to close."""
+
+
+def read_alias_key(file: Optional[str]) -> Optional[bytes]:
+    """Read the secret key for hashed aliases from a file.
+
+    Args:
+        file (Optional[str]): The path to the key file, or None for no key.
+
+    Returns:
+        Optional[bytes]: The key without surrounding whitespace.
+
+    Raises:
+        ValueError: If the file holds no key.
+    """
+    if file is None:
+        return None
+    with open(file, "rb") as f:
+        key = f.read().strip()
+    if not key:
+        raise ValueError(f"Alias key file {file} is empty")
+    return key
+
+
+class ResultCache:
+    """A directory of mangled outputs keyed by their input and settings.
+
+    Outputs are copied in and out of the cache, so later appends to an
+    output do not change its cached copy. Once the cached outputs add up
+    to more than `max_bytes`, the least recently used ones are evicted.
+    Several processes may share a directory; each evicts only the entries
+    it has stored or used.
+
+    Attributes:
+        path (str): The cache directory.
+        max_bytes (int): The total size of the outputs to keep.
+        hits (int): The number of lookups that found an output.
+        misses (int): The number of lookups that did not.
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_CACHE_BYTES):
+        """Open or create a result cache.
+
+        Args:
+            path (str): The cache directory.
+            max_bytes (int): The total size of the outputs to keep.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # Entries in order of last use, oldest first
+        entries = sorted(
+            (
+                (entry.stat().st_mtime, entry.name, entry.stat().st_size)
+                for entry in os.scandir(path)
+                if entry.name.endswith(CACHE_ENTRY_SUFFIX)
+            )
+        )
+        self._entries: OrderedDict[str, int] = OrderedDict(
+            (name, size) for _, name, size in entries
+        )
+        self._size = sum(self._entries.values())
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """Build a cache key from JSON-serializable parts."""
+        return hash_string(json.dumps(parts, sort_keys=True))
+
+    def get(self, key: str, output_file: str) -> bool:
+        """Copy the cached output for a key to a file, if there is one.
+
+        Args:
+            key (str): A key from `key`.
+            output_file (str): The path to copy the output to.
+
+        Returns:
+            bool: True if the output was found and copied.
+        """
+        name = key + CACHE_ENTRY_SUFFIX
+        entry = os.path.join(self.path, name)
+        try:
+            shutil.copyfile(entry, output_file)
+            os.utime(entry)
+            size = os.path.getsize(entry)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+        return True
+
+    def put(self, key: str, output_file: str) -> None:
+        """Store a copy of an output under a key, evicting old outputs.
+
+        Outputs larger than the whole cache are not stored.
+
+        Args:
+            key (str): A key from `key`.
+            output_file (str): The path of the output to store.
+        """
+        size = os.path.getsize(output_file)
+        if size > self.max_bytes:
+            return
+        name = key + CACHE_ENTRY_SUFFIX
+        entry = os.path.join(self.path, name)
+        tmp_file = f"{entry}.{os.getpid()}-{threading.get_ident()}.tmp"
+        shutil.copyfile(output_file, tmp_file)
+        os.replace(tmp_file, entry)
+        with self._lock:
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            while self._size > self.max_bytes:
+                evicted, evicted_size = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                try:
+                    os.remove(os.path.join(self.path, evicted))
+                except FileNotFoundError:
+                    pass
+
+
+def iter_json_lines(file: str) -> Iterator[dict]:
+    """Lazily read entries from a JSONL file, one line at a time.
+
+    Args:
+        file (str): The path to the JSONL file.
+
+    Yields:
+        dict: The next entry decoded from the file.
+    """
+    with open_jsonl(file, "r") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _trie_regex(words: Iterable[str]) -> str:
+    """Build a regex alternation that shares common prefixes between words.
+
+    The engine walks a single trie instead of trying every word in turn at
+    each position, so matching cost stays flat as the word count grows.
+
+    Args:
+        words (Iterable[str]): The literal words to match.
+
+    Returns:
+        str: A regex string matching any of the words.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        is_word_end = "" in node
+        branches = [
+            re.escape(char) + build(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not is_word_end:
+            return branches[0]
+        alternation = "(?:" + "|".join(branches) + ")"
+        return alternation + "?" if is_word_end else alternation
+
+    return build(trie)
+
+
+def compile_device_pattern(
+    device_mappings: dict[str, str]
+) -> Optional[re.Pattern]:
+    """Compile all known device names into a single regex.
+
+    Only whole device names are matched, so `URDELAB08` does not match
+    inside `URDELAB080`. When every name is made of word characters, the
+    start of the name is checked by `is_device_match` instead of a leading
+    lookbehind, which lets the regex engine skip ahead to candidate first
+    characters and makes a scan of a line with no devices much cheaper.
+
+    Args:
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+
+    Returns:
+        Optional[re.Pattern]: The compiled pattern, or None if there are no
+                              device names to match.
+    """
+    devices = [device for device in device_mappings if device]
+    if not devices:
+        return None
+    alternation = _trie_regex(devices)
+    if all(DEVICE_PATTERN_PLAIN.match(device) for device in devices):
+        return re.compile(f"(?:{alternation}){DEVICE_BOUNDARY_END}")
+    return re.compile(
+        f"{DEVICE_BOUNDARY_START}(?:{alternation}){DEVICE_BOUNDARY_END}"
+    )
+
+
+def is_device_match(match: re.Match) -> bool:
+    """Check that a device pattern match is not the tail of a longer name.
+
+    Args:
+        match (re.Match): A match of a pattern from `compile_device_pattern`.
+
+    Returns:
+        bool: True if the match starts a whole device name.
+    """
+    start = match.start()
+    return start == 0 or not DEVICE_CHAR_PATTERN.match(match.string, start - 1)
+
+
+def replace_device_names(
+    text: str,
+    device_mappings: dict[str, str],
+    pattern: Optional[re.Pattern] = None,
+    counts: Optional[Counter] = None,
+) -> str:
+    """Replace every known device name in a string in a single scan.
+
+    Args:
+        text (str): The string to search.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+        pattern (Optional[re.Pattern]): A pattern from
+            `compile_device_pattern`. Compiled on the fly if not given.
+        counts (Optional[Counter]): Incremented for each replacement, keyed
+                                    by mangled name.
+
+    Returns:
+        str: The string with device names replaced by their mangled names.
+    """
+    if pattern is None:
+        pattern = compile_device_pattern(device_mappings)
+    if pattern is None:
+        return text
+    if counts is None:
+        return pattern.sub(
+            lambda match: (
+                device_mappings[match[0]]
+                if is_device_match(match)
+                else match[0]
+            ),
+            text,
+        )
+
+    def replace(match: re.Match) -> str:
+        if not is_device_match(match):
+            return match[0]
+        alias = device_mappings[match[0]]
+        counts[alias] += 1
+        return alias
+
+    return pattern.sub(replace, text)
+
+
+def mangle_entry(
+    entry: dict,
+    device_mappings: dict[str, str],
+    pattern: Optional[re.Pattern] = None,
+) -> dict:
+    """Mangle device names in a single entry.
+
+    Args:
+        entry (dict): A dictionary representing one JSONL entry.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+        pattern (Optional[re.Pattern]): A pattern from
+            `compile_device_pattern`. Compiled on the fly if not given.
+
+    Returns:
+        dict: A new dictionary with mangled device names.
+    """
+    entry_str = replace_device_names(
+        json.dumps(entry), device_mappings, pattern
+    )
+    return json.loads(entry_str)
+
+
+def mangle_device_names(
+    data: list[dict], device_mappings: dict[str, str]
+) -> list[dict]:
+    """Mangle device names in the data using the provided device hashes.
+
+    Args:
+        data (list[dict]): A list of dictionaries representing the JSONL data.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+
+    Returns:
+        list[dict]: The list of dictionaries with mangled device names.
+    """
+    pattern = compile_device_pattern(device_mappings)
+    return [mangle_entry(entry, device_mappings, pattern) for entry in data]
+
+
+class DevicePathIndex(NamedTuple):
+    """The JSON paths that can hold device names, per event type.
+
+    Attributes:
+        paths (dict[str, list[str]]): Paths such as
+            "event.object_data.locations[].neName", keyed by the event's
+            `_type`.
+        tries (dict[str, dict]): The paths of each event type merged into
+                                 a trie of path tokens.
+    """
+
+    paths: dict
+    tries: dict
+
+
+def event_type(entry: Any) -> Optional[str]:
+    """Get the `_type` of an entry's event, or None if it has none."""
+    if isinstance(entry, dict) and isinstance(entry.get("event"), dict):
+        return entry["event"].get("_type")
+    return None
+
+
+def compile_device_path_index(
+    paths: dict[str, list[str]]
+) -> DevicePathIndex:
+    """Compile the device paths of each event type into tries.
+
+    Event types without paths are left out of the tries, so their entries
+    are replaced in full rather than not at all.
+
+    Args:
+        paths (dict[str, list[str]]): Dotted paths keyed by event type.
+            "[]" after a key steps into each item of a list and "*" as a
+            key steps into each value of an object.
+
+    Returns:
+        DevicePathIndex: The compiled index.
+
+    Raises:
+        ValueError: If a path is empty or malformed.
+    """
+    tries = {}
+    for type_name, type_paths in paths.items():
+        if not type_paths:
+            continue
+        trie: dict = {}
+        for path in type_paths:
+            tokens = DEVICE_PATH_TOKEN_PATTERN.findall(path)
+            if not all(path.split(".")) or "".join(tokens) != path.replace(
+                ".", ""
+            ):
+                raise ValueError(f"Malformed device path '{path}'")
+            node = trie
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[PATH_END] = True
+        tries[type_name] = trie
+    return DevicePathIndex(paths, tries)
+
+
+def _replace_at_trie(
+    node: Any,
+    trie: dict,
+    device_mappings: dict[str, str],
+    pattern: re.Pattern,
+    counts: Optional[Counter] = None,
+) -> None:
+    """Replace device names in the strings a path trie selects."""
+    for token, child in trie.items():
+        if token == PATH_END:
+            continue
+        if token == PATH_EACH_ITEM:
+            if not isinstance(node, list):
+                continue
+            keys = range(len(node))
+        elif not isinstance(node, dict):
+            continue
+        elif token == PATH_EACH_VALUE:
+            keys = list(node)
+        elif token in node:
+            keys = (token,)
+        else:
+            continue
+        for key in keys:
+            value = node[key]
+            if isinstance(value, str):
+                if PATH_END in child:
+                    node[key] = replace_device_names(
+                        value, device_mappings, pattern, counts
+                    )
+            elif isinstance(value, (dict, list)):
+                _replace_at_trie(
+                    value, child, device_mappings, pattern, counts
+                )
+
+
+def replace_device_paths(
+    entry: dict,
+    index: DevicePathIndex,
+    device_mappings: dict[str, str],
+    pattern: Optional[re.Pattern] = None,
+    counts: Optional[Counter] = None,
+) -> bool:
+    """Replace device names only at the indexed paths of an entry.
+
+    Subtrees outside the paths indexed for the entry's event type are not
+    visited at all.
+
+    Args:
+        entry (dict): A decoded entry, modified in place.
+        index (DevicePathIndex): An index from `compile_device_path_index`.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+        pattern (Optional[re.Pattern]): A pattern from
+            `compile_device_pattern`. Compiled on the fly if not given.
+        counts (Optional[Counter]): Incremented for each replacement, keyed
+                                    by mangled name.
+
+    Returns:
+        bool: False if the entry's event type is not in the index, in which
+              case the entry is left as it is.
+    """
+    trie = index.tries.get(event_type(entry))
+    if trie is None:
+        return False
+    if pattern is None:
+        pattern = compile_device_pattern(device_mappings)
+    if pattern is not None:
+        _replace_at_trie(entry, trie, device_mappings, pattern, counts)
+    return True
+
+
+def _find_device_paths(
+    node: Any, path: str, pattern: re.Pattern, found: set
+) -> None:
+    """Add the paths of the strings below a node that hold device names."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            # Keys that the path syntax cannot express are skipped
+            if DEVICE_PATH_TOKEN_PATTERN.fullmatch(key) and key != "*":
+                child = f"{path}.{key}" if path else key
+                _find_device_paths(value, child, pattern, found)
+    elif isinstance(node, list):
+        for item in node:
+            _find_device_paths(item, f"{path}[]", pattern, found)
+    elif isinstance(node, str) and any(
+        is_device_match(match) for match in pattern.finditer(node)
+    ):
+        found.add(path)
+
+
+def learn_device_paths(
+    entries: Iterable[dict],
+    device_mappings: dict[str, str],
+    pattern: Optional[re.Pattern] = None,
+) -> dict[str, list[str]]:
+    """Learn which paths hold device names in a sample of entries.
+
+    Args:
+        entries (Iterable[dict]): The sample of decoded entries.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+        pattern (Optional[re.Pattern]): A pattern from
+            `compile_device_pattern`. Compiled on the fly if not given.
+
+    Returns:
+        dict[str, list[str]]: The sorted paths found, keyed by event type.
+            Event types whose sampled entries held no device name are left
+            out, so that their entries are still replaced in full.
+    """
+    if pattern is None:
+        pattern = compile_device_pattern(device_mappings)
+    found: dict[str, set] = {}
+    for entry in entries:
+        type_name = event_type(entry)
+        if type_name is None or pattern is None:
+            continue
+        paths = found.setdefault(type_name, set())
+        _find_device_paths(entry, "", pattern, paths)
+    return {
+        type_name: sorted(paths)
+        for type_name, paths in found.items()
+        if paths
+    }
+
+
+def load_device_path_index(
+    path: str,
+    input_files: Iterable[str] = (),
+    sample_lines: int = DEFAULT_LEARN_LINES,
+) -> DevicePathIndex:
+    """Load device paths from a JSON file, learning them if it is missing.
+
+    Paths are learned from the first lines of the input files, with the
+    devices of each file's start markers, and saved to the file for later
+    runs. Values at paths that the sample did not show holding a device
+    name are not replaced, so the sample should cover every event type and
+    field that can carry one.
+
+    Args:
+        path (str): The JSON file mapping event types to lists of paths.
+        input_files (Iterable[str]): The files to learn the paths from.
+        sample_lines (int): The number of lines to learn the paths from, in
+                            total across the files.
+
+    Returns:
+        DevicePathIndex: The compiled index.
+    """
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return compile_device_path_index(json.load(f))
+
+    paths: dict[str, set] = {}
+    remaining = sample_lines
+    for input_file in input_files:
+        if remaining <= 0:
+            break
+        device_mappings = get_device_mappings(read_start_markers(input_file))
+        with open_jsonl(input_file, "r") as f:
+            sample = [
+                json.loads(line)
+                for line in islice(f, remaining)
+                if line.strip()
+            ]
+        remaining -= len(sample)
+        learned = learn_device_paths(sample, device_mappings)
+        for type_name, type_paths in learned.items():
+            paths.setdefault(type_name, set()).update(type_paths)
+    paths = {
+        type_name: sorted(paths[type_name]) for type_name in sorted(paths)
+    }
+    with open(path, "w") as f:
+        json.dump(paths, f, indent=2)
+        f.write("\n")
+    return compile_device_path_index(paths)
+
+
+class NullifyPlan(NamedTuple):
+    """Pointers compiled for nullifying fields in a single walk per entry.
+
+    Attributes:
+        trie (dict): Nested keys of the simple pointers. A key mapped to
+                     its pointer is nullified, a key mapped to a dict is
+                     descended.
+        expressions (list): Pairs of a pointer that is not plain dotted keys
+                            and its compiled jsonpath_ng expression.
+        key_pattern (Optional[re.Pattern]): Matches the raw JSON of any key
+            the trie nullifies, or None if the trie is empty.
+    """
+
+    trie: dict
+    expressions: list
+    key_pattern: Optional[re.Pattern] = None
+
+
+def is_simple_pointer(pointer: JsonPathStr) -> bool:
+    """Check whether a pointer is a plain key or a dotted path of keys.
+
+    Args:
+        pointer (JsonPathStr): The pointer to check.
+
+    Returns:
+        bool: True if the pointer can be nullified without jsonpath_ng.
+    """
+    return bool(SIMPLE_POINTER_PATTERN.match(pointer)) and not any(
+        key in JSONPATH_KEYWORDS for key in pointer.split(".")
+    )
+
+
+def compile_nullify_plan(pointers: list[JsonPathStr]) -> NullifyPlan:
+    """Compile a list of pointers into a nullification plan.
+
+    Simple pointers are merged into a key trie. Other pointers are parsed
+    with jsonpath_ng once here rather than once per entry.
+
+    Args:
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                      representing the fields to nullify.
+
+    Returns:
+        NullifyPlan: The compiled plan.
+    """
+    trie: dict = {}
+    expressions = []
+    for pointer in pointers:
+        if not is_simple_pointer(pointer):
+            from jsonpath_ng import parse as jsonparse
+
+            expressions.append(
+                (pointer, jsonparse(f"$..{NULLIFY_ROOT_KEY}..{pointer}"))
+            )
+            continue
+        *parents, last = pointer.split(".")
+        node = trie
+        for key in parents:
+            child = node.setdefault(key, {})
+            if isinstance(child, str):
+                # A shorter pointer already nullifies this whole subtree
+                break
+            node = child
+        else:
+            node[last] = pointer
+    return NullifyPlan(trie, expressions, _compile_key_pattern(trie))
+
+
+def _compile_key_pattern(trie: dict) -> Optional[re.Pattern]:
+    """Compile a regex matching the raw JSON of the keys a trie nullifies."""
+    keys = set()
+    nodes = [trie]
+    while nodes:
+        for key, child in nodes.pop().items():
+            if isinstance(child, str):
+                keys.add(key)
+            else:
+                nodes.append(child)
+    if not keys:
+        return None
+    return re.compile(f'"(?:{_trie_regex(keys)})":')
+
+
+def _apply_trie(
+    data: dict, trie: dict, counts: Optional[Counter] = None
+) -> None:
+    """Nullify the fields of a trie relative to a single dictionary."""
+    for key, child in trie.items():
+        if key not in data:
+            continue
+        if isinstance(child, str):
+            data[key] = ""
+            if counts is not None:
+                counts[child] += 1
+        elif isinstance(data[key], dict):
+            _apply_trie(data[key], child, counts)
+
+
+def _walk_nullify(
+    data, trie: dict, inside_root: bool, counts: Optional[Counter] = None
+) -> None:
+    """Apply a trie at every dictionary below an `object_data` key."""
+    if isinstance(data, dict):
+        if inside_root:
+            _apply_trie(data, trie, counts)
+        for key, value in data.items():
+            _walk_nullify(
+                value, trie, inside_root or key == NULLIFY_ROOT_KEY, counts
+            )
+    elif isinstance(data, list):
+        for item in data:
+            _walk_nullify(item, trie, inside_root, counts)
+
+
+def nullify_entry(
+    entry: dict,
+    pointers: list[JsonPathStr],
+    plan: Optional[NullifyPlan] = None,
+    counts: Optional[Counter] = None,
+) -> dict:
+    """Nullify fields in a single entry based on the provided JSON Pointers.
+
+    Args:
+        entry (dict): A dictionary representing one JSONL entry.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                      representing the fields to nullify.
+        plan (Optional[NullifyPlan]): A plan from `compile_nullify_plan`.
+            Compiled on the fly if not given.
+        counts (Optional[Counter]): Incremented for each nullified field,
+                                    keyed by pointer.
+
+    Returns:
+        dict: The entry with specified fields set to an empty string.
+    """
+    if plan is None:
+        plan = compile_nullify_plan(pointers)
+    if plan.trie:
+        _walk_nullify(entry, plan.trie, False, counts)
+    for pointer, jsonpath_expr in plan.expressions:
+        if counts is not None:
+            counts[pointer] += len(jsonpath_expr.find(entry))
+        entry = jsonpath_expr.update(entry, "")
+    return entry
+
+
+def nullify_fields(
+    data: list[dict], pointers: list[JsonPathStr]
+) -> list[dict]:
+    """Nullify fields in the data based on the provided JSON Pointers.
+
+    Args:
+        data (list[dict]): A list of dictionaries representing the JSONL data.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                      representing the fields to nullify.
+
+    Returns:
+        list[dict]: The modified list of dictionaries with specified fields
+                    set to an empty string.
+    """
+    if not pointers:
+        return data
+    plan = compile_nullify_plan(pointers)
+    return [nullify_entry(entry, pointers, plan) for entry in data]
+
+
+def mangle_entries(
+    entries: Iterable[dict],
+    device_mappings: dict[str, str],
+    pointers: list[JsonPathStr],
+) -> Iterator[dict]:
+    """Lazily mangle device names and nullify fields in a stream of entries.
+
+    Only one entry is held in memory at a time, so this can be chained
+    between a reader and a writer to process files of any size.
+
+    Args:
+        entries (Iterable[dict]): The entries to process.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                      representing the fields to nullify.
+
+    Yields:
+        dict: The next entry with mangled device names and nullified fields.
+    """
+    pattern = compile_device_pattern(device_mappings)
+    plan = compile_nullify_plan(pointers)
+    for entry in entries:
+        entry = mangle_entry(entry, device_mappings, pattern)
+        if pointers:
+            entry = nullify_entry(entry, pointers, plan)
+        yield entry
+
+
+def line_may_change(
+    line: str, pattern: Optional[re.Pattern], plan: NullifyPlan
+) -> bool:
+    """Check whether mangling could change the content of a raw line.
+
+    Args:
+        line (str): The raw line.
+        pattern (Optional[re.Pattern]): A pattern from
+                                        `compile_device_pattern`.
+        plan (NullifyPlan): A plan from `compile_nullify_plan`.
+
+    Returns:
+        bool: False only if the line has no known device and no field to
+              nullify.
+    """
+    if pattern is not None and any(
+        is_device_match(match) for match in pattern.finditer(line)
+    ):
+        return True
+    if (plan.trie or plan.expressions) and f'"{NULLIFY_ROOT_KEY}":' in line:
+        if plan.expressions:
+            return True
+        if plan.key_pattern.search(line):
+            return True
+    return False
+
+
+def _alias_stream_devices(
+    line: str,
+    alias_store: HashMappingStore,
+    device_mappings: dict[str, str],
+    pattern: Optional[re.Pattern],
+) -> tuple[dict[str, str], Optional[re.Pattern]]:
+    """Alias the unknown devices of a raw line's start marker or device
+    values.
+
+    Returns:
+        tuple[dict[str, str], Optional[re.Pattern]]: The device mapping and
+            its pattern, recompiled only if the line named new devices.
+    """
+    names = {
+        match.group(match.lastindex)
+        for match in _device_token_pattern.finditer(line)
+    }
+    if is_start_marker_line(line):
+        names.update(extract_device_names([json.loads(line)]))
+    if names <= device_mappings.keys():
+        return device_mappings, pattern
+    device_mappings = alias_store.add_devices(names)
+    return device_mappings, compile_device_pattern(device_mappings)
+
+
+def _stream_alias_store(
+    mapping_store: Optional[DeviceMappingStore],
+) -> Optional[HashMappingStore]:
+    """Get the store to alias devices found in lines with, if any."""
+    if isinstance(mapping_store, HashMappingStore):
+        return mapping_store
+    return None
+
+
+def mangle_lines(
+    lines: Iterable[str],
+    device_mappings: dict[str, str],
+    pointers: list[JsonPathStr],
+    pattern: Optional[re.Pattern] = None,
+    plan: Optional[NullifyPlan] = None,
+    codec: str = "json",
+    passthrough: bool = True,
+    stats: Optional[MangleStats] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+    alias_store: Optional[HashMappingStore] = None,
+) -> Iterator[str]:
+    """Lazily mangle and nullify raw JSONL lines.
+
+    Device names are replaced directly in the raw text, so each line is
+    decoded and encoded only once. Output lines are encoded as compact JSON.
+    Lines whose content mangling cannot change skip device replacement and
+    nullification, but are still decoded and encoded, so that malformed
+    lines are rejected and the output does not depend on the filter.
+
+    Args:
+        lines (Iterable[str]): The raw JSONL lines to process.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                      representing the fields to nullify.
+        pattern (Optional[re.Pattern]): A pattern from
+            `compile_device_pattern`. Compiled on the fly if not given.
+        plan (Optional[NullifyPlan]): A plan from `compile_nullify_plan`.
+            Compiled on the fly if not given.
+        codec (str): The name of the JSON codec to use.
+        passthrough (bool): Whether to pre-filter lines that mangling
+                            cannot change.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        device_paths (Optional[DevicePathIndex]): If given, device names
+            are only replaced at the indexed paths of entries whose event
+            type is in the index. Other entries, and entries that name a
+            device outside the indexed paths, are replaced in full.
+        alias_store (Optional[HashMappingStore]): If given, the devices of
+            start markers and device values in the lines are aliased by the
+            store on first sight.
+
+    Yields:
+        str: The next processed line, terminated by a newline.
+    """
+    started = time.perf_counter()
+    if pattern is None:
+        pattern = compile_device_pattern(device_mappings)
+    if plan is None:
+        plan = compile_nullify_plan(pointers)
+    json_codec = get_json_codec(codec)
+    if stats is not None:
+        stats.timings["compile"] += time.perf_counter() - started
+        yield from _mangle_lines_timed(
+            lines,
+            device_mappings,
+            pointers,
+            pattern,
+            plan,
+            json_codec,
+            passthrough,
+            stats,
+            device_paths,
+            alias_store,
+        )
+        return
+    for line in lines:
+        if alias_store is not None:
+            device_mappings, pattern = _alias_stream_devices(
+                line, alias_store, device_mappings, pattern
+            )
+        if passthrough and not line_may_change(line, pattern, plan):
+            yield json_codec.dumps(json_codec.loads(line)) + "\n"
+            continue
+        entry = _decode_replaced(
+            line, json_codec, device_mappings, pattern, device_paths
+        )
+        if pointers:
+            entry = nullify_entry(entry, pointers, plan)
+        yield json_codec.dumps(entry) + "\n"
+
+
+def _count_device_matches(text: str, pattern: Optional[re.Pattern]) -> int:
+    """Count the whole device names in a string."""
+    if pattern is None:
+        return 0
+    return sum(is_device_match(match) for match in pattern.finditer(text))
+
+
+def _decode_replaced(
+    line: str,
+    json_codec: JsonCodec,
+    device_mappings: dict[str, str],
+    pattern: Optional[re.Pattern],
+    device_paths: Optional[DevicePathIndex] = None,
+    counts: Optional[Counter] = None,
+) -> Any:
+    """Decode a raw line with its device names replaced.
+
+    With a path index, the line is decoded first and only the indexed
+    paths are rewritten. Lines of unindexed event types, and lines naming
+    devices outside the indexed paths, fall back to replacing the raw text.
+    """
+    if device_paths is not None:
+        entry = json_codec.loads(line)
+        replaced: Counter = Counter()
+        if replace_device_paths(
+            entry, device_paths, device_mappings, pattern, replaced
+        ) and sum(replaced.values()) >= _count_device_matches(line, pattern):
+            if counts is not None:
+                counts.update(replaced)
+            return entry
+    return json_codec.loads(
+        replace_device_names(line, device_mappings, pattern, counts)
+    )
+
+
+def _mangle_lines_timed(
+    lines: Iterable[str],
+    device_mappings: dict[str, str],
+    pointers: list[JsonPathStr],
+    pattern: Optional[re.Pattern],
+    plan: NullifyPlan,
+    json_codec: JsonCodec,
+    passthrough: bool,
+    stats: MangleStats,
+    device_paths: Optional[DevicePathIndex] = None,
+    alias_store: Optional[HashMappingStore] = None,
+) -> Iterator[str]:
+    """Mangle lines as `mangle_lines` does, timing each stage.
+
+    Kept apart from `mangle_lines` so that runs without stats do not pay
+    for the clock calls.
+    """
+    clock = time.perf_counter
+    counts, timings = stats.counts, stats.timings
+    lines = iter(lines)
+    while True:
+        t_read = clock()
+        line = next(lines, None)
+        t_filter = clock()
+        timings["read"] += t_filter - t_read
+        if line is None:
+            return
+        counts["lines"] += 1
+        if alias_store is not None:
+            device_mappings, pattern = _alias_stream_devices(
+                line, alias_store, device_mappings, pattern
+            )
+            t_aliased = clock()
+            timings["mapping"] += t_aliased - t_filter
+            t_filter = t_aliased
+        may_change = not passthrough or line_may_change(line, pattern, plan)
+        t_replace = clock()
+        timings["filter"] += t_replace - t_filter
+        if may_change and device_paths is not None:
+            # Decoding and replacing are interleaved, so time them together
+            entry = _decode_replaced(
+                line,
+                json_codec,
+                device_mappings,
+                pattern,
+                device_paths,
+                stats.replacements,
+            )
+            t_nullify = clock()
+            timings["replace"] += t_nullify - t_replace
+        else:
+            if may_change:
+                line = replace_device_names(
+                    line, device_mappings, pattern, stats.replacements
+                )
+            t_decode = clock()
+            timings["replace"] += t_decode - t_replace
+            entry = json_codec.loads(line)
+            t_nullify = clock()
+            timings["decode"] += t_nullify - t_decode
+        counts["decoded_lines"] += 1
+        if may_change and pointers:
+            entry = nullify_entry(entry, pointers, plan, stats.nullified)
+        t_encode = clock()
+        timings["nullify"] += t_encode - t_nullify
+        output = json_codec.dumps(entry) + "\n"
+        timings["encode"] += clock() - t_encode
+        yield output
+
+
+def write_lines(
+    f_out: IO, lines: Iterable[str], stats: Optional[MangleStats] = None
+) -> None:
+    """Write lines to a file, timing the writes if stats are collected.
+
+    Args:
+        f_out (IO): The file to write to.
+        lines (Iterable[str]): The lines to write.
+        stats (Optional[MangleStats]): Collects the write time if given.
+    """
+    if stats is None:
+        f_out.writelines(lines)
+        return
+    clock = time.perf_counter
+    for line in lines:
+        start = clock()
+        f_out.write(line)
+        stats.timings["write"] += clock() - start
+        if stats.first_output_at is None:
+            stats.record_output()
+
+
+def split_line_ranges(file: str, n_ranges: int) -> list[tuple[int, int]]:
+    """Split a file into byte ranges that start and end on line boundaries.
+
+    Args:
+        file (str): The path to the file to split.
+        n_ranges (int): The number of ranges to aim for. Fewer are returned
+                        if the file has fewer lines.
+
+    Returns:
+        list[tuple[int, int]]: A list of (start, end) byte offsets covering
+                               the whole file in order.
+    """
+    size = os.path.getsize(file)
+    boundaries = [0]
+    with open(file, "rb") as f:
+        for i in range(1, n_ranges):
+            target = size * i // n_ranges
+            if target <= boundaries[-1]:
+                continue
+            # Move to the start of the line following the target offset
+            f.seek(target)
+            f.readline()
+            if (offset := f.tell()) >= size:
+                break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def iter_byte_range(file: str, start: int, end: int) -> Iterator[str]:
+    """Lazily read the lines of a file between two byte offsets.
+
+    Args:
+        file (str): The path to the file.
+        start (int): The offset of the first line to read.
+        end (int): The offset at which to stop reading.
+
+    Yields:
+        str: The next decoded line.
+    """
+    with open(file, "rb") as f:
+        f.seek(start)
+        offset = start
+        while offset < end and (line := f.readline()):
+            offset += len(line)
+            yield line.decode("utf-8")
+
+
+# Compiled state for each process in a parallel mangling pool
+_worker_state: dict = {}
+
+
+def _compile_worker_state(
+    device_mappings: dict[str, str],
+    pointers: list[JsonPathStr],
+    codec: str,
+    compresslevel: Optional[int],
+    collect_stats: bool = False,
+    device_paths: Optional[DevicePathIndex] = None,
+    alias_store: Optional[HashMappingStore] = None,
+) -> dict:
+    """Compile the device pattern and nullify plan for mangling files."""
+    return {
+        "alias_store": alias_store,
+        "device_paths": device_paths,
+        "collect_stats": collect_stats,
+        "device_mappings": device_mappings,
+        "pointers": pointers,
+        "codec": codec,
+        "compresslevel": compresslevel,
+        "pattern": compile_device_pattern(device_mappings),
+        "plan": compile_nullify_plan(pointers),
+    }
+
+
+def _init_mangle_worker(*args) -> None:
+    """Compile the device pattern and nullify plan once per pool worker."""
+    _worker_state.update(_compile_worker_state(*args))
+
+
+def _mangle_whole_file(
+    input_file: str, output_file: str, state: Optional[dict] = None
+) -> Optional[MangleStats]:
+    """Mangle a whole file with compiled state, by default a pool worker's.
+
+    Returns:
+        Optional[MangleStats]: The stats for the file, if the state collects
+                               them.
+    """
+    if state is None:
+        state = _worker_state
+    stats = MangleStats() if state["collect_stats"] else None
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open_jsonl(input_file, "r") as f_in, open_jsonl(
+        output_file, "w", state["compresslevel"]
+    ) as f_out:
+        write_lines(
+            f_out,
+            mangle_lines(
+                f_in,
+                state["device_mappings"],
+                state["pointers"],
+                state["pattern"],
+                state["plan"],
+                state["codec"],
+                stats=stats,
+                device_paths=state["device_paths"],
+                alias_store=state["alias_store"],
+            ),
+            stats,
+        )
+    if stats is not None:
+        stats.counts["files"] += 1
+        stats.counts["bytes_read"] += os.path.getsize(input_file)
+        stats.counts["bytes_written"] += os.path.getsize(output_file)
+    return stats
+
+
+def _mangle_byte_range(
+    input_file: str, start: int, end: int, part_file: str
+) -> tuple[str, Optional[MangleStats]]:
+    """Mangle one byte range of the input into a part file in a pool worker.
+
+    Returns:
+        tuple[str, Optional[MangleStats]]: The path of the written part file
+            and the stats for the range, if the pool collects them.
+    """
+    stats = MangleStats() if _worker_state["collect_stats"] else None
+    lines = iter_byte_range(input_file, start, end)
+    with open_jsonl(part_file, "w", _worker_state["compresslevel"]) as f:
+        write_lines(
+            f,
+            mangle_lines(
+                lines,
+                _worker_state["device_mappings"],
+                _worker_state["pointers"],
+                _worker_state["pattern"],
+                _worker_state["plan"],
+                _worker_state["codec"],
+                stats=stats,
+                device_paths=_worker_state["device_paths"],
+                alias_store=_worker_state["alias_store"],
+            ),
+            stats,
+        )
+    return part_file, stats
+
+
+def mangle_json_file_parallel(
+    input_file: str,
+    output_file: str,
+    pointers: list[JsonPathStr],
+    device_mappings: dict[str, str],
+    workers: int,
+    codec: str = "json",
+    compresslevel: Optional[int] = None,
+    stats: Optional[MangleStats] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+    alias_store: Optional[HashMappingStore] = None,
+) -> None:
+    """Mangle a JSONL file in line-aligned chunks across a process pool.
+
+    Each chunk is written to a temporary part file next to the output, and
+    the parts are concatenated in their original order, so the result is
+    identical to the serial path. For compressed output, each part is
+    compressed by its worker and the output is a multi-member archive.
+    The input must not be compressed.
+
+    Args:
+        input_file (str): The path to the input JSONL file.
+        output_file (str): The path to the output JSONL file.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                    representing the fields to nullify.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+        workers (int): The number of worker processes.
+        codec (str): The name of the JSON codec to use.
+        compresslevel (Optional[int]): The compression level for compressed
+                                       output.
+        stats (Optional[MangleStats]): Collects the workers' counts and
+                                       timings if given.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+        alias_store (Optional[HashMappingStore]): A store to alias the
+            devices found in the lines with, as in `mangle_lines`.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    size = os.path.getsize(input_file)
+    n_ranges = max(workers * 4, -(-size // PARALLEL_CHUNK_SIZE))
+    ranges = split_line_ranges(input_file, n_ranges)
+    part_dir = os.path.dirname(os.path.abspath(output_file))
+    # Parts are compressed in the same format as the output
+    suffix = ".jsonl" + os.path.splitext(str(output_file))[1]
+    with tempfile.TemporaryDirectory(dir=part_dir) as tmp_dir:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_mangle_worker,
+            initargs=(
+                device_mappings,
+                pointers,
+                codec,
+                compresslevel,
+                stats is not None,
+                device_paths,
+                alias_store,
+            ),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _mangle_byte_range,
+                    str(input_file),
+                    start,
+                    end,
+                    os.path.join(tmp_dir, f"part-{i:06}{suffix}"),
+                )
+                for i, (start, end) in enumerate(ranges)
+            ]
+            # Stitch the parts together in order as they complete
+            with open(output_file, "wb") as f_out:
+                for future in futures:
+                    part_file, part_stats = future.result()
+                    if part_stats is not None:
+                        stats.merge(part_stats)
+                    with open(part_file, "rb") as f_part:
+                        shutil.copyfileobj(f_part, f_out)
+                    if stats is not None and f_out.tell():
+                        stats.record_output()
+                    os.remove(part_file)
+
+
+def _load_device_mappings(
+    input_file: str,
+    mapping_store: Optional[DeviceMappingStore] = None,
+    stats: Optional[MangleStats] = None,
+) -> dict[str, str]:
+    """Build the device mapping of a file from all of its start markers."""
+    if _stream_alias_store(mapping_store) is not None:
+        # Hashed aliases are assigned as the lines name devices instead
+        return mapping_store.refresh()
+    started = time.perf_counter()
+    # Get the devide name mapping from Resync start markers
+    markers = read_start_markers(input_file)
+    mapped = time.perf_counter()
+    if mapping_store is not None:
+        device_mappings = mapping_store.add_markers(markers)
+    else:
+        device_mappings = get_device_mappings(markers)
+    if stats is not None:
+        stats.timings["markers"] += mapped - started
+        stats.timings["mapping"] += time.perf_counter() - mapped
+        stats.counts["start_markers"] += len(markers)
+    return device_mappings
+
+
+def _load_appended_device_mappings(
+    input_file: str,
+    offset: int,
+    device_mappings: dict[str, str],
+    mapping_store: Optional[DeviceMappingStore] = None,
+    stats: Optional[MangleStats] = None,
+    partial_line: bool = False,
+) -> tuple[int, int, dict[str, str]]:
+    """Extend a device mapping with the start markers appended to a file.
+
+    Returns:
+        tuple[int, int, dict[str, str]]: The offsets of the first and past
+            the last line to process, and the extended device mapping.
+    """
+    started = time.perf_counter()
+    # Find the end of the last complete line and any new start markers
+    markers = []
+    with open(input_file, "rb") as f:
+        if offset:
+            f.seek(offset - 1)
+            previous, following = f.read(1), f.read(1)
+            # Only a partial line that was processed already ends without a
+            # newline, which may have been appended since
+            if previous != b"\n" and following == b"\n":
+                offset += 1
+            elif previous != b"\n" and following:
+                raise ValueError(
+                    f"Offset {offset} of {input_file} is not at a line "
+                    "boundary"
+                )
+        f.seek(offset)
+        end = offset
+        while (line := f.readline()).endswith(b"\n"):
+            end += len(line)
+            if b"ResyncMarker" in line:
+                decoded = line.decode("utf-8")
+                if is_start_marker_line(decoded):
+                    markers.append(json.loads(decoded))
+    if partial_line and line.strip():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # The line is still being written
+            pass
+        else:
+            end += len(line)
+            if is_start_marker_line(line.decode("utf-8")):
+                markers.append(entry)
+    if end == offset:
+        return offset, end, device_mappings
+    mapped = time.perf_counter()
+    if mapping_store is not None:
+        device_mappings = mapping_store.add_markers(markers)
+    else:
+        update_device_mappings(device_mappings, markers)
+    if stats is not None:
+        stats.timings["markers"] += mapped - started
+        stats.timings["mapping"] += time.perf_counter() - mapped
+        stats.counts["start_markers"] += len(markers)
+    return offset, end, device_mappings
+
+
+def _result_cache_key(
+    input_file: str,
+    start: int,
+    end: Optional[int],
+    output_file: str,
+    pointers: list[JsonPathStr],
+    device_mappings: dict[str, str],
+    codec: str,
+    compresslevel: Optional[int],
+    device_paths: Optional[DevicePathIndex],
+    stats: Optional[MangleStats] = None,
+) -> str:
+    """Build the result cache key of mangling a range of an input file."""
+    started = time.perf_counter()
+    key = ResultCache.key(
+        hash_file(input_file, start, end),
+        pointers,
+        # The mapping version: outputs are only reused for the same aliases
+        hash_string(json.dumps(sorted(device_mappings.items()))),
+        get_json_codec(codec).name,
+        detect_compression(output_file, "w"),
+        compresslevel,
+        None if device_paths is None else device_paths.paths,
+    )
+    if stats is not None:
+        stats.timings["hash"] += time.perf_counter() - started
+    return key
+
+
+def _get_cached_output(
+    cache: ResultCache,
+    key: str,
+    output_file: str,
+    stats: Optional[MangleStats] = None,
+) -> bool:
+    """Copy a cached output to a file, counting the hit or miss."""
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    hit = cache.get(key, output_file)
+    if stats is not None:
+        stats.timings["cache"] += time.perf_counter() - started
+        stats.counts["cache_hits" if hit else "cache_misses"] += 1
+        if hit:
+            stats.counts["bytes_written"] += os.path.getsize(output_file)
+            stats.record_output()
+    return hit
+
+
+def _file_version(file: str) -> tuple[int, int, int]:
+    """Get the inode, size and modification time of a file."""
+    stat = os.stat(file)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _put_cached_output(
+    cache: ResultCache,
+    key: str,
+    output_file: str,
+    stats: Optional[MangleStats] = None,
+) -> None:
+    """Store an output in the result cache, timing the copy."""
+    started = time.perf_counter()
+    cache.put(key, output_file)
+    if stats is not None:
+        stats.timings["cache"] += time.perf_counter() - started
+
+
+def _output_size(output_file: str, mode: str) -> int:
+    """Get the size an output file has before it is opened in a mode."""
+    if mode == "a" and os.path.exists(output_file):
+        return os.path.getsize(output_file)
+    return 0
+
+
+def mangle_json_file(
+    input_file: str,
+    output_file: str,
+    pointers: list[JsonPathStr],
+    workers: int = 1,
+    mapping_store: Optional[DeviceMappingStore] = None,
+    codec: str = "json",
+    compresslevel: Optional[int] = None,
+    stats: Optional[MangleStats] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+    cache: Optional[ResultCache] = None,
+) -> None:
+    """Mangle device names and nullify specified fields in a JSONL file.
+
+    Writes the modified data to a new JSONL file. Entries are streamed from
+    the input to the output one line at a time, so memory use does not grow
+    with the size of the file. Input compressed with gzip, bz2 or xz is
+    decompressed on the fly, and the output is compressed if its name ends
+    in .gz, .bz2 or .xz.
+
+    Args:
+        input_file (str): The path to the input JSONL file.
+        output_file (str): The path to the output JSONL file.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                    representing the fields to nullify.
+        workers (int): The number of worker processes. Values above 1
+                       process the file in parallel chunks, unless the
+                       input is compressed.
+        mapping_store (Optional[DeviceMappingStore]): A persistent store to
+            take aliases from and add new devices to. If not given, devices
+            are numbered from DEVICE-001 for this file alone.
+        codec (str): The name of the JSON codec to use.
+        compresslevel (Optional[int]): The compression level for compressed
+                                       output.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        device_paths (Optional[DevicePathIndex]): If given, device names
+            are only replaced at the indexed paths of each event type.
+        cache (Optional[ResultCache]): A cache of outputs to reuse when the
+            input, pointers, device mapping and output settings match, and
+            to add the output to otherwise.
+    """
+    started = time.perf_counter()
+    device_mappings = _load_device_mappings(input_file, mapping_store, stats)
+    if cache is not None:
+        input_version = _file_version(input_file)
+        cache_key = _result_cache_key(
+            input_file,
+            0,
+            None,
+            output_file,
+            pointers,
+            device_mappings,
+            codec,
+            compresslevel,
+            device_paths,
+            stats,
+        )
+        if _get_cached_output(cache, cache_key, output_file, stats):
+            if stats is not None:
+                stats.timings["total"] += time.perf_counter() - started
+            return
+
+    if workers > 1 and not detect_compression(input_file):
+        mangle_json_file_parallel(
+            input_file,
+            output_file,
+            pointers,
+            device_mappings,
+            workers,
+            codec,
+            compresslevel,
+            stats,
+            device_paths,
+            _stream_alias_store(mapping_store),
+        )
+    else:
+        # Stream mangled lines from the input file to the output file
+        opened = time.perf_counter()
+        with open_jsonl(input_file, "r") as f_in, open_jsonl(
+            output_file, "w", compresslevel
+        ) as f_out:
+            if stats is not None:
+                stats.timings["open"] += time.perf_counter() - opened
+            write_lines(
+                f_out,
+                mangle_lines(
+                    f_in,
+                    device_mappings,
+                    pointers,
+                    codec=codec,
+                    stats=stats,
+                    device_paths=device_paths,
+                    alias_store=_stream_alias_store(mapping_store),
+                ),
+                stats,
+            )
+
+    # The output is only cached if the input did not change meanwhile
+    if cache is not None and _file_version(input_file) == input_version:
+        _put_cached_output(cache, cache_key, output_file, stats)
+
+    if stats is not None:
+        stats.counts["bytes_read"] += os.path.getsize(input_file)
+        stats.counts["bytes_written"] += os.path.getsize(output_file)
+        stats.timings["total"] += time.perf_counter() - started
+
+
+def mangle_json_file_tail(
+    input_file: str,
+    output_file: str,
+    pointers: list[JsonPathStr],
+    offset: int = 0,
+    device_mappings: Optional[dict[str, str]] = None,
+    mapping_store: Optional[DeviceMappingStore] = None,
+    codec: str = "json",
+    compresslevel: Optional[int] = None,
+    stats: Optional[MangleStats] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+    cache: Optional[ResultCache] = None,
+    partial_line: bool = False,
+) -> int:
+    """Mangle the lines appended to a JSONL file since a byte offset.
+
+    Only complete lines are processed; a trailing partial line is left for
+    the next call, unless `partial_line` is set and it already holds a
+    whole JSON value, as the last line of a file written without a final
+    newline does. The newline that may still follow such a line is skipped
+    by the next call. The output is appended to, unless starting from
+    offset 0 in which case it is overwritten. The input must not be
+    compressed; a compressed output gains one archive member per call.
+
+    Args:
+        input_file (str): The path to the input JSONL file.
+        output_file (str): The path to the output JSONL file.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                    representing the fields to nullify.
+        offset (int): The byte offset up to which the input has already
+                      been processed.
+        device_mappings (Optional[dict[str, str]]): The mapping built so far.
+            Extended in place with devices from newly appended start markers.
+        mapping_store (Optional[DeviceMappingStore]): A persistent store to
+            use instead of `device_mappings`.
+        codec (str): The name of the JSON codec to use.
+        compresslevel (Optional[int]): The compression level for compressed
+                                       output.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+        cache (Optional[ResultCache]): A cache of outputs to reuse when
+            starting from offset 0, as in `mangle_json_file`.
+        partial_line (bool): Whether to also process a trailing line
+            without a newline if it holds a whole JSON value, such as when
+            the file has been quiet for a while.
+
+    Returns:
+        int: The byte offset up to which the input has now been processed.
+
+    Raises:
+        ValueError: If the offset is not at a line boundary, as when the
+                    file was rewritten in place. `tail_fingerprint` tells
+                    such files apart before resuming.
+    """
+    if device_mappings is None:
+        device_mappings = {}
+    started = time.perf_counter()
+    offset, end, device_mappings = _load_appended_device_mappings(
+        input_file,
+        offset,
+        device_mappings,
+        mapping_store,
+        stats,
+        partial_line,
+    )
+    if end == offset:
+        return offset
+
+    cache_key = None
+    if cache is not None and offset == 0:
+        cache_key = _result_cache_key(
+            input_file,
+            0,
+            end,
+            output_file,
+            pointers,
+            device_mappings,
+            codec,
+            compresslevel,
+            device_paths,
+            stats,
+        )
+        if _get_cached_output(cache, cache_key, output_file, stats):
+            if stats is not None:
+                stats.timings["total"] += time.perf_counter() - started
+            return end
+
+    lines = iter_byte_range(input_file, offset, end)
+    output_mode = "w" if offset == 0 else "a"
+    written = _output_size(output_file, output_mode)
+    opened = time.perf_counter()
+    with open_jsonl(output_file, output_mode, compresslevel) as f_out:
+        if stats is not None:
+            stats.timings["open"] += time.perf_counter() - opened
+        write_lines(
+            f_out,
+            mangle_lines(
+                lines,
+                device_mappings,
+                pointers,
+                codec=codec,
+                stats=stats,
+                device_paths=device_paths,
+                alias_store=_stream_alias_store(mapping_store),
+            ),
+            stats,
+        )
+    if cache_key is not None:
+        _put_cached_output(cache, cache_key, output_file, stats)
+    if stats is not None:
+        stats.counts["bytes_read"] += end - offset
+        stats.counts["bytes_written"] += os.path.getsize(output_file) - written
+        stats.timings["total"] += time.perf_counter() - started
+    return end
+
+
+def _read_batch(
+    lines: Iterator[str], size: int, stats: MangleStats
+) -> list[str]:
+    """Read the next batch of lines in a pipeline's reader stage."""
+    started = time.perf_counter()
+    batch = list(islice(lines, size))
+    stats.timings["read"] += time.perf_counter() - started
+    return batch
+
+
+def _mangle_batch(
+    batch: list[str],
+    device_mappings: dict[str, str],
+    pointers: list[JsonPathStr],
+    pattern: Optional[re.Pattern],
+    plan: NullifyPlan,
+    codec: str,
+    stats: Optional[MangleStats],
+    device_paths: Optional[DevicePathIndex] = None,
+    alias_store: Optional[HashMappingStore] = None,
+) -> list[str]:
+    """Mangle a batch of lines in a pipeline's transform stage."""
+    return list(
+        mangle_lines(
+            batch,
+            device_mappings,
+            pointers,
+            pattern,
+            plan,
+            codec,
+            stats=stats,
+            device_paths=device_paths,
+            alias_store=alias_store,
+        )
+    )
+
+
+def _write_batch(f_out: IO, batch: list[str], stats: MangleStats) -> None:
+    """Write a batch of lines in a pipeline's writer stage."""
+    started = time.perf_counter()
+    f_out.writelines(batch)
+    stats.timings["write"] += time.perf_counter() - started
+    if batch:
+        stats.record_output()
+
+
+async def mangle_lines_pipeline(
+    lines: Iterable[str],
+    f_out: IO,
+    device_mappings: dict[str, str],
+    pointers: list[JsonPathStr],
+    codec: str = "json",
+    executor: Optional["Executor"] = None,
+    batch_size: int = PIPELINE_BATCH_LINES,
+    queue_size: int = PIPELINE_QUEUE_SIZE,
+    stats: Optional[MangleStats] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+    alias_store: Optional[HashMappingStore] = None,
+) -> None:
+    """Mangle lines into a file with overlapped reading and writing.
+
+    A reader, a transform and a writer stage run concurrently, passing
+    batches of lines through bounded queues, so the disk is read and
+    written while earlier batches are being mangled and a slow stage holds
+    back the others instead of buffering without limit. Blocking reads and
+    writes run in the event loop's default executor. Batches are mangled
+    one at a time in `executor`, so the output keeps the input's order.
+
+    Args:
+        lines (Iterable[str]): The raw JSONL lines to process.
+        f_out (IO): The file to write the processed lines to.
+        device_mappings (dict[str, str]): A dictionary mapping device names
+                                          to their mangled names.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                      representing the fields to nullify.
+        codec (str): The name of the JSON codec to use.
+        executor (Optional[Executor]): The thread pool to mangle batches in.
+            Defaults to the event loop's default executor.
+        batch_size (int): The number of lines per batch.
+        queue_size (int): The number of batches each queue holds.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+        alias_store (Optional[HashMappingStore]): A store to alias the
+            devices found in the lines with, as in `mangle_lines`.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    pattern, plan = await loop.run_in_executor(
+        executor,
+        lambda: (
+            compile_device_pattern(device_mappings),
+            compile_nullify_plan(pointers),
+        ),
+    )
+    lines = iter(lines)
+    read_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    write_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    # Stages run in different threads, so each keeps its own stats
+    read_stats, write_stats = MangleStats(), MangleStats()
+    transform_stats = None if stats is None else MangleStats()
+
+    async def read():
+        while batch := await loop.run_in_executor(
+            None, _read_batch, lines, batch_size, read_stats
+        ):
+            await read_queue.put(batch)
+        await read_queue.put(None)
+
+    async def transform():
+        nonlocal device_mappings, pattern
+        while (batch := await read_queue.get()) is not None:
+            # Pick up the devices that earlier batches found in their lines
+            if alias_store is not None and len(alias_store.mappings) != len(
+                device_mappings
+            ):
+                device_mappings = alias_store.refresh()
+                pattern = compile_device_pattern(device_mappings)
+            output = await loop.run_in_executor(
+                executor,
+                _mangle_batch,
+                batch,
+                device_mappings,
+                pointers,
+                pattern,
+                plan,
+                codec,
+                transform_stats,
+                device_paths,
+                alias_store,
+            )
+            await write_queue.put(output)
+        await write_queue.put(None)
+
+    async def write():
+        while (batch := await write_queue.get()) is not None:
+            await loop.run_in_executor(
+                None, _write_batch, f_out, batch, write_stats
+            )
+
+    tasks = [
+        asyncio.ensure_future(stage()) for stage in (read, transform, write)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other stages, which would block on their queues
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    if stats is not None:
+        stats.merge(read_stats).merge(transform_stats).merge(write_stats)
+
+
+async def mangle_json_file_async(
+    input_file: str,
+    output_file: str,
+    pointers: list[JsonPathStr],
+    mapping_store: Optional[DeviceMappingStore] = None,
+    codec: str = "json",
+    compresslevel: Optional[int] = None,
+    stats: Optional[MangleStats] = None,
+    executor: Optional["Executor"] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+    cache: Optional[ResultCache] = None,
+) -> None:
+    """Mangle a JSONL file as `mangle_json_file` does, on an asyncio
+    pipeline.
+
+    Several files can be mangled concurrently in one event loop, and the
+    output is the same as that of the serial path.
+
+    Args:
+        input_file (str): The path to the input JSONL file.
+        output_file (str): The path to the output JSONL file.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                    representing the fields to nullify.
+        mapping_store (Optional[DeviceMappingStore]): A persistent store to
+            take aliases from and add new devices to.
+        codec (str): The name of the JSON codec to use.
+        compresslevel (Optional[int]): The compression level for compressed
+                                       output.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        executor (Optional[Executor]): The thread pool to mangle batches in.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+        cache (Optional[ResultCache]): A cache of outputs, as in
+                                       `mangle_json_file`.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    device_mappings = await loop.run_in_executor(
+        None, _load_device_mappings, input_file, mapping_store, stats
+    )
+    if cache is not None:
+        input_version = _file_version(input_file)
+        cache_key = await loop.run_in_executor(
+            None,
+            _result_cache_key,
+            input_file,
+            0,
+            None,
+            output_file,
+            pointers,
+            device_mappings,
+            codec,
+            compresslevel,
+            device_paths,
+            stats,
+        )
+        if await loop.run_in_executor(
+            None, _get_cached_output, cache, cache_key, output_file, stats
+        ):
+            if stats is not None:
+                stats.timings["total"] += time.perf_counter() - started
+            return
+    opened = time.perf_counter()
+    f_in = await loop.run_in_executor(None, open_jsonl, input_file, "r")
+    with f_in:
+        f_out = await loop.run_in_executor(
+            None, open_jsonl, output_file, "w", compresslevel
+        )
+        with f_out:
+            if stats is not None:
+                stats.timings["open"] += time.perf_counter() - opened
+            await mangle_lines_pipeline(
+                f_in,
+                f_out,
+                device_mappings,
+                pointers,
+                codec,
+                executor,
+                stats=stats,
+                device_paths=device_paths,
+                alias_store=_stream_alias_store(mapping_store),
+            )
+    # The output is only cached if the input did not change meanwhile
+    if cache is not None and _file_version(input_file) == input_version:
+        await loop.run_in_executor(
+            None, _put_cached_output, cache, cache_key, output_file, stats
+        )
+    if stats is not None:
+        stats.counts["bytes_read"] += os.path.getsize(input_file)
+        stats.counts["bytes_written"] += os.path.getsize(output_file)
+        stats.timings["total"] += time.perf_counter() - started
+
+
+async def mangle_json_file_tail_async(
+    input_file: str,
+    output_file: str,
+    pointers: list[JsonPathStr],
+    offset: int = 0,
+    device_mappings: Optional[dict[str, str]] = None,
+    mapping_store: Optional[DeviceMappingStore] = None,
+    codec: str = "json",
+    compresslevel: Optional[int] = None,
+    stats: Optional[MangleStats] = None,
+    executor: Optional["Executor"] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+    cache: Optional[ResultCache] = None,
+    partial_line: bool = False,
+) -> int:
+    """Mangle the lines appended to a JSONL file as `mangle_json_file_tail`
+    does, on an asyncio pipeline.
+
+    Args:
+        input_file (str): The path to the input JSONL file.
+        output_file (str): The path to the output JSONL file.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                    representing the fields to nullify.
+        offset (int): The byte offset up to which the input has already
+                      been processed.
+        device_mappings (Optional[dict[str, str]]): The mapping built so far.
+            Extended in place with devices from newly appended start markers.
+        mapping_store (Optional[DeviceMappingStore]): A persistent store to
+            use instead of `device_mappings`.
+        codec (str): The name of the JSON codec to use.
+        compresslevel (Optional[int]): The compression level for compressed
+                                       output.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        executor (Optional[Executor]): The thread pool to mangle batches in.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+        cache (Optional[ResultCache]): A cache of outputs to reuse when
+            starting from offset 0, as in `mangle_json_file`.
+        partial_line (bool): Whether to also process a trailing line
+            without a newline if it holds a whole JSON value.
+
+    Returns:
+        int: The byte offset up to which the input has now been processed.
+
+    Raises:
+        ValueError: If the offset is not at a line boundary.
+    """
+    import asyncio
+
+    if device_mappings is None:
+        device_mappings = {}
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    offset, end, device_mappings = await loop.run_in_executor(
+        None,
+        _load_appended_device_mappings,
+        input_file,
+        offset,
+        device_mappings,
+        mapping_store,
+        stats,
+        partial_line,
+    )
+    if end == offset:
+        return offset
+    cache_key = None
+    if cache is not None and offset == 0:
+        cache_key = await loop.run_in_executor(
+            None,
+            _result_cache_key,
+            input_file,
+            0,
+            end,
+            output_file,
+            pointers,
+            device_mappings,
+            codec,
+            compresslevel,
+            device_paths,
+            stats,
+        )
+        if await loop.run_in_executor(
+            None, _get_cached_output, cache, cache_key, output_file, stats
+        ):
+            if stats is not None:
+                stats.timings["total"] += time.perf_counter() - started
+            return end
+
+    lines = iter_byte_range(input_file, offset, end)
+    output_mode = "w" if offset == 0 else "a"
+    written = _output_size(output_file, output_mode)
+    opened = time.perf_counter()
+    f_out = await loop.run_in_executor(
+        None, open_jsonl, output_file, output_mode, compresslevel
+    )
+    with f_out:
+        if stats is not None:
+            stats.timings["open"] += time.perf_counter() - opened
+        await mangle_lines_pipeline(
+            lines,
+            f_out,
+            device_mappings,
+            pointers,
+            codec,
+            executor,
+            stats=stats,
+            device_paths=device_paths,
+            alias_store=_stream_alias_store(mapping_store),
+        )
+    if cache_key is not None:
+        await loop.run_in_executor(
+            None, _put_cached_output, cache, cache_key, output_file, stats
+        )
+    if stats is not None:
+        stats.counts["bytes_read"] += end - offset
+        stats.counts["bytes_written"] += os.path.getsize(output_file) - written
+        stats.timings["total"] += time.perf_counter() - started
+    return end
+
+
+def find_input_files(
+    path: str, exclude: Optional[str] = None
+) -> tuple[str, list[str]]:
+    """Find the files to mangle in a directory or matching a glob.
+
+    Directories are searched recursively for JSON and JSONL files, which
+    may be compressed. A glob may match any file.
+
+    Args:
+        path (str): A directory, or a glob such as "data/**/*.jsonl".
+        exclude (Optional[str]): A directory whose files are never returned,
+                                 such as the output directory.
+
+    Returns:
+        tuple[str, list[str]]: The directory the files are relative to and
+                               the sorted paths of the files.
+    """
+    if os.path.isdir(path):
+        base_dir = path
+        files = [
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in names
+            if is_jsonl_file(name)
+        ]
+    else:
+        import glob
+        from pathlib import Path
+
+        base_parts = []
+        for part in Path(path).parts:
+            if any(char in part for char in "*?["):
+                break
+            base_parts.append(part)
+        base_dir = os.path.join(*base_parts) if base_parts else "."
+        files = [
+            file
+            for file in glob.glob(path, recursive=True)
+            if os.path.isfile(file)
+        ]
+    if exclude is not None:
+        exclude = os.path.abspath(exclude)
+        files = [
+            file
+            for file in files
+            if os.path.commonpath([os.path.abspath(file), exclude]) != exclude
+        ]
+    return base_dir, sorted(files)
+
+
+def _read_batch_manifest(output_dir: str) -> dict:
+    """Read the manifest of a batch output directory, if it has one."""
+    try:
+        with open(os.path.join(output_dir, BATCH_MANIFEST), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_batch_manifest(output_dir: str, manifest: dict) -> None:
+    """Replace the manifest of a batch output directory atomically."""
+    manifest_file = os.path.join(output_dir, BATCH_MANIFEST)
+    with open(f"{manifest_file}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
+
+
+def _batch_mapping_version(
+    previous: dict, device_mappings: dict[str, str]
+) -> dict:
+    """Version the device mapping of a batch for its manifest.
+
+    The version of the previous run is kept unless the alias of one of its
+    devices has changed, so adding devices does not make outputs stale.
+    Devices are recorded by a hash of their name and alias, so the manifest
+    does not name them.
+
+    Args:
+        previous (dict): The mapping version of the previous run, if any.
+        device_mappings (dict[str, str]): The device mapping of this run.
+
+    Returns:
+        dict: The version number and the hashes of the aliases.
+    """
+    aliases = sorted(
+        hash_string(json.dumps([name, alias]))
+        for name, alias in device_mappings.items()
+    )
+    version = previous.get("version", 0)
+    if not set(previous.get("aliases", [])) <= set(aliases):
+        version += 1
+    return {"version": version, "aliases": aliases}
+
+
+def mangle_json_files(
+    input_files: list[str],
+    input_dir: str,
+    output_dir: str,
+    pointers: list[JsonPathStr],
+    workers: int = 1,
+    mapping_store: Optional[DeviceMappingStore] = None,
+    codec: str = "json",
+    compresslevel: Optional[int] = None,
+    stats: Optional[MangleStats] = None,
+    force: bool = False,
+    device_paths: Optional[DevicePathIndex] = None,
+) -> tuple[int, int]:
+    """Mangle a batch of JSONL files with one device mapping.
+
+    The mapping is built from the start markers of every file, so a device
+    has the same alias in all outputs. Each output is written to the same
+    path relative to `output_dir` as its input is to `input_dir`. Files
+    are mangled whole, up to `workers` at a time in a process pool.
+
+    A manifest in `output_dir` records the size and modification time of
+    each input when it was mangled. Inputs that have not changed since are
+    skipped, unless the pointers have changed or a device mapped by an
+    earlier run has a new alias. New devices alone leave outputs up to
+    date, so a skipped file that names a new device without its start
+    marker keeps the name until it changes or `force` is given. Hashed
+    aliases only change with the key and width of the store.
+
+    Args:
+        input_files (list[str]): The paths to the input JSONL files.
+        input_dir (str): The directory the input paths are relative to.
+        output_dir (str): The directory to write the outputs to.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                    representing the fields to nullify.
+        workers (int): The number of worker processes.
+        mapping_store (Optional[DeviceMappingStore]): A persistent store to
+            take aliases from and add new devices to.
+        codec (str): The name of the JSON codec to use.
+        compresslevel (Optional[int]): The compression level for compressed
+                                       outputs.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        force (bool): Whether to mangle files that are up to date.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+
+    Returns:
+        tuple[int, int]: The number of files mangled and skipped.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    started = time.perf_counter()
+    alias_store = _stream_alias_store(mapping_store)
+    if alias_store is not None:
+        # Hashed aliases are assigned as the lines name devices instead
+        file_markers = []
+    elif workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            file_markers = list(executor.map(read_start_markers, input_files))
+    else:
+        file_markers = [read_start_markers(file) for file in input_files]
+    markers = [marker for file in file_markers for marker in file]
+    mapped = time.perf_counter()
+    if mapping_store is not None:
+        device_mappings = mapping_store.add_markers(markers)
+    else:
+        device_mappings = get_device_mappings(markers)
+    if stats is not None:
+        stats.timings["markers"] += mapped - started
+        stats.timings["mapping"] += time.perf_counter() - mapped
+        stats.counts["start_markers"] += len(markers)
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = _read_batch_manifest(output_dir)
+    outputs = manifest.setdefault("files", {})
+    if alias_store is not None:
+        # The store only holds the devices seen so far, which do not change
+        # the aliases of the others
+        mapping_key = alias_store.alias("")
+    else:
+        manifest["mapping"] = _batch_mapping_version(
+            manifest.get("mapping", {}), device_mappings
+        )
+        mapping_key = manifest["mapping"]["version"]
+    # Outputs are only up to date for the same pointers, aliases and paths
+    run_params = [pointers, mapping_key]
+    if device_paths is not None:
+        run_params.append(device_paths.paths)
+    run_key = hash_string(json.dumps(run_params))
+    jobs = {}
+    for input_file in input_files:
+        relative = os.path.relpath(input_file, input_dir)
+        output_file = os.path.join(output_dir, relative)
+        stat = os.stat(input_file)
+        entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "key": run_key,
+        }
+        up_to_date = outputs.get(relative) == entry
+        if force or not up_to_date or not os.path.exists(output_file):
+            jobs[relative] = (input_file, output_file, entry)
+
+    state_args = (
+        device_mappings,
+        pointers,
+        codec,
+        compresslevel,
+        stats is not None,
+        device_paths,
+        alias_store,
+    )
+    try:
+        if workers > 1:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_mangle_worker,
+                initargs=state_args,
+            ) as executor:
+                futures = {
+                    relative: executor.submit(
+                        _mangle_whole_file, input_file, output_file
+                    )
+                    for relative, (input_file, output_file, _) in jobs.items()
+                }
+                for relative, future in futures.items():
+                    file_stats = future.result()
+                    outputs[relative] = jobs[relative][2]
+                    if file_stats is not None:
+                        stats.merge(file_stats)
+        else:
+            state = _compile_worker_state(*state_args)
+            for relative, (input_file, output_file, entry) in jobs.items():
+                file_stats = _mangle_whole_file(input_file, output_file, state)
+                outputs[relative] = entry
+                if file_stats is not None:
+                    stats.merge(file_stats)
+    finally:
+        # Keep track of the files that were mangled before any failure
+        _write_batch_manifest(output_dir, manifest)
+    if stats is not None:
+        stats.timings["total"] += time.perf_counter() - started
+    return len(jobs), len(input_files) - len(jobs)
+
+
+def compile_alias_pattern(
+    device_mappings: dict[str, str]
+) -> Optional[re.Pattern]:
+    """Compile the mangled names of a device mapping into a single regex.
+
+    Matches must be checked with `is_device_match`, as for
+    `compile_device_pattern`.
+    """
+    return compile_device_pattern(
+        {alias: alias for alias in device_mappings.values()}
+    )
+
+
+class ShardWriter:
+    """Write lines to numbered shard files, rotating them by size or line
+    count, and index the byte ranges of the lines naming each device.
+
+    A shard is rotated before the line that would start past its limit, so
+    a shard can exceed `max_bytes` by at most one line. Consecutive lines
+    naming a device are merged into one byte range.
+
+    Attributes:
+        shards (list[str]): The paths of the shards written so far.
+        ranges (dict[str, list[list[int]]]): [shard, start, end] byte
+            ranges per mangled device name, where shard indexes `shards`.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        max_bytes: Optional[int] = None,
+        max_lines: Optional[int] = None,
+        alias_pattern: Optional[re.Pattern] = None,
+    ):
+        """Prepare to write shards named `<prefix>00000.jsonl` and up.
+
+        Args:
+            prefix (str): The path prefix of the shards.
+            max_bytes (Optional[int]): The size to rotate shards at.
+            max_lines (Optional[int]): The line count to rotate shards at.
+            alias_pattern (Optional[re.Pattern]): A pattern from
+                `compile_alias_pattern`. Lines are not indexed without one.
+        """
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.alias_pattern = alias_pattern
+        self.shards: list[str] = []
+        self.ranges: dict[str, list[list[int]]] = {}
+        self._file: Optional[IO] = None
+        self._bytes = 0
+        self._lines = 0
+
+    def _rotate(self) -> None:
+        """Close the current shard and start the next one."""
+        if self._file is not None:
+            self._file.close()
+        path = f"{self.prefix}{len(self.shards):05}.jsonl"
+        self._file = open(path, "w", encoding="utf-8")
+        self.shards.append(path)
+        self._bytes = self._lines = 0
+
+    def _is_full(self) -> bool:
+        """Check whether the current shard has reached a limit."""
+        if self.max_bytes and self._bytes >= self.max_bytes:
+            return True
+        return bool(self.max_lines) and self._lines >= self.max_lines
+
+    def write(self, line: str) -> None:
+        """Write a newline-terminated line to the current shard."""
+        if self._file is None or self._is_full():
+            self._rotate()
+        start = self._bytes
+        self._file.write(line)
+        self._bytes += len(line) if line.isascii() else len(line.encode())
+        self._lines += 1
+        if self.alias_pattern is None:
+            return
+        shard = len(self.shards) - 1
+        aliases = {
+            match.group()
+            for match in self.alias_pattern.finditer(line)
+            if is_device_match(match)
+        }
+        for alias in aliases:
+            spans = self.ranges.setdefault(alias, [])
+            if spans and spans[-1][0] == shard and spans[-1][2] == start:
+                spans[-1][2] = self._bytes
+            else:
+                spans.append([shard, start, self._bytes])
+
+    def writelines(self, lines: Iterable[str]) -> None:
+        """Write newline-terminated lines."""
+        for line in lines:
+            self.write(line)
+
+    def close(self) -> None:
+        """Close the current shard."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _write_shards(
+    lines: Iterable[str],
+    prefix: str,
+    state: dict,
+    shard_bytes: Optional[int],
+    shard_lines: Optional[int],
+) -> tuple[list[str], dict, Optional[MangleStats]]:
+    """Mangle lines with compiled state into rotated shards.
+
+    Returns:
+        tuple[list[str], dict, Optional[MangleStats]]: The shard paths, the
+            byte ranges of each device in them, and the stats if the state
+            collects them.
+    """
+    stats = MangleStats() if state["collect_stats"] else None
+    if state["alias_store"] is not None:
+        # Devices may also be aliased on the fly, after the pattern is built
+        alias_pattern = state["alias_store"].alias_pattern()
+    else:
+        alias_pattern = compile_alias_pattern(state["device_mappings"])
+    with ShardWriter(prefix, shard_bytes, shard_lines, alias_pattern) as f:
+        write_lines(
+            f,
+            mangle_lines(
+                lines,
+                state["device_mappings"],
+                state["pointers"],
+                state["pattern"],
+                state["plan"],
+                state["codec"],
+                stats=stats,
+                device_paths=state["device_paths"],
+                alias_store=state["alias_store"],
+            ),
+            stats,
+        )
+    return f.shards, f.ranges, stats
+
+
+def _mangle_range_to_shards(
+    input_file: str,
+    start: int,
+    end: int,
+    prefix: str,
+    shard_bytes: Optional[int],
+    shard_lines: Optional[int],
+) -> tuple[list[str], dict, Optional[MangleStats]]:
+    """Mangle one byte range of the input into shards in a pool worker."""
+    lines = iter_byte_range(input_file, start, end)
+    return _write_shards(
+        lines, prefix, _worker_state, shard_bytes, shard_lines
+    )
+
+
+def mangle_json_file_sharded(
+    input_file: str,
+    output_file: str,
+    pointers: list[JsonPathStr],
+    shard_bytes: Optional[int] = None,
+    shard_lines: Optional[int] = None,
+    workers: int = 1,
+    mapping_store: Optional[DeviceMappingStore] = None,
+    codec: str = "json",
+    stats: Optional[MangleStats] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+) -> str:
+    """Mangle a JSONL file into rotated shards with a device index.
+
+    For an output file `out.jsonl`, the shards are written as
+    `out-00000.jsonl`, `out-00001.jsonl` and so on, and the index as
+    `out.index.json`:
+
+        {"shards": ["out-00000.jsonl", ...],
+         "devices": {"DEVICE-007": [[shard, start, end], ...], ...}}
+
+    Each range holds whole lines of one shard that name the device, so a
+    consumer can seek to them with `iter_device_lines` instead of reading
+    every shard. With several workers, each chunk of the input is mangled
+    into its own shards concurrently, which also skips stitching the chunks
+    together. Shards are not compressed, so that the ranges are file
+    offsets.
+
+    Args:
+        input_file (str): The path to the input JSONL file.
+        output_file (str): The path the shard and index names derive from.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                    representing the fields to nullify.
+        shard_bytes (Optional[int]): The size to rotate shards at.
+        shard_lines (Optional[int]): The line count to rotate shards at.
+        workers (int): The number of worker processes.
+        mapping_store (Optional[DeviceMappingStore]): A persistent store to
+            take aliases from and add new devices to.
+        codec (str): The name of the JSON codec to use.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+
+    Returns:
+        str: The path of the index file.
+    """
+    started = time.perf_counter()
+    device_mappings = _load_device_mappings(input_file, mapping_store, stats)
+    state_args = (
+        device_mappings,
+        pointers,
+        codec,
+        None,
+        stats is not None,
+        device_paths,
+        _stream_alias_store(mapping_store),
+    )
+    stem = os.path.splitext(str(output_file))[0]
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        if workers > 1 and not detect_compression(input_file):
+            from concurrent.futures import ProcessPoolExecutor
+
+            size = os.path.getsize(input_file)
+            n_ranges = max(workers * 4, -(-size // PARALLEL_CHUNK_SIZE))
+            ranges = split_line_ranges(input_file, n_ranges)
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_mangle_worker,
+                initargs=state_args,
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _mangle_range_to_shards,
+                        str(input_file),
+                        start,
+                        end,
+                        os.path.join(tmp_dir, f"part-{i:06}-"),
+                        shard_bytes,
+                        shard_lines,
+                    )
+                    for i, (start, end) in enumerate(ranges)
+                ]
+                parts = [future.result() for future in futures]
+        else:
+            with open_jsonl(input_file, "r") as f_in:
+                parts = [
+                    _write_shards(
+                        f_in,
+                        os.path.join(tmp_dir, "part-"),
+                        _compile_worker_state(*state_args),
+                        shard_bytes,
+                        shard_lines,
+                    )
+                ]
+
+        # Number the shards in input order and merge their ranges
+        shards: list[str] = []
+        devices: dict[str, list[list[int]]] = {}
+        for part_shards, part_ranges, part_stats in parts:
+            first = len(shards)
+            for shard in part_shards:
+                name = f"{os.path.basename(stem)}-{len(shards):05}.jsonl"
+                os.replace(shard, os.path.join(output_dir, name))
+                shards.append(name)
+            for alias, spans in part_ranges.items():
+                devices.setdefault(alias, []).extend(
+                    [first + shard, start, end] for shard, start, end in spans
+                )
+            if part_stats is not None:
+                stats.merge(part_stats)
+
+    # Remove the shards a previous, longer run left behind
+    import glob
+
+    for shard in glob.glob(glob.escape(stem) + SHARD_NAME_GLOB):
+        if os.path.basename(shard) not in shards:
+            os.remove(shard)
+
+    index_file = stem + SHARD_INDEX_SUFFIX
+    index = {"shards": shards, "devices": dict(sorted(devices.items()))}
+    with open(f"{index_file}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{index_file}.tmp", index_file)
+    if stats is not None:
+        stats.counts["shards"] += len(shards)
+        stats.counts["bytes_read"] += os.path.getsize(input_file)
+        stats.counts["bytes_written"] += sum(
+            os.path.getsize(os.path.join(output_dir, name)) for name in shards
+        )
+        stats.timings["total"] += time.perf_counter() - started
+    return index_file
+
+
+def iter_device_lines(index_file: str, alias: str) -> Iterator[str]:
+    """Read the lines naming one device from a sharded output.
+
+    Args:
+        index_file (str): The index written by `mangle_json_file_sharded`.
+        alias (str): The mangled device name, such as "DEVICE-007".
+
+    Yields:
+        str: The next line naming the device, in output order.
+    """
+    with open(index_file, "r") as f:
+        index = json.load(f)
+    shard_dir = os.path.dirname(os.path.abspath(index_file))
+    for shard, start, end in index["devices"].get(alias, []):
+        with open(os.path.join(shard_dir, index["shards"][shard]), "rb") as f:
+            f.seek(start)
+            while f.tell() < end:
+                yield f.readline().decode("utf-8")
+
+
+class ResyncWindow(NamedTuple):
+    """The lines of one Resync, from its start marker through its end
+    marker.
+
+    Attributes:
+        device (str): The device name the Resync covers.
+        start (int): The byte offset of the start marker.
+        end (int): The byte offset just past the end marker.
+    """
+
+    device: str
+    start: int
+    end: int
+
+
+class ResyncIndex(NamedTuple):
+    """The Resync windows of a file and the devices of its start markers.
+
+    Attributes:
+        windows (list[ResyncWindow]): The windows in order of their start
+                                      markers.
+        devices (list[str]): The device names of the start markers, in
+                             order of first appearance, from which the
+                             device mapping of the file is built.
+    """
+
+    windows: list[ResyncWindow]
+    devices: list[str]
+
+
+def index_resync_windows(file: str) -> list[ResyncWindow]:
+    """Find the byte span of each Resync window of a JSONL file.
+
+    A window opens at a start marker and closes at the next end marker of
+    the same device. A window that is never closed runs to the next start
+    marker of its device, or to the end of the file.
+
+    Args:
+        file (str): The path to the uncompressed JSONL file.
+
+    Returns:
+        list[ResyncWindow]: The windows in order of their start markers.
+
+    Raises:
+        ValueError: If the file is compressed, as windows are read back by
+                    seeking to their offsets.
+    """
+    return _index_resync_file(file).windows
+
+
+def _index_resync_file(file: str) -> ResyncIndex:
+    """Find the Resync windows and start marker devices of a file in one
+    scan, as `index_resync_windows` does."""
+    if detect_compression(file):
+        raise ValueError(f"Cannot index Resync windows of compressed {file}")
+    windows = []
+    devices: dict[str, None] = {}
+    opened: dict[str, int] = {}
+    for offset, line in scan_lines(file, b"ResyncMarker"):
+        decoded = line.decode("utf-8")
+        if is_start_marker_line(decoded):
+            for device in extract_device_names([json.loads(decoded)]):
+                devices[device] = None
+                if device in opened:
+                    windows.append(
+                        ResyncWindow(device, opened.pop(device), offset)
+                    )
+                opened[device] = offset
+        elif END_MARKER_SIGNATURE in line:
+            for device in extract_device_names([json.loads(decoded)]):
+                if device in opened:
+                    windows.append(
+                        ResyncWindow(
+                            device, opened.pop(device), offset + len(line)
+                        )
+                    )
+    size = os.path.getsize(file)
+    windows.extend(
+        ResyncWindow(device, start, size) for device, start in opened.items()
+    )
+    windows.sort(key=lambda window: window.start)
+    return ResyncIndex(windows, list(devices))
 
 
-def hash_string(s: str, /) -> str:
-    """Returns a SHA-256 hash of the input string.
+def load_resync_index(file: str) -> ResyncIndex:
+    """Load the Resync index of a file from the index file kept next to it.
+
+    The index file is `<file>.windows.json`. It is rebuilt when it is
+    missing, was written by an older version without the devices, or the
+    file has changed since it was written.
 
     Args:
-        s (str): The input string to hash.
+        file (str): The path to the uncompressed JSONL file.
 
     Returns:
-        str: The SHA-256 hash of the input string in hexadecimal format.
+        ResyncIndex: The windows and start marker devices of the file.
     """
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+    index_file = f"{file}{WINDOW_INDEX_SUFFIX}"
+    version = list(_file_version(file))
+    try:
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        if index.get("version") == version and "devices" in index:
+            return ResyncIndex(
+                [ResyncWindow(*window) for window in index["windows"]],
+                index["devices"],
+            )
+    except (FileNotFoundError, ValueError):
+        pass
+    resync_index = _index_resync_file(file)
+    index = {
+        "version": version,
+        "windows": [list(window) for window in resync_index.windows],
+        "devices": resync_index.devices,
+    }
+    with open(f"{index_file}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{index_file}.tmp", index_file)
+    return resync_index
 
 
-def read_device_mappings(file: str) -> dict[str, str]:
-    """Read device mappings from a JSON file.
+def load_resync_windows(file: str) -> list[ResyncWindow]:
+    """Load the Resync windows of a file through `load_resync_index`.
 
     Args:
-        file (str): The path to the JSON file containing device mappings.
+        file (str): The path to the uncompressed JSONL file.
 
     Returns:
-        dict[str, str]: A dictionary mapping device names
-                        to their mangled names.
+        list[ResyncWindow]: The windows in order of their start markers.
     """
-    # Get Resync Start markers using jsonparse
-    markers = []
-    with open(file) as f:
-        for line in f:
-            if "ResyncMarker" in line:
-                entry = json.loads(line)
-                json_marker_type = jsonparse("$.event.marker_type")
-                if (
-                    match := json_marker_type.find(entry)[0]
-                ) and match.value == "start":
-                    markers.append(entry)
+    return load_resync_index(file).windows
 
-    # Extract device mappings from markers
-    return get_device_mappings(markers)
 
+def mangle_json_file_windows(
+    input_file: str,
+    output_file: str,
+    pointers: list[JsonPathStr],
+    devices: Iterable[str],
+    mapping_store: Optional[DeviceMappingStore] = None,
+    codec: str = "json",
+    compresslevel: Optional[int] = None,
+    stats: Optional[MangleStats] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+) -> int:
+    """Mangle only the Resync windows of some devices in a JSONL file.
 
-def read_start_markers(file: str) -> list[dict]:
-    """Get the Start markers from a JSONL file.
+    The windows are found through `load_resync_index` and read by seeking
+    straight to them, so reprocessing one device does not read the rest of
+    the dump. Devices are still aliased from every start marker of the
+    file, in the order the index keeps, so the aliases match those of a
+    full run without scanning the file for its markers again.
 
     Args:
-        file (str): The path to the JSONL file.
+        input_file (str): The path to the uncompressed input JSONL file.
+        output_file (str): The path to the output JSONL file.
+        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
+                                    representing the fields to nullify.
+        devices (Iterable[str]): The names of the devices to mangle.
+        mapping_store (Optional[DeviceMappingStore]): A persistent store to
+            take aliases from and add new devices to.
+        codec (str): The name of the JSON codec to use.
+        compresslevel (Optional[int]): The compression level for compressed
+                                       output.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
 
     Returns:
-        list[dict]: A list of dictionaries representing the start markers.
+        int: The number of windows mangled.
     """
-    markers = []
-    with open(file) as f:
-        for line in f:
-            if "ResyncMarker" in line and '"marker_type":"start"' in line:
-                markers.append(json.loads(line))
-    return markers
+    started = time.perf_counter()
+    resync_index = load_resync_index(input_file)
+    indexed = time.perf_counter()
+    if mapping_store is not None:
+        device_mappings = mapping_store.add_devices(resync_index.devices)
+    else:
+        device_mappings = number_device_names({}, resync_index.devices)
+    mapped = time.perf_counter()
+    devices = set(devices)
+    windows = [
+        window for window in resync_index.windows if window.device in devices
+    ]
+    # Merge overlapping windows so that no line is written twice
+    spans: list[list[int]] = []
+    for window in windows:
+        if spans and window.start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], window.end)
+        else:
+            spans.append([window.start, window.end])
+    if stats is not None:
+        stats.timings["mapping"] += mapped - indexed
+        stats.timings["windows"] += (
+            indexed - started + time.perf_counter() - mapped
+        )
 
+    lines = (
+        line
+        for start, end in spans
+        for line in iter_byte_range(input_file, start, end)
+    )
+    with open_jsonl(output_file, "w", compresslevel) as f_out:
+        write_lines(
+            f_out,
+            mangle_lines(
+                lines,
+                device_mappings,
+                pointers,
+                codec=codec,
+                stats=stats,
+                device_paths=device_paths,
+                alias_store=_stream_alias_store(mapping_store),
+            ),
+            stats,
+        )
+    if stats is not None:
+        stats.counts["windows"] += len(windows)
+        stats.counts["bytes_read"] += sum(end - start for start, end in spans)
+        stats.counts["bytes_written"] += os.path.getsize(output_file)
+        stats.timings["total"] += time.perf_counter() - started
+    return len(windows)
 
-def get_device_mappings(markers: list[dict]) -> dict[str, str]:
-    """Get a mapping of device names to their new mangled names.
 
-    Args:
-        markers (list[dict]): A list of dictionaries representing
-                              the start markers.
+class MangleService:
+    """Compiled mangling state kept warm across requests.
 
-    Returns:
-        dict[str, str]: A dictionary mapping device names
-                        to their mangled names.
+    The device mapping is shared by all requests, so a device keeps its
+    alias across connections, and the device pattern is only recompiled
+    when the mapping grows. Nullify plans are cached per pointer set. The
+    service can be used from several threads at once.
+
+    Attributes:
+        mapping_store (Union[DeviceMappingStore, HashMappingStore]): The
+            store aliases are taken from.
+        codec (str): The name of the JSON codec to use.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+        stats (Optional[MangleStats]): The totals of all requests, if
+                                       collected.
+        pointers (list[JsonPathStr]): The fields to nullify for requests
+                                      that do not name their own.
+        serve_root (Optional[str]): The directory that the file paths of
+            requests must resolve into, or None to refuse file paths.
     """
-    jsonpath_expr = jsonparse("$..properties.device")
-    mappings = {}
-    counter = 1
-    for marker in markers:
-        matches = jsonpath_expr.find(marker)
-        for match in matches:
-            # Extract device names using regex
-            device = match.value
-            if nd_name := DEVICE_PATTERN_ND.search(device):
-                device_name = nd_name.group(1)
+
+    def __init__(
+        self,
+        mapping_store: Optional[DeviceMappingStore] = None,
+        codec: str = "json",
+        device_paths: Optional[DevicePathIndex] = None,
+        stats: Optional[MangleStats] = None,
+        pointers: Optional[list[JsonPathStr]] = None,
+        max_plans: int = DEFAULT_MAX_PLANS,
+        flush_ms: Optional[float] = DEFAULT_SERVER_FLUSH_MS,
+        serve_root: Optional[str] = None,
+    ):
+        """Prepare the shared state.
+
+        Args:
+            mapping_store (Optional[DeviceMappingStore]): A persistent
+                store to take aliases from. An in-memory store is used if
+                not given.
+            codec (str): The name of the JSON codec to use.
+            device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                      device names at.
+            stats (Optional[MangleStats]): Collects the totals of all
+                                           requests if given.
+            pointers (Optional[list[JsonPathStr]]): The fields to nullify
+                for requests that do not name their own.
+            max_plans (int): The number of nullify plans to keep.
+            flush_ms (Optional[float]): The milliseconds after which lines
+                sent back to a client are flushed, even while its stream
+                is idle.
+            serve_root (Optional[str]): The directory that the file paths
+                of requests must resolve into. Requests naming files are
+                refused without one.
+        """
+        if mapping_store is None:
+            mapping_store = DeviceMappingStore(":memory:")
+        self.mapping_store = mapping_store
+        self.codec = codec
+        self.device_paths = device_paths
+        self.stats = stats
+        self.pointers = pointers or []
+        self.max_plans = max_plans
+        self.flush_ms = flush_ms
+        self.serve_root = serve_root and os.path.realpath(serve_root)
+        # Load the codec now rather than on the first request
+        get_json_codec(codec)
+        self._plans: OrderedDict[tuple, NullifyPlan] = OrderedDict()
+        self._mappings: dict[str, str] = {}
+        self._pattern: Optional[re.Pattern] = None
+        self._lock = threading.Lock()
+
+    def plan(self, pointers: list[JsonPathStr]) -> NullifyPlan:
+        """Get the compiled nullify plan of a pointer set.
+
+        Args:
+            pointers (list[JsonPathStr]): The fields to nullify.
+
+        Returns:
+            NullifyPlan: The plan, compiled on first use.
+        """
+        key = tuple(pointers)
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                return self._plans[key]
+        plan = compile_nullify_plan(pointers)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def pattern(self) -> tuple[dict[str, str], Optional[re.Pattern]]:
+        """Get the current device mapping and its compiled pattern.
+
+        Returns:
+            tuple[dict[str, str], Optional[re.Pattern]]: A snapshot of the
+                mapping and the pattern of its device names.
+        """
+        with self._lock:
+            # Other requests may add devices to the store meanwhile
+            mappings = self.mapping_store.refresh()
+            if len(mappings) != len(self._mappings):
+                self._pattern = compile_device_pattern(mappings)
+                self._mappings = mappings
+            return self._mappings, self._pattern
+
+    def _merge_stats(self, stats: Optional[MangleStats]) -> None:
+        """Add the stats of a request to the totals."""
+        if stats is not None:
+            with self._lock:
+                self.stats.merge(stats)
+
+    def mangle_stream(
+        self, lines: Iterable[str], pointers: list[JsonPathStr]
+    ) -> Iterator[str]:
+        """Lazily mangle lines as they arrive, learning devices from the
+        start markers among them.
+
+        Each start marker extends the mapping before its own line is
+        mangled, so the lines of a Resync are mangled with its device even
+        though the stream cannot be scanned ahead.
+
+        Args:
+            lines (Iterable[str]): The raw JSONL lines.
+            pointers (list[JsonPathStr]): The fields to nullify.
+
+        Yields:
+            str: The next processed line, terminated by a newline.
+        """
+        stats = MangleStats() if self.stats is not None else None
+        plan = self.plan(pointers)
+        lines = iter(lines)
+        held: list[str] = []
+
+        def until_start_marker() -> Iterator[str]:
+            for line in lines:
+                if is_start_marker_line(line):
+                    held.append(line)
+                    return
+                yield line
+
+        segment = until_start_marker()
+        try:
+            while True:
+                mappings, pattern = self.pattern()
+                yield from mangle_lines(
+                    segment,
+                    mappings,
+                    pointers,
+                    pattern,
+                    plan,
+                    self.codec,
+                    stats=stats,
+                    device_paths=self.device_paths,
+                    alias_store=_stream_alias_store(self.mapping_store),
+                )
+                if not held:
+                    return
+                marker = held.pop()
+                self.mapping_store.add_markers([json.loads(marker)])
+                if stats is not None:
+                    stats.counts["start_markers"] += 1
+                segment = chain([marker], until_start_marker())
+        finally:
+            self._merge_stats(stats)
+
+    def mangle_file(
+        self, input_file: str, pointers: list[JsonPathStr]
+    ) -> Iterator[str]:
+        """Lazily mangle the lines of a file with all of its devices.
+
+        Args:
+            input_file (str): The path to the JSONL file, which may be
+                              compressed.
+            pointers (list[JsonPathStr]): The fields to nullify.
+
+        Yields:
+            str: The next processed line, terminated by a newline.
+        """
+        stats = MangleStats() if self.stats is not None else None
+        plan = self.plan(pointers)
+        _load_device_mappings(input_file, self.mapping_store, stats)
+        mappings, pattern = self.pattern()
+        try:
+            with open_jsonl(input_file, "r") as f_in:
+                yield from mangle_lines(
+                    f_in,
+                    mappings,
+                    pointers,
+                    pattern,
+                    plan,
+                    self.codec,
+                    stats=stats,
+                    device_paths=self.device_paths,
+                    alias_store=_stream_alias_store(self.mapping_store),
+                )
+        finally:
+            self._merge_stats(stats)
+
+    def resolve_path(self, path: Any) -> str:
+        """Resolve a file path named by a request inside the serve root.
+
+        Args:
+            path (Any): The path, relative to the serve root or absolute.
+
+        Returns:
+            str: The resolved path, with symbolic links followed.
+
+        Raises:
+            PermissionError: If there is no serve root or the path resolves
+                             outside of it.
+            ValueError: If the path is not a string.
+        """
+        if not isinstance(path, str):
+            raise ValueError("File paths must be strings")
+        if self.serve_root is None:
+            raise PermissionError("File paths are not served")
+        resolved = os.path.realpath(os.path.join(self.serve_root, path))
+        if os.path.commonpath([resolved, self.serve_root]) != self.serve_root:
+            raise PermissionError(f"{path} is outside of the serve root")
+        return resolved
+
+    def handle(self, conn: "socket.socket") -> None:
+        """Serve one client connection.
+
+        The client first sends a JSON request line. Its optional
+        "pointers" are the fields to nullify for this connection, instead
+        of the service's own:
+
+        - With "input" and "output" paths, the input file is mangled into
+          the output file and a JSON line with the output path is returned.
+        - With only an "input" path, the mangled lines of the file are
+          sent back.
+        - Otherwise, the rest of the client's data is read as JSONL and the
+          mangled lines are sent back in batches as they are produced, at
+          most `flush_ms` after each line. The client must read them while
+          it writes, and shut down its sending side when done.
+
+        File paths are only accepted on a Unix socket, whose permissions
+        limit who can connect, and must resolve inside `serve_root`.
+
+        A failed request is answered with a JSON line holding an "error",
+        and logged.
+
+        Args:
+            conn (socket.socket): The accepted connection, closed when done.
+        """
+        import socket
+
+        allow_paths = conn.family == getattr(socket, "AF_UNIX", None)
+        try:
+            with conn, conn.makefile("rb") as reader, conn.makefile(
+                "wb"
+            ) as f, BatchedWriter(f, max_ms=self.flush_ms) as writer:
+                self._handle_request(reader, writer, allow_paths)
+        except OSError:
+            # The client went away before the reply was flushed
+            pass
+
+    def _handle_request(
+        self, reader: IO, writer: "BatchedWriter", allow_paths: bool = False
+    ) -> None:
+        """Answer the request read from a connection, or report why not."""
+        try:
+            request = json.loads(reader.readline())
+            if not isinstance(request, dict):
+                raise ValueError("The request must be a JSON object")
+            pointers = request.get("pointers", self.pointers)
+            if not isinstance(pointers, list) or not all(
+                isinstance(pointer, str) for pointer in pointers
+            ):
+                raise ValueError("'pointers' must be a list of strings")
+            input_file = request.get("input")
+            output_file = request.get("output")
+            if (input_file, output_file) != (None, None):
+                if not allow_paths:
+                    raise PermissionError(
+                        "File paths are only served on a Unix socket"
+                    )
+                if input_file is not None:
+                    input_file = self.resolve_path(input_file)
+                if output_file is not None:
+                    output_file = self.resolve_path(output_file)
+            if input_file is None:
+                lines = (line.decode("utf-8") for line in reader)
+                output = self.mangle_stream(lines, pointers)
             else:
-                device_name = device
-            # Add extracted names to mappings if not present
-            if device_name not in mappings:
-                mappings[device_name] = f"DEVICE-{counter:03}"
-                counter += 1
-    return mappings
+                output = self.mangle_file(input_file, pointers)
+            if output_file is None:
+                writer.writelines(output)
+            else:
+                with open_jsonl(output_file, "w") as f_out:
+                    f_out.writelines(output)
+                writer.write(json.dumps({"output": output_file}) + "\n")
+        except Exception as e:
+            import logging
 
+            logging.getLogger(__name__).exception("Mangling request failed")
+            reply = {"error": f"{type(e).__name__}: {e}"}
+            try:
+                writer.write(json.dumps(reply) + "\n")
+            except OSError:
+                pass
 
-def mangle_device_names(
-    data: list[dict], device_mappings: dict[str, str]
-) -> list[dict]:
-    """Mangle device names in the data using the provided device hashes.
 
-    Args:
-        data (list[dict]): A list of dictionaries representing the JSONL data.
-        device_mappings (dict[str, str]): A dictionary mapping device names
-                                          to their mangled names.
+class BatchedWriter:
+    """Buffer lines for a binary stream and write them out in batches.
 
-    Returns:
-        list[dict]: The list of dictionaries with mangled device names.
+    A batch is written and flushed once it holds `max_lines` lines or
+    `max_bytes` bytes, whichever comes first. With `max_ms`, a background
+    thread also flushes a batch at most that long after its first line,
+    so a stalled input does not hold back lines already mangled.
+
+    Attributes:
+        bytes_written (int): The number of bytes written so far.
     """
-    new_data = data.copy()
-    for entry in new_data:
-        entry_str = json.dumps(entry)
-        for device, mangled_name in device_mappings.items():
-            entry_str = entry_str.replace(f"{device}", f"{mangled_name}")
-        entry.update(json.loads(entry_str))
 
-    return new_data
+    def __init__(
+        self,
+        f: IO,
+        max_lines: Optional[int] = None,
+        max_ms: Optional[float] = None,
+        max_bytes: Optional[int] = DEFAULT_FLUSH_BYTES,
+    ):
+        """Prepare to buffer lines.
 
+        Args:
+            f (IO): The binary stream to write to. It is flushed but not
+                    closed.
+            max_lines (Optional[int]): The line count to flush at.
+            max_ms (Optional[float]): The milliseconds to flush after.
+            max_bytes (Optional[int]): The size to flush at.
+        """
+        self.f = f
+        self.max_lines = max_lines
+        self.max_ms = max_ms
+        self.max_bytes = max_bytes
+        self.bytes_written = 0
+        self._lines: list[str] = []
+        self._bytes = 0
+        self._first_at = 0.0
+        self._error: Optional[OSError] = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = None
+        if max_ms:
+            self._timer = threading.Thread(
+                target=self._flush_periodically, daemon=True
+            )
+            self._timer.start()
 
-def nullify_fields(
-    data: list[dict], pointers: list[JsonPathStr]
-) -> list[dict]:
-    """Nullify fields in the data based on the provided JSON Pointers.
+    def _flush_locked(self) -> None:
+        """Write out the buffered lines while holding the lock."""
+        if self._lines:
+            data = "".join(self._lines).encode("utf-8")
+            self._lines = []
+            self._bytes = 0
+            self.f.write(data)
+            self.bytes_written += len(data)
+        self.f.flush()
+
+    def _flush_periodically(self) -> None:
+        """Flush each batch once it is `max_ms` old, until closed."""
+        interval = self.max_ms / 1000
+        timeout = interval
+        while not self._closed.wait(timeout):
+            with self._lock:
+                timeout = interval
+                if not self._lines:
+                    continue
+                age = time.monotonic() - self._first_at
+                if age < interval:
+                    timeout = interval - age
+                    continue
+                try:
+                    self._flush_locked()
+                except OSError as e:
+                    self._error = e
+                    return
+
+    def _is_full(self) -> bool:
+        """Check whether the buffered batch has reached a limit."""
+        if self.max_bytes and self._bytes >= self.max_bytes:
+            return True
+        return bool(self.max_lines) and len(self._lines) >= self.max_lines
+
+    def write(self, line: str) -> None:
+        """Buffer a newline-terminated line, flushing if the batch is full.
+
+        Raises:
+            OSError: If a background flush failed.
+        """
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            if not self._lines:
+                self._first_at = time.monotonic()
+            self._lines.append(line)
+            self._bytes += len(line) if line.isascii() else len(line.encode())
+            if self._is_full():
+                self._flush_locked()
+
+    def writelines(self, lines: Iterable[str]) -> None:
+        """Buffer newline-terminated lines."""
+        for line in lines:
+            self.write(line)
+
+    def flush(self) -> None:
+        """Write out the buffered lines now."""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        """Write out the buffered lines and stop the background flushes."""
+        self._closed.set()
+        if self._timer is not None:
+            self._timer.join()
+        self.flush()
+
+    def __enter__(self) -> "BatchedWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def mangle_json_stream(
+    input_file: str,
+    output_file: str,
+    pointers: list[JsonPathStr],
+    mapping_store: Optional[DeviceMappingStore] = None,
+    codec: str = "json",
+    compresslevel: Optional[int] = None,
+    stats: Optional[MangleStats] = None,
+    device_paths: Optional[DevicePathIndex] = None,
+    flush_lines: Optional[int] = None,
+    flush_ms: Optional[float] = None,
+    flush_bytes: Optional[int] = DEFAULT_FLUSH_BYTES,
+) -> None:
+    """Mangle JSONL from and to files or the standard streams.
+
+    An input of "-" is read from stdin as it arrives, with devices aliased
+    as their start markers come in, so the command can sit in a shell
+    pipeline. An output of "-" is written to stdout. The output is written
+    in batches following `BatchedWriter`, not once per line.
 
     Args:
-        data (list[dict]): A list of dictionaries representing the JSONL data.
+        input_file (str): The path to the input JSONL file, or "-".
+        output_file (str): The path to the output JSONL file, or "-".
         pointers (list[JsonPathStr]): A list of JSON Pointers or strings
-                                      representing the fields to nullify.
+                                    representing the fields to nullify.
+        mapping_store (Optional[DeviceMappingStore]): A persistent store to
+            take aliases from and add new devices to.
+        codec (str): The name of the JSON codec to use.
+        compresslevel (Optional[int]): The compression level for a
+                                       compressed output file.
+        stats (Optional[MangleStats]): Collects counts and per-stage
+                                       timings if given.
+        device_paths (Optional[DevicePathIndex]): The paths to replace
+                                                  device names at.
+        flush_lines (Optional[int]): The line count to flush output at.
+        flush_ms (Optional[float]): The milliseconds to flush output after.
+        flush_bytes (Optional[int]): The size to flush output at.
+    """
+    started = time.perf_counter()
+    service = MangleService(mapping_store, codec, device_paths, stats)
+    if input_file == STDIO_PATH:
+        lines = (line.decode("utf-8") for line in sys.stdin.buffer)
+        output = service.mangle_stream(lines, pointers)
+    else:
+        output = service.mangle_file(input_file, pointers)
+    if output_file == STDIO_PATH:
+        f_out = nullcontext(sys.stdout.buffer)
+    else:
+        f_out = open_jsonl(output_file, "wb", compresslevel)
+    with f_out as f, BatchedWriter(
+        f, flush_lines, flush_ms, flush_bytes
+    ) as writer:
+        write_lines(writer, output, stats)
+    if stats is not None:
+        if input_file != STDIO_PATH:
+            stats.counts["bytes_read"] += os.path.getsize(input_file)
+        stats.counts["bytes_written"] += writer.bytes_written
+        stats.timings["total"] += time.perf_counter() - started
+
+
+def listen_socket(
+    socket_path: Optional[str] = None, port: Optional[int] = None
+) -> "socket.socket":
+    """Open a listening socket for `serve`.
+
+    Args:
+        socket_path (Optional[str]): The path of the Unix socket to listen
+            on, which only its owner can connect to. A stale socket left by
+            a previous server is replaced.
+        port (Optional[int]): The localhost TCP port to listen on, if no
+                              socket path is given. 0 picks a free port.
 
     Returns:
-        list[dict]: The modified list of dictionaries with specified fields
-                    set to an empty string.
+        socket.socket: The listening socket.
     """
-    if not pointers:
-        return data
-    result = []
-    root_pointer = "$..object_data"
-    for entry in data:
-        for pointer in pointers:
-            jsonpath_expr = jsonparse(f"{root_pointer}..{pointer}")
-            entry = jsonpath_expr.update(entry, "")
-        result.append(entry)
-    return result
+    import socket
+    import stat
 
+    if socket_path is not None:
+        if os.path.exists(socket_path) and stat.S_ISSOCK(
+            os.stat(socket_path).st_mode
+        ):
+            os.remove(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Create the socket file without access for other users
+        umask = os.umask(0o177)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(umask)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", port or 0))
+    server.listen()
+    return server
 
-def mangle_json_file(
-    input_file: str, output_file: str, pointers: list[JsonPathStr]
+
+def serve(
+    service: MangleService,
+    server: "socket.socket",
+    workers: int = 1,
+    stop: Optional[threading.Event] = None,
 ) -> None:
-    """Mangle device names and nullify specified fields in a JSONL file.
+    """Serve mangling requests until stopped or interrupted.
 
-    Writes the modified data to a new JSONL file.
+    Connections are handled by a bounded pool of threads. While every
+    thread is busy, no more connections are accepted, so further clients
+    wait in the socket's listen backlog instead of an unbounded queue. The
+    listening socket is closed on return, and its file removed if it is a
+    Unix socket.
 
     Args:
-        input_file (str): The path to the input JSONL file.
-        output_file (str): The path to the output JSONL file.
-        pointers (list[JsonPathStr]): A list of JSON Pointers or strings
-                                    representing the fields to nullify.
+        service (MangleService): The state to mangle with.
+        server (socket.socket): A socket from `listen_socket`.
+        workers (int): The number of connections to handle at once.
+        stop (Optional[threading.Event]): Stops the server when set.
     """
-    # Get the devide name mapping from Resync start markers
-    markers = read_start_markers(input_file)
-    device_mappings = get_device_mappings(markers)
+    import socket
+    from concurrent.futures import ThreadPoolExecutor
+
+    socket_path = None
+    if server.family == getattr(socket, "AF_UNIX", None):
+        socket_path = server.getsockname()
+    # Wake up regularly to check whether the server should stop
+    server.settimeout(0.5)
+    free_workers = threading.BoundedSemaphore(workers)
+    try:
+        with server, ThreadPoolExecutor(max_workers=workers) as executor:
+            while stop is None or not stop.is_set():
+                if not free_workers.acquire(timeout=0.5):
+                    continue
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    free_workers.release()
+                    continue
+                conn.settimeout(None)
+                future = executor.submit(service.handle, conn)
+                future.add_done_callback(lambda _: free_workers.release())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+_profile_lock = threading.Lock()
+_profile_runs = count()
+
+
+def prune_profile_dumps(profile_dir: str, keep: int) -> None:
+    """Delete all but the newest profile dumps in a directory.
+
+    Only directories named like the runs of `profile_run` are considered,
+    so anything else kept in the directory is left alone.
+
+    Args:
+        profile_dir (str): The directory holding one subdirectory per run.
+        keep (int): The number of runs to keep.
+    """
+    runs = sorted(
+        (
+            entry
+            for entry in os.scandir(profile_dir)
+            if entry.is_dir() and PROFILE_RUN_PATTERN.match(entry.name)
+        ),
+        key=lambda entry: (entry.stat().st_mtime, entry.name),
+    )
+    for entry in runs[: max(len(runs) - keep, 0)]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _function_line_ranges() -> list[tuple[int, int, str]]:
+    """Get the line range of every function defined in this module."""
+    import ast
 
-    # Read the input JSONL file
-    with open(input_file, "r") as f:
-        data = [json.loads(line) for line in f]
+    with open(__file__, "r") as f:
+        tree = ast.parse(f.read())
+    return [
+        (node.lineno, node.end_lineno, node.name)
+        for node in ast.walk(tree)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+    ]
 
-    # Mangle device names and nullify specified fields
-    mangled_data = mangle_device_names(data, device_mappings)
-    mangled_data = nullify_fields(mangled_data, pointers)
 
-    # Write the modified data to the output JSONL file
-    with open(output_file, "w") as f:
-        for entry in mangled_data:
-            f.write(json.dumps(entry).replace(" ", "") + "\n")
+def attribute_allocations(snapshot: "tracemalloc.Snapshot") -> Counter:
+    """Sum the memory of a tracemalloc snapshot by filter_json function.
+
+    Each allocation is attributed to the innermost function of this module
+    on its traceback, so memory allocated by the json module or by file
+    objects is charged to the function that called them.
+
+    Args:
+        snapshot (tracemalloc.Snapshot): The snapshot to attribute.
+
+    Returns:
+        Counter: Bytes allocated, keyed by function name. Allocations with
+                 no function of this module on their traceback are keyed
+                 by "<other>".
+    """
+    module_file = os.path.abspath(__file__)
+    ranges = _function_line_ranges()
+    names: dict[int, str] = {}
+    sizes = Counter()
+    for stat in snapshot.statistics("traceback"):
+        name = "<other>"
+        # Frames are ordered from the oldest call
+        for frame in reversed(stat.traceback):
+            if os.path.abspath(frame.filename) != module_file:
+                continue
+            if frame.lineno not in names:
+                # The innermost function is the one that starts last
+                enclosing = [
+                    (start, function)
+                    for start, end, function in ranges
+                    if start <= frame.lineno <= end
+                ]
+                names[frame.lineno] = (
+                    max(enclosing)[1] if enclosing else "<module>"
+                )
+            name = names[frame.lineno]
+            break
+        sizes[name] += stat.size
+    return sizes
+
+
+class _MemorySampler:
+    """Sample tracemalloc in a thread, keeping the largest snapshot.
+
+    Attributes:
+        n_samples (int): The number of samples taken.
+        largest (Optional[tuple]): The traced bytes, seconds since the start
+            and snapshot of the sample with the most traced memory.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.n_samples = 0
+        self.largest = None
+        self._started = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        import tracemalloc
+
+        tracemalloc.start(PROFILE_TRACE_FRAMES)
+        self._started = time.monotonic()
+        self._thread.start()
+
+    def sample(self):
+        import tracemalloc
+
+        self.n_samples += 1
+        current, _ = tracemalloc.get_traced_memory()
+        if self.largest is None or current > self.largest[0]:
+            elapsed = time.monotonic() - self._started
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)]
+            )
+            self.largest = (current, elapsed, snapshot)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def stop(self) -> int:
+        """Stop sampling after a final sample, which covers runs shorter
+        than the interval.
+
+        Returns:
+            int: The peak traced memory in bytes.
+        """
+        import tracemalloc
+
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+    def write_report(self, path: str, peak: int) -> None:
+        """Write the allocations of the largest sample to a file."""
+        current, elapsed, snapshot = self.largest
+        with open(path, "w") as f:
+            f.write(f"Peak traced memory: {peak / 2**20:.2f} MiB\n")
+            f.write(
+                f"Largest sample: {current / 2**20:.2f} MiB at "
+                f"{elapsed:.2f}s, of {self.n_samples} samples\n\n"
+            )
+            f.write("Allocated at the largest sample by function:\n")
+            for name, size in attribute_allocations(snapshot).most_common():
+                f.write(f"{size / 2**20:12.3f} MiB  {name}\n")
+            f.write("\nTop lines at the largest sample:\n")
+            for stat in snapshot.statistics("lineno")[:PROFILE_REPORT_ROWS]:
+                f.write(f"{stat}\n")
+
+
+@contextmanager
+def profile_run(
+    profile_dir: str,
+    name: str,
+    keep: int = DEFAULT_PROFILE_KEEP,
+    sample_interval: float = 1.0,
+) -> Iterator[Optional[str]]:
+    """Profile a block with cProfile and sampled tracemalloc snapshots.
+
+    Each run is dumped to its own subdirectory of `profile_dir`:
+
+        profile.prof  cProfile stats, to load with pstats or snakeviz
+        profile.txt   The top functions by cumulative time
+        memory.txt    Allocations by function and by line at the sample
+                      with the highest traced memory
+
+    Only the calling thread is profiled, and worker processes of parallel
+    runs are not. Runs are profiled one at a time, since tracemalloc is
+    process-wide; a run started while another is being profiled is not
+    profiled.
+
+    Args:
+        profile_dir (str): The directory to dump profiles to.
+        name (str): A name for the run, such as the input file name.
+        keep (int): The number of runs to keep in `profile_dir`.
+        sample_interval (float): Seconds between tracemalloc samples, or 0
+                                 to skip memory profiling.
+
+    Yields:
+        Optional[str]: The directory of this run's dumps, or None if the
+                       run is not profiled.
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    if not _profile_lock.acquire(blocking=False):
+        yield None
+        return
+    try:
+        run_name = (
+            f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+            f"-{next(_profile_runs):04}-{os.path.basename(str(name))}"
+        )
+        run_dir = os.path.join(profile_dir, run_name)
+        os.makedirs(run_dir)
+        sampler = None
+        if sample_interval > 0 and not tracemalloc.is_tracing():
+            sampler = _MemorySampler(sample_interval)
+            sampler.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield run_dir
+        finally:
+            profiler.disable()
+            if sampler is not None:
+                peak = sampler.stop()
+                sampler.write_report(os.path.join(run_dir, "memory.txt"), peak)
+            profiler.dump_stats(os.path.join(run_dir, "profile.prof"))
+            with open(os.path.join(run_dir, "profile.txt"), "w") as f:
+                pstats.Stats(profiler, stream=f).sort_stats(
+                    "cumulative"
+                ).print_stats(PROFILE_REPORT_ROWS)
+            prune_profile_dumps(profile_dir, keep)
+    finally:
+        _profile_lock.release()
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Filter and mangle JSONL data.")
     parser.add_argument(
-        "--input", "-i", type=str, required=True, help="Input JSONL file path."
+        "--input",
+        "-i",
+        type=str,
+        required=False,
+        help="Input JSONL file path, a directory or glob of files to "
+        "mangle as a batch, or - for stdin. Not used when serving.",
     )
     parser.add_argument(
         "--output",
         "-o",
         type=str,
         required=False,
-        default="mangled_data.jsonl",
-        help="Output JSONL file path.",
+        help="Output JSONL file path, output directory for a batch, or - "
+        "for stdout. Defaults to mangled_data.jsonl or mangled_data.",
     )
     parser.add_argument(
         "--pointers",
@@ -210,16 +4617,412 @@ if __name__ == "__main__":
         required=False,
         help="File containing JSON Pointers to nullify, one per line.",
     )
-
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of worker processes to mangle the file with, or to "
+        "mangle the files of a batch with.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Mangle the files of a batch even if they are up to date.",
+    )
+    parser.add_argument(
+        "--mapping_store",
+        "-m",
+        type=str,
+        required=False,
+        help="SQLite file to keep device aliases stable across runs.",
+    )
+    parser.add_argument(
+        "--hash_aliases",
+        action="store_true",
+        help="Derive each device alias from a hash of its name, so that "
+        "separate runs agree on aliases without a mapping store. Devices "
+        "are aliased as device values name them, without a scan for start "
+        "markers first.",
+    )
+    parser.add_argument(
+        "--alias_key_file",
+        type=str,
+        required=False,
+        help="File holding the secret key to hash device names with "
+        "HMAC-SHA256. Implies --hash_aliases.",
+    )
+    parser.add_argument(
+        "--alias_width",
+        type=int,
+        required=False,
+        default=DEFAULT_ALIAS_WIDTH,
+        help="Number of hexadecimal digits in hashed aliases.",
+    )
+    parser.add_argument(
+        "--codec",
+        "-c",
+        type=str,
+        required=False,
+        default="json",
+        choices=list(JSON_CODECS),
+        help="JSON library used to decode and encode lines. orjson is "
+        "faster but writes non-ASCII characters unescaped.",
+    )
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        required=False,
+        help="Compression level for .gz, .bz2 or .xz output.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Overlap reading, mangling and writing on an asyncio pipeline.",
+    )
+    parser.add_argument(
+        "--device_paths",
+        type=str,
+        required=False,
+        help="JSON file of the paths that hold device names per event type. "
+        "Only those values are rewritten. Learned from the input if the file "
+        "does not exist.",
+    )
+    parser.add_argument(
+        "--device_rules",
+        type=str,
+        required=False,
+        help="JSON file of extra rules for extracting device names from "
+        "start markers, as a list of {vendor, key, chars} objects.",
+    )
+    parser.add_argument(
+        "--learn_lines",
+        type=int,
+        required=False,
+        default=DEFAULT_LEARN_LINES,
+        help="Number of input lines to learn device paths from.",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        required=False,
+        help="Write the output as shards of about this many MiB, with an "
+        "index of the byte ranges of each device.",
+    )
+    parser.add_argument(
+        "--shard_lines",
+        type=int,
+        required=False,
+        help="Write the output as shards of this many lines, with an index "
+        "of the byte ranges of each device.",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        nargs="+",
+        required=False,
+        help="Only mangle the Resync windows of these device names, seeking "
+        "to them through an index kept next to the input.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        required=False,
+        help="Directory of cached outputs, reused when the input content, "
+        "pointers, device mapping and output settings are unchanged.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        required=False,
+        default=DEFAULT_CACHE_BYTES // 2**20,
+        help="MiB of cached outputs to keep, evicting the least recently "
+        "used.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        required=False,
+        help="Directory to dump cProfile and tracemalloc reports to.",
+    )
+    parser.add_argument(
+        "--profile_keep",
+        type=int,
+        required=False,
+        default=DEFAULT_PROFILE_KEEP,
+        help="Number of profiled runs to keep in the profile directory.",
+    )
+    parser.add_argument(
+        "--profile_interval",
+        type=float,
+        required=False,
+        default=1.0,
+        help="Seconds between tracemalloc samples, or 0 to skip them.",
+    )
+    parser.add_argument(
+        "--stats",
+        type=str,
+        nargs="?",
+        const="-",
+        required=False,
+        help="Write per-stage counters and timings as JSON to this file, "
+        "or to stdout if no file is given.",
+    )
+    parser.add_argument(
+        "--flush_lines",
+        type=int,
+        required=False,
+        help="With stdin or stdout, flush output every this many lines.",
+    )
+    parser.add_argument(
+        "--flush_ms",
+        type=float,
+        required=False,
+        help="With stdin or stdout, or when serving, flush output at most "
+        "this many milliseconds after a line is mangled. Defaults to "
+        f"{DEFAULT_SERVER_FLUSH_MS} when serving.",
+    )
+    parser.add_argument(
+        "--flush_bytes",
+        type=int,
+        required=False,
+        default=DEFAULT_FLUSH_BYTES,
+        help="With stdin or stdout, flush output every this many bytes.",
+    )
+    parser.add_argument(
+        "--serve_socket",
+        type=str,
+        required=False,
+        help="Serve mangling requests on this Unix socket, keeping compiled "
+        "state warm between them.",
+    )
+    parser.add_argument(
+        "--serve_port",
+        type=int,
+        required=False,
+        help="Serve mangling requests on this localhost TCP port, keeping "
+        "compiled state warm between them. Only streamed lines are served.",
+    )
+    parser.add_argument(
+        "--serve_root",
+        type=str,
+        required=False,
+        help="Let requests on --serve_socket name input and output files "
+        "inside this directory.",
+    )
     args = parser.parse_args()
-    input_file = args.input
+    if args.pipeline and args.workers > 1:
+        parser.error("--pipeline cannot be combined with --workers")
+    serving = args.serve_socket is not None or args.serve_port is not None
+    if serving == (args.input is not None):
+        parser.error(
+            "Give either --input or one of --serve_socket and --serve_port"
+        )
+    if args.serve_root is not None and args.serve_socket is None:
+        parser.error("--serve_root needs --serve_socket")
+    input_file = args.input or ""
+    is_glob = any(char in input_file for char in "*?[")
+    batch = os.path.isdir(input_file) or (
+        is_glob and not os.path.isfile(input_file)
+    )
+    if batch and args.pipeline:
+        parser.error("--pipeline cannot be used with a directory or glob")
+    if batch and args.cache:
+        parser.error("--cache cannot be used with a directory or glob")
+    sharded = bool(args.shard_size or args.shard_lines)
+    if sharded and (batch or args.pipeline or args.cache):
+        parser.error(
+            "--shard_size and --shard_lines cannot be combined with a batch, "
+            "--pipeline or --cache"
+        )
+    if args.devices and (batch or sharded or args.pipeline or args.cache):
+        parser.error(
+            "--devices cannot be combined with a batch, sharding, --pipeline "
+            "or --cache"
+        )
+    if serving and (sharded or args.devices or args.pipeline or args.cache):
+        parser.error(
+            "Serving cannot be combined with sharding, --devices, --pipeline "
+            "or --cache"
+        )
+    piped = STDIO_PATH in (input_file, args.output)
+    exclusive = batch or sharded or args.devices or args.pipeline
+    if piped and (exclusive or args.cache or args.workers > 1):
+        parser.error(
+            "stdin or stdout cannot be combined with a batch, sharding, "
+            "--devices, --pipeline, --cache or --workers"
+        )
     output_file = args.output
+    if output_file is None:
+        output_file = "mangled_data" if batch else "mangled_data.jsonl"
+    # Keep messages out of the mangled data when it goes to stdout
+    log = sys.stderr if output_file == STDIO_PATH else sys.stdout
+    if sharded and detect_compression(output_file, "w"):
+        parser.error("Sharded output cannot be compressed")
+    if args.device_rules:
+        register_device_rules(load_device_rules(args.device_rules))
     # Get pointers from command line list and specified file
     pointers = args.pointers
     if args.pointer_file:
         with open(args.pointer_file, "r") as pf:
             pointers.extend([line.strip() for line in pf if line.strip()])
 
-    mangle_json_file(input_file, output_file, pointers)
+    hash_aliases = args.hash_aliases or bool(args.alias_key_file)
+    if hash_aliases and args.mapping_store:
+        parser.error("Hashed aliases cannot be combined with --mapping_store")
+    if not 1 <= args.alias_width <= 64:
+        parser.error("--alias_width must be from 1 to 64")
+
+    mapping_store = None
+    if args.mapping_store:
+        mapping_store = DeviceMappingStore(args.mapping_store)
+    elif hash_aliases:
+        mapping_store = HashMappingStore(
+            read_alias_key(args.alias_key_file), args.alias_width
+        )
+
+    cache = None
+    if args.cache:
+        cache = ResultCache(args.cache, args.cache_size * 2**20)
+
+    stats = MangleStats() if args.stats else None
+    profiler = nullcontext()
+    if args.profile:
+        profiler = profile_run(
+            args.profile,
+            "batch" if batch else input_file or "serve",
+            args.profile_keep,
+            args.profile_interval,
+        )
+    with profiler:
+        if batch:
+            input_dir, input_files = find_input_files(
+                input_file, exclude=output_file
+            )
+        else:
+            input_files = [input_file] if input_file else []
+            if input_file == STDIO_PATH:
+                input_files = []
+        device_paths = None
+        if args.device_paths:
+            device_paths = load_device_path_index(
+                args.device_paths, input_files, args.learn_lines
+            )
+        if serving:
+            service = MangleService(
+                mapping_store,
+                args.codec,
+                device_paths,
+                stats,
+                pointers,
+                flush_ms=args.flush_ms or DEFAULT_SERVER_FLUSH_MS,
+                serve_root=args.serve_root,
+            )
+            server = listen_socket(args.serve_socket, args.serve_port)
+            print(f"Serving on {server.getsockname()}", flush=True)
+            serve(service, server, args.workers)
+        elif batch:
+            mangled, skipped = mangle_json_files(
+                input_files,
+                input_dir,
+                output_file,
+                pointers,
+                args.workers,
+                mapping_store,
+                args.codec,
+                args.compress_level,
+                stats,
+                args.force,
+                device_paths,
+            )
+        elif piped:
+            mangle_json_stream(
+                input_file,
+                output_file,
+                pointers,
+                mapping_store,
+                args.codec,
+                args.compress_level,
+                stats,
+                device_paths,
+                args.flush_lines,
+                args.flush_ms,
+                args.flush_bytes,
+            )
+        elif sharded:
+            index_file = mangle_json_file_sharded(
+                input_file,
+                output_file,
+                pointers,
+                args.shard_size and args.shard_size * 2**20,
+                args.shard_lines,
+                args.workers,
+                mapping_store,
+                args.codec,
+                stats,
+                device_paths,
+            )
+        elif args.devices:
+            n_windows = mangle_json_file_windows(
+                input_file,
+                output_file,
+                pointers,
+                args.devices,
+                mapping_store,
+                args.codec,
+                args.compress_level,
+                stats,
+                device_paths,
+            )
+        elif args.pipeline:
+            import asyncio
+
+            asyncio.run(
+                mangle_json_file_async(
+                    input_file,
+                    output_file,
+                    pointers,
+                    mapping_store,
+                    args.codec,
+                    args.compress_level,
+                    stats,
+                    device_paths=device_paths,
+                    cache=cache,
+                )
+            )
+        else:
+            mangle_json_file(
+                input_file,
+                output_file,
+                pointers,
+                args.workers,
+                mapping_store,
+                args.codec,
+                args.compress_level,
+                stats,
+                device_paths,
+                cache,
+            )
 
-    print(f"Mangled data written to {output_file}")
+    if serving:
+        print("Server stopped")
+    elif batch:
+        print(
+            f"Mangled {mangled} files into {output_file}, "
+            f"skipped {skipped} up to date"
+        )
+    elif sharded:
+        print(f"Mangled data written to shards indexed in {index_file}")
+    elif args.devices:
+        print(f"Mangled {n_windows} Resync windows written to {output_file}")
+    else:
+        destination = "stdout" if output_file == STDIO_PATH else output_file
+        print(f"Mangled data written to {destination}", file=log)
+    if stats is not None:
+        report = json.dumps(stats.as_dict(), indent=2)
+        if args.stats == "-":
+            print(report, file=log)
+        else:
+            with open(args.stats, "w") as f:
+                f.write(report + "\n")
@@ -0,0 +1,246 @@
+"""Throughput and memory benchmarks for the filter_json stages.
+
+Not collected by default. Run explicitly with:
+
+    pytest test/benchmark_filter_json.py
+
+The corpus is configured with environment variables:
+
+    BENCH_LINES     Number of ObjectChanged lines (default 20000)
+    BENCH_DEVICES   Number of devices with start markers (default 200)
+    BENCH_POINTERS  Number of pointers to nullify (default 30)
+    BENCH_WORKERS   Workers for the end-to-end run (default 1)
+    BENCH_COLD_RUNS Fresh runs of filter_json.py to time (default 5)
+    BENCH_OUTPUT    JSON results file (default benchmark_results.json)
+
+Peak memory (peak_mb) is traced with tracemalloc in the benchmark process
+only. With more than one worker, the end-to-end run also reports
+worker_peak_rss_mb, the largest peak RSS of any child process that has
+exited so far, which is a worker unless the cold-start runs came first.
+"""
+import copy
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+from ..filter_json import (
+    get_device_mappings,
+    mangle_device_names,
+    mangle_json_file,
+    nullify_fields,
+    read_start_markers,
+)
+from .utils import make_api_response, make_test_cases
+
+BENCH_LINES = int(os.environ.get("BENCH_LINES", 20000))
+BENCH_DEVICES = int(os.environ.get("BENCH_DEVICES", 200))
+BENCH_POINTERS = int(os.environ.get("BENCH_POINTERS", 30))
+BENCH_WORKERS = int(os.environ.get("BENCH_WORKERS", 1))
+BENCH_COLD_RUNS = int(os.environ.get("BENCH_COLD_RUNS", 5))
+BENCH_OUTPUT = os.environ.get("BENCH_OUTPUT", "benchmark_results.json")
+
+# Device name used in the example_api_response fixture
+EXAMPLE_DEVICE = "URDELAB080"
+
+FILTER_JSON_SCRIPT = Path(__file__).parents[1] / "filter_json.py"
+
+
+def measure(fn, *args, copy_args=False):
+    """Time a call, then repeat it under tracemalloc for its peak memory.
+
+    Args:
+        copy_args (bool): Give each call its own deep copy of the arguments,
+                          made before the call is measured, for functions
+                          that change their arguments in place.
+
+    Returns:
+        tuple: The result of the call, the elapsed seconds and the peak
+               traced memory in bytes.
+    """
+    call_args = copy.deepcopy(args) if copy_args else args
+    start = time.perf_counter()
+    result = fn(*call_args)
+    elapsed = time.perf_counter() - start
+    call_args = copy.deepcopy(args) if copy_args else args
+    tracemalloc.start()
+    fn(*call_args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def cold_start(argv, stats_file, runs):
+    """Time fresh runs of filter_json.py from process start to first output.
+
+    Each run starts a new interpreter, so imports, compilation and the
+    device mapping are included in the times.
+
+    Returns:
+        dict: The seconds from starting each process to its first output
+              line and to its exit, and their medians.
+    """
+    first_output, exited = [], []
+    for _ in range(runs):
+        started = time.time()
+        subprocess.run(
+            [sys.executable, FILTER_JSON_SCRIPT, *argv, "--stats", stats_file],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        exited.append(time.time() - started)
+        with open(stats_file, "r") as f:
+            first_output_at = json.load(f)["first_output_at"]
+        if first_output_at is not None:
+            first_output.append(first_output_at - started)
+    return {
+        "runs": runs,
+        "first_output_seconds": [round(t, 4) for t in first_output],
+        "exit_seconds": [round(t, 4) for t in exited],
+        "median_first_output_seconds": (
+            round(statistics.median(first_output), 4)
+            if first_output
+            else None
+        ),
+        "median_exit_seconds": round(statistics.median(exited), 4),
+    }
+
+
+@pytest.fixture(scope="session")
+def bench_results():
+    results = {}
+    yield results
+    report = {
+        "params": {
+            "lines": BENCH_LINES,
+            "devices": BENCH_DEVICES,
+            "pointers": BENCH_POINTERS,
+            "workers": BENCH_WORKERS,
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+    with open(BENCH_OUTPUT, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+@pytest.fixture(scope="session")
+def bench_corpus(tmp_path_factory):
+    """Write a corpus of start markers and ObjectChanged lines to disk.
+
+    Returns:
+        tuple: The corpus path, its entries and the pointers to nullify.
+    """
+    # Build the base line from the example_api_response fixture's shape
+    base = make_api_response()
+    pointers = []
+    for i in range(BENCH_POINTERS):
+        if i % 2:
+            base["event"]["object_data"][f"secret{i}"] = {"info": "x"}
+            pointers.append(f"secret{i}.info")
+        else:
+            base["event"]["object_data"][f"secret{i}"] = "x"
+            pointers.append(f"secret{i}")
+    base_str = json.dumps(base, separators=(",", ":"))
+
+    devices = [f"BENCHLAB{i:05}" for i in range(BENCH_DEVICES)]
+    markers, _ = make_test_cases(
+        [(f"MD=CISCO_EPNM!ND={device}", "") for device in devices]
+    )
+    lines = [json.dumps(marker, separators=(",", ":")) for marker in markers]
+    lines += [
+        base_str.replace(EXAMPLE_DEVICE, devices[i % BENCH_DEVICES])
+        for i in range(BENCH_LINES)
+    ]
+
+    corpus = tmp_path_factory.mktemp("bench") / "corpus.jsonl"
+    corpus.write_text("\n".join(lines) + "\n")
+    entries = [json.loads(line) for line in lines]
+    return corpus, entries, pointers
+
+
+def record(results, stage, corpus, n_lines, elapsed, peak):
+    size_mb = corpus.stat().st_size / 1e6
+    results[stage] = {
+        "seconds": round(elapsed, 4),
+        "lines_per_s": round(n_lines / elapsed, 1),
+        "mb_per_s": round(size_mb / elapsed, 2),
+        "peak_mb": round(peak / 1e6, 2),
+    }
+
+
+def test_bench_read_start_markers(bench_corpus, bench_results):
+    corpus, entries, _ = bench_corpus
+    markers, elapsed, peak = measure(read_start_markers, corpus)
+    assert len(markers) == BENCH_DEVICES
+    record(
+        bench_results, "read_start_markers", corpus, len(entries), elapsed, peak
+    )
+
+
+def test_bench_get_device_mappings(bench_corpus, bench_results):
+    corpus, entries, _ = bench_corpus
+    markers = entries[:BENCH_DEVICES]
+    mappings, elapsed, peak = measure(get_device_mappings, markers)
+    assert len(mappings) == BENCH_DEVICES
+    record(
+        bench_results, "get_device_mappings", corpus, len(entries), elapsed, peak
+    )
+
+
+def test_bench_mangle_device_names(bench_corpus, bench_results):
+    corpus, entries, _ = bench_corpus
+    mappings = get_device_mappings(entries[:BENCH_DEVICES])
+    _, elapsed, peak = measure(mangle_device_names, entries, mappings)
+    record(
+        bench_results, "mangle_device_names", corpus, len(entries), elapsed, peak
+    )
+
+
+def test_bench_nullify_fields(bench_corpus, bench_results):
+    corpus, entries, pointers = bench_corpus
+    _, elapsed, peak = measure(
+        nullify_fields, entries, pointers, copy_args=True
+    )
+    record(
+        bench_results, "nullify_fields", corpus, len(entries), elapsed, peak
+    )
+
+
+def test_bench_mangle_json_file(bench_corpus, bench_results, tmp_path):
+    corpus, entries, pointers = bench_corpus
+    output = tmp_path / "output.jsonl"
+    _, elapsed, peak = measure(
+        mangle_json_file, corpus, output, pointers, BENCH_WORKERS
+    )
+    record(
+        bench_results, "mangle_json_file", corpus, len(entries), elapsed, peak
+    )
+    if BENCH_WORKERS > 1 and resource is not None:
+        # Reported in bytes on macOS and in kilobytes elsewhere
+        worker_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if sys.platform != "darwin":
+            worker_peak *= 1024
+        bench_results["mangle_json_file"]["worker_peak_rss_mb"] = round(
+            worker_peak / 1e6, 2
+        )
+
+
+def test_bench_cold_start(bench_corpus, bench_results, tmp_path):
+    corpus, _, pointers = bench_corpus
+    argv = ["-i", corpus, "-o", tmp_path / "output.jsonl", "-p", *pointers]
+    report = cold_start(argv, tmp_path / "stats.json", BENCH_COLD_RUNS)
+    assert len(report["first_output_seconds"]) == BENCH_COLD_RUNS
+    bench_results["cold_start"] = report
@@ -1,4 +1,59 @@
-from ..filter_json import mangle_device_names, get_device_mappings, nullify_fields
+import asyncio
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from ..filter_json import (
+    BATCH_MANIFEST,
+    mangle_device_names,
+    get_device_mappings,
+    nullify_fields,
+    mangle_entries,
+    mangle_json_file,
+    replace_device_names,
+    compile_nullify_plan,
+    split_line_ranges,
+    mangle_json_file_tail,
+    DeviceMappingStore,
+    HashMappingStore,
+    index_start_markers,
+    read_device_mappings,
+    get_json_codec,
+    mangle_lines,
+    open_jsonl,
+    MangleStats,
+    profile_run,
+    mangle_json_file_async,
+    mangle_json_file_tail_async,
+    mangle_lines_pipeline,
+    find_input_files,
+    mangle_json_files,
+    learn_device_paths,
+    compile_device_path_index,
+    replace_device_paths,
+    extract_device_names,
+    extract_device_name,
+    load_device_rules,
+    register_device_rules,
+    ResultCache,
+    mangle_json_file_sharded,
+    iter_device_lines,
+    index_resync_windows,
+    load_resync_windows,
+    mangle_json_file_windows,
+    MangleService,
+    listen_socket,
+    serve,
+    BatchedWriter,
+    mangle_json_stream,
+)
 from .utils import make_test_cases
 
 
@@ -33,3 +88,997 @@ def test_auto_generate_example(example_device_pairs):
 def test_nullify_fields(example_nested_data, example_null_data, example_pointers):
     output_data = nullify_fields(example_nested_data, example_pointers)
     assert output_data == example_null_data
+
+
+def test_compile_nullify_plan(example_pointers):
+    plan = compile_nullify_plan(example_pointers)
+    # Leaves of the trie hold the pointer that nullifies them
+    assert plan.trie == {
+        "secret-info": "secret-info",
+        "secret": {"info": "secret.info"},
+    }
+    assert plan.expressions == []
+
+    # "secret" nullifies all of "secret", so "secret.info" is folded under
+    # it, whichever of the two comes first
+    for pointers in (
+        example_pointers + ["secret", "list[0]"],
+        ["secret", "list[0]"] + example_pointers,
+    ):
+        plan = compile_nullify_plan(pointers)
+        assert plan.trie == {"secret-info": "secret-info", "secret": "secret"}
+        assert [pointer for pointer, _ in plan.expressions] == ["list[0]"]
+
+
+def test_nullify_fields_complex_pointer(example_nested_data):
+    output_data = nullify_fields(example_nested_data, ["public.'info'"])
+    assert output_data[4]["event"]["object_data"]["secret"] == {
+        "info": "Make sure to nullify this data!",
+        "public": {"info": ""},
+    }
+
+
+def test_replace_device_names_whole_names_only():
+    device_mappings = {
+        "URDELAB08": "DEVICE-001",
+        "URDELAB080": "DEVICE-002",
+        "DEVICE-002": "DEVICE-003",
+    }
+    text = "MD=CISCO_EPNM!ND=URDELAB080!CTP=x MD=CISCO_EPNM!ND=URDELAB08 URDELAB0800"
+    assert replace_device_names(text, device_mappings) == (
+        "MD=CISCO_EPNM!ND=DEVICE-002!CTP=x MD=CISCO_EPNM!ND=DEVICE-001 URDELAB0800"
+    )
+
+
+def test_mangle_entries_is_lazy(example_jsonl_data, example_device_mappings):
+    entries = iter(example_jsonl_data)
+    stream = mangle_entries(entries, example_device_mappings, [])
+    first = next(stream)
+    assert first["event"]["properties"]["device"] == "MD=CISCO_EPNM!ND=DEVICE-001"
+    # Only the first entry has been consumed from the source
+    assert len(list(entries)) == len(example_jsonl_data) - 1
+
+
+def test_mangle_json_file(tmp_path, example_device_pairs):
+    input_data, expected_data = make_test_cases(example_device_pairs)
+    input_file = tmp_path / "input.jsonl"
+    output_file = tmp_path / "output.jsonl"
+    with open(input_file, "w") as f:
+        for entry in input_data:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    mangle_json_file(input_file, output_file, [])
+
+    with open(output_file) as f:
+        assert [json.loads(line) for line in f] == expected_data
+
+
+def test_split_line_ranges(tmp_path):
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text("".join(f'{{"line":{i}}}\n' for i in range(10)))
+    ranges = split_line_ranges(input_file, 4)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == input_file.stat().st_size
+    content = input_file.read_bytes()
+    for start, end in ranges:
+        assert content[start:end].endswith(b"\n")
+    # More ranges than lines are never returned
+    assert len(split_line_ranges(input_file, 50)) == 10
+
+
+def test_mangle_json_file_parallel(
+    tmp_path, example_device_pairs, example_api_response, example_pointers
+):
+    input_data, _ = make_test_cases(example_device_pairs)
+    input_file = tmp_path / "input.jsonl"
+    with open(input_file, "w") as f:
+        for entry in input_data + [example_api_response] * 20:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    mangle_json_file(input_file, tmp_path / "serial.jsonl", example_pointers)
+    mangle_json_file(
+        input_file, tmp_path / "parallel.jsonl", example_pointers, workers=3
+    )
+
+    serial = (tmp_path / "serial.jsonl").read_bytes()
+    assert (tmp_path / "parallel.jsonl").read_bytes() == serial
+
+
+def test_mangle_json_file_tail(
+    tmp_path, example_device_pairs, example_api_response, example_pointers
+):
+    input_data, _ = make_test_cases(example_device_pairs)
+    lines = [
+        json.dumps(entry, separators=(",", ":")) + "\n"
+        for entry in input_data + [example_api_response] * 3
+    ]
+    input_file = tmp_path / "input.jsonl"
+    tail_output = tmp_path / "tail.jsonl"
+    device_mappings = {}
+
+    # Write the first half plus a partial line, then append the rest
+    input_file.write_text("".join(lines[:3]) + lines[3][:10])
+    offset = mangle_json_file_tail(
+        input_file, tail_output, example_pointers, 0, device_mappings
+    )
+    assert offset == len("".join(lines[:3]))
+    assert len(device_mappings) == 3
+    input_file.write_text("".join(lines))
+    offset = mangle_json_file_tail(
+        input_file, tail_output, example_pointers, offset, device_mappings
+    )
+    assert offset == input_file.stat().st_size
+
+    mangle_json_file(input_file, tmp_path / "full.jsonl", example_pointers)
+    assert tail_output.read_bytes() == (tmp_path / "full.jsonl").read_bytes()
+
+    # A last line without a newline is kept back until it is asked for and
+    # whole, and the newline that may follow it later is skipped
+    last = lines[-1].rstrip("\n")
+    input_file.write_text("".join(lines) + last[:10])
+    args = (input_file, tail_output, example_pointers)
+    assert mangle_json_file_tail(*args, offset, device_mappings) == offset
+    assert mangle_json_file_tail(
+        *args, offset, device_mappings, partial_line=True
+    ) == offset
+    input_file.write_text("".join(lines) + last)
+    offset = mangle_json_file_tail(
+        *args, offset, device_mappings, partial_line=True
+    )
+    assert offset == input_file.stat().st_size
+    input_file.write_text("".join(lines) + lines[-1] + lines[-1])
+    offset = mangle_json_file_tail(*args, offset, device_mappings)
+    assert offset == input_file.stat().st_size
+    mangle_json_file(input_file, tmp_path / "full.jsonl", example_pointers)
+    assert tail_output.read_bytes() == (tmp_path / "full.jsonl").read_bytes()
+
+    # Resuming in the middle of a line, as after a rewrite, is refused
+    with pytest.raises(ValueError, match="line boundary"):
+        mangle_json_file_tail(*args, 10, {})
+
+
+def test_device_mapping_store(tmp_path, example_device_pairs):
+    markers, _ = make_test_cases(example_device_pairs)
+    store_file = str(tmp_path / "devices.db")
+
+    store = DeviceMappingStore(store_file)
+    assert store.add_markers(markers[1:]) == {
+        "URZELAB077": "DEVICE-001",
+        "USMDF-007": "DEVICE-002",
+    }
+
+    # A second store on the same file sees existing aliases and extends them
+    other_store = DeviceMappingStore(store_file)
+    assert other_store.add_markers(markers) == {
+        "URZELAB077": "DEVICE-001",
+        "USMDF-007": "DEVICE-002",
+        "UNCERTO030-Lab4206-C": "DEVICE-003",
+    }
+    assert store.refresh() == other_store.mappings
+
+    # Stores hand out snapshots that other threads cannot change
+    mappings = store.refresh()
+    store.add_devices(["URDELAB080"])
+    assert "URDELAB080" not in mappings
+    store.close()
+    other_store.close()
+
+
+def test_hash_mapping_store(tmp_path, monkeypatch, example_device_pairs):
+    from .. import filter_json
+
+    markers, _ = make_test_cases(example_device_pairs)
+
+    # Aliases do not depend on the order or set of devices seen
+    store = HashMappingStore(b"secret", width=8)
+    mappings = dict(store.add_markers(markers))
+    assert mappings == HashMappingStore(b"secret", 8).add_markers(markers[::-1])
+    assert all(re.fullmatch(r"DEVICE-[0-9a-f]{8}", a) for a in mappings.values())
+    assert HashMappingStore(b"other", 8).add_markers(markers) != mappings
+    assert store.add_devices(["URZELAB077"]) == mappings
+    store.add_devices(["URDELAB080"])
+    assert "URDELAB080" not in mappings
+
+    # A one-digit alias space cannot hold 17 devices
+    with pytest.raises(ValueError, match="both hash to"):
+        HashMappingStore(width=1).add_devices(f"D{i}" for i in range(17))
+
+    input_file = tmp_path / "input.jsonl"
+    with open(input_file, "w") as f:
+        for entry in markers:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    output_file = tmp_path / "output.jsonl"
+    # Start markers are aliased as they are read, not in a pre-pass
+    monkeypatch.setattr(filter_json, "read_start_markers", None)
+    mangle_json_file(
+        input_file, output_file, [], mapping_store=HashMappingStore(b"secret", 8)
+    )
+    output = output_file.read_text()
+    assert all(alias in output for alias in mappings.values())
+
+
+def test_index_start_markers(tmp_path, example_device_pairs, example_api_response):
+    markers, _ = make_test_cases(example_device_pairs)
+    lines = [
+        json.dumps(entry, separators=(",", ":")) + "\n"
+        for entry in [example_api_response, *markers, example_api_response]
+    ]
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text("".join(lines))
+
+    index = index_start_markers(input_file)
+    assert [marker.entry for marker in index] == markers
+    content = input_file.read_bytes()
+    for marker in index:
+        line = content[marker.offset:marker.offset + marker.length]
+        assert json.loads(line) == marker.entry
+    assert read_device_mappings(input_file) == get_device_mappings(markers)
+
+
+def test_extract_device_names(example_device_pairs, example_jsonl_data):
+    from jsonpath_ng import parse
+
+    markers, _ = make_test_cases(example_device_pairs)
+    nested = {"a": [example_jsonl_data, {"properties": {"device": "X"}}]}
+    expr = parse("$..properties.device")
+    for entries in (markers, example_jsonl_data, [nested]):
+        expected = [
+            match.value for entry in entries for match in expr.find(entry)
+        ]
+        names = list(extract_device_names(entries))
+        assert len(names) == len(expected)
+        assert all(value.endswith(name) for name, value in zip(names, expected))
+
+
+def test_device_rules(tmp_path, monkeypatch):
+    from .. import filter_json
+
+    # Keep the rules registered here from leaking into other tests
+    monkeypatch.setattr(filter_json, "DEVICE_RULES", list(filter_json.DEVICE_RULES))
+    monkeypatch.setattr(
+        filter_json, "_device_rules_pattern", filter_json._device_rules_pattern
+    )
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(
+        json.dumps([{"vendor": "MD=JUNIPER", "key": "NE", "chars": "[\\w.]"}])
+    )
+    register_device_rules(load_device_rules(rules_file))
+    values = {
+        "MD=CISCO_EPNM!ND=URDELAB080": "URDELAB080",
+        "MD=JUNIPER!SITE=x!NE=core1.lab!PORT=2": "core1.lab",
+        "MD=JUNIPER!ND=URDELAB081": "URDELAB081",
+        "MD=OTHER!NE=core2.lab": "MD=OTHER!NE=core2.lab",
+        "USMDF-007": "USMDF-007",
+    }
+    assert {value: extract_device_name(value) for value in values} == values
+
+    rules_file.write_text(json.dumps([{"vendor": "", "key": "NE", "chars": "(x)"}]))
+    with pytest.raises(ValueError, match="capturing group"):
+        load_device_rules(rules_file)
+
+
+def test_lazy_imports():
+    # Short runs should not pay for modules that only some runs need
+    code = (
+        "import sys, filter_json; "
+        "print(sorted({'asyncio', 'jsonpath_ng', 'sqlite3'} & set(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "[]"
+
+
+@pytest.mark.parametrize("codec", ["json", "orjson"])
+def test_json_codec_compact(codec, example_api_response):
+    pytest.importorskip(codec)
+    json_codec = get_json_codec(codec)
+    line = json_codec.dumps(example_api_response)
+    assert line == json.dumps(example_api_response, separators=(",", ":"))
+    # Spaces inside values are kept
+    assert '"layer termination cannot terminate"' in line
+    assert json_codec.loads(line) == example_api_response
+
+
+def test_json_codec_default():
+    # orjson is only used when asked for, even where it is installed
+    assert get_json_codec().name == "json"
+    with pytest.raises(ValueError, match="Unknown JSON codec"):
+        get_json_codec("auto")
+
+
+@pytest.mark.parametrize("codec", ["json", "orjson"])
+def test_json_codec_big_int(codec):
+    pytest.importorskip(codec)
+    json_codec = get_json_codec(codec)
+    line = '{"a":123456789012345678901234,"b":[-98765432109876543210],"c":1}'
+    assert json_codec.dumps(json_codec.loads(line)) == line
+    assert json_codec.loads(line)["a"] == 123456789012345678901234
+
+
+def test_mangle_lines_passthrough(
+    example_device_pairs, example_api_response, example_pointers
+):
+    markers, _ = make_test_cases(example_device_pairs)
+    device_mappings = get_device_mappings(markers)
+    unknown_device = make_response_line(example_api_response, "OTHERLAB01")
+    lines = [
+        json.dumps(entry, separators=(",", ":")) + "\n" for entry in markers
+    ] + [
+        unknown_device,
+        unknown_device.replace(",", ", "),
+        unknown_device.replace('"version":1', '"version":1.0e0'),
+        make_response_line(example_api_response, "URZELAB077"),
+    ]
+    assert list(
+        mangle_lines(lines, device_mappings, example_pointers)
+    ) == list(
+        mangle_lines(
+            lines, device_mappings, example_pointers, passthrough=False
+        )
+    )
+
+    # Lines that cannot change are still checked to be valid JSON
+    for line in ['{"a":1\n', "garbage\n", '{"b":[1,2}\n']:
+        for stats in (None, MangleStats()):
+            with pytest.raises(ValueError):
+                list(mangle_lines([line], {}, [], stats=stats))
+    # and repeated keys are resolved as the decoder does
+    line = '{"a":1,"a":2}\n'
+    assert list(mangle_lines([line], {}, [])) == ['{"a":2}\n']
+
+
+def make_response_line(response, device):
+    line = json.dumps(response, separators=(",", ":"))
+    return line.replace("URDELAB080", device) + "\n"
+
+
+def test_hash_aliases_mid_resync(tmp_path, monkeypatch, example_api_response):
+    from .. import filter_json
+
+    # A piece of a dump that starts after the start markers of its devices
+    devices = ["URZELAB077", "URDELAB080", "ABC-1"]
+    input_file = tmp_path / "piece.jsonl"
+    input_file.write_text(
+        "".join(make_response_line(example_api_response, d) for d in devices * 3)
+    )
+    aliases = HashMappingStore(b"secret", 8).add_devices(devices)
+    # Hashed aliases need no scan for start markers
+    monkeypatch.setattr(filter_json, "read_start_markers", None)
+
+    for workers in (1, 2):
+        output_file = tmp_path / f"output-{workers}.jsonl"
+        mangle_json_file(
+            input_file,
+            output_file,
+            [],
+            workers=workers,
+            mapping_store=HashMappingStore(b"secret", 8),
+        )
+        output = output_file.read_text()
+        assert not any(device in output for device in devices)
+        assert all(output.count(alias) for alias in aliases.values())
+
+    # Devices aliased on the fly are indexed in the shards too
+    index_file = mangle_json_file_sharded(
+        input_file,
+        tmp_path / "sharded.jsonl",
+        [],
+        shard_lines=2,
+        workers=2,
+        mapping_store=HashMappingStore(b"secret", 8),
+    )
+    lines = list(iter_device_lines(index_file, aliases["ABC-1"]))
+    assert len(lines) == 3
+    assert all(aliases["ABC-1"] in line for line in lines)
+
+    # Without hashed aliases, only the start markers name devices
+    monkeypatch.undo()
+    mangle_json_file(input_file, tmp_path / "plain.jsonl", [])
+    assert "URZELAB077" in (tmp_path / "plain.jsonl").read_text()
+
+
+def test_device_paths(example_device_pairs, example_api_response):
+    markers, _ = make_test_cases(example_device_pairs)
+    device_mappings = get_device_mappings(markers)
+    lines = [
+        json.dumps(entry, separators=(",", ":")) + "\n" for entry in markers
+    ] + [make_response_line(example_api_response, "URZELAB077")]
+    paths = learn_device_paths(
+        [json.loads(line) for line in lines], device_mappings
+    )
+    assert "event.object_id" in paths["bp.v1.ObjectChanged"]
+    assert (
+        "event.object_data.properties.data.attributes.locations[].neName"
+        in paths["bp.v1.ObjectChanged"]
+    )
+    assert paths["bp.v2.ResyncMarker"] == [
+        "event.marker_scope.filterParam.properties.device"
+    ]
+
+    # Replacing only at the learned paths gives the same output
+    index = compile_device_path_index(paths)
+    assert list(
+        mangle_lines(lines, device_mappings, [], device_paths=index)
+    ) == list(mangle_lines(lines, device_mappings, []))
+
+    # Devices outside the learned paths are still replaced, such as in a
+    # field the sample did not have or under a key the paths cannot name
+    for key in ("other", "tp.x"):
+        entry = json.loads(lines[-1])
+        entry["event"][key] = "URZELAB077"
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        output = list(
+            mangle_lines([line], device_mappings, [], device_paths=index)
+        )
+        assert "URZELAB077" not in output[0]
+        assert output == list(mangle_lines([line], device_mappings, []))
+
+    # Other values are left alone, and unindexed types are fully replaced
+    index = compile_device_path_index(
+        {"bp.v1.ObjectChanged": ["event.object_data.properties.*"]}
+    )
+    entry = json.loads(lines[-1])
+    assert replace_device_paths(entry, index, device_mappings)
+    device = entry["event"]["object_data"]["properties"]["device"]
+    assert device == "MD=CISCO_EPNM!ND=" + device_mappings["URZELAB077"]
+    assert "URZELAB077" in entry["event"]["object_id"]
+    assert not replace_device_paths(json.loads(lines[0]), index, {})
+    marker_line = list(
+        mangle_lines(lines[:1], device_mappings, [], device_paths=index)
+    )[0]
+    assert marker_line == list(mangle_lines(lines[:1], device_mappings, []))[0]
+
+    # A type first sampled without a device is not learned as having none
+    sample = [json.loads(make_response_line(example_api_response, "other"))]
+    assert learn_device_paths(sample, device_mappings) == {}
+    index = compile_device_path_index({"bp.v1.ObjectChanged": []})
+    assert list(
+        mangle_lines(lines[-1:], device_mappings, [], device_paths=index)
+    ) == list(mangle_lines(lines[-1:], device_mappings, []))
+    assert "URZELAB077" not in list(
+        mangle_lines(lines[-1:], device_mappings, [], device_paths=index)
+    )[0]
+
+    with pytest.raises(ValueError):
+        compile_device_path_index({"bp.v1.ObjectChanged": ["event..id"]})
+
+
+def test_mangle_json_file_stats(
+    tmp_path, example_device_pairs, example_nested_data, example_pointers
+):
+    input_data, _ = make_test_cases(example_device_pairs)
+    input_file = tmp_path / "input.jsonl"
+    with open(input_file, "w") as f:
+        for entry in input_data + example_nested_data * 10:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    n_lines = len(input_data) + len(example_nested_data) * 10
+
+    mangle_json_file(input_file, tmp_path / "plain.jsonl", example_pointers)
+    results = {}
+    for workers in (1, 3):
+        stats = MangleStats()
+        output_file = tmp_path / f"output{workers}.jsonl"
+        mangle_json_file(
+            input_file, output_file, example_pointers, workers, stats=stats
+        )
+        # Collecting stats does not change the output
+        assert output_file.read_bytes() == (tmp_path / "plain.jsonl").read_bytes()
+        assert stats.counts["lines"] == n_lines
+        assert stats.counts["bytes_read"] == input_file.stat().st_size
+        assert stats.counts["bytes_written"] == output_file.stat().st_size
+        assert stats.timings["total"] > 0
+        results[workers] = stats
+
+    serial, parallel = results[1], results[3]
+    assert serial.first_output_at is not None
+    assert sum(serial.replacements.values()) > 0
+    assert set(serial.nullified) == set(example_pointers)
+    assert parallel.counts == serial.counts
+    assert parallel.replacements == serial.replacements
+    assert parallel.nullified == serial.nullified
+    report = serial.as_dict()
+    assert json.loads(json.dumps(report))["counts"]["lines"] == n_lines
+    assert f"filter_json_lines_total {n_lines}\n" in serial.to_prometheus()
+
+
+def test_result_cache(
+    tmp_path, example_device_pairs, example_nested_data, example_pointers
+):
+    input_data, _ = make_test_cases(example_device_pairs)
+    input_file = tmp_path / "input.jsonl"
+    with open(input_file, "w") as f:
+        for entry in input_data + example_nested_data:
+            f.write(json.dumps(entry) + "\n")
+    mangle_json_file(input_file, tmp_path / "plain.jsonl", example_pointers)
+    expected = (tmp_path / "plain.jsonl").read_bytes()
+
+    cache = ResultCache(str(tmp_path / "cache"))
+    outcomes = []
+    for i, pointers in enumerate([example_pointers, example_pointers, []]):
+        stats = MangleStats()
+        output_file = tmp_path / f"output{i}.jsonl"
+        mangle_json_file(
+            input_file, output_file, pointers, stats=stats, cache=cache
+        )
+        outcomes.append(stats.counts["cache_hits"])
+        if pointers:
+            assert output_file.read_bytes() == expected
+    # Only the same content with the same pointers is reused
+    assert outcomes == [0, 1, 0]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # Least recently used outputs are evicted past the size limit
+    size = len(expected)
+    cache = ResultCache(str(tmp_path / "lru"), max_bytes=2 * size)
+    for key in "abc":
+        cache.put(key, tmp_path / "plain.jsonl")
+        if key == "b":
+            assert cache.get("a", tmp_path / "copy.jsonl")
+    assert cache.get("a", tmp_path / "copy.jsonl")
+    assert not cache.get("b", tmp_path / "copy.jsonl")
+    assert cache.get("c", tmp_path / "copy.jsonl")
+    assert sorted(os.listdir(tmp_path / "lru")) == ["a.out", "c.out"]
+
+
+def test_mangle_json_file_sharded(
+    tmp_path, example_device_pairs, example_nested_data, example_pointers
+):
+    input_data, _ = make_test_cases(example_device_pairs)
+    input_file = tmp_path / "input.jsonl"
+    with open(input_file, "w") as f:
+        for entry in (input_data + example_nested_data) * 5:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    mangle_json_file(input_file, tmp_path / "plain.jsonl", example_pointers)
+    expected = (tmp_path / "plain.jsonl").read_text().splitlines(True)
+
+    for workers in (1, 3):
+        output_dir = tmp_path / f"sharded{workers}"
+        index_file = mangle_json_file_sharded(
+            input_file,
+            output_dir / "out.jsonl",
+            example_pointers,
+            shard_lines=7,
+            workers=workers,
+        )
+        with open(index_file) as f:
+            index = json.load(f)
+        lines = [
+            line
+            for shard in index["shards"]
+            for line in (output_dir / shard).read_text().splitlines(True)
+        ]
+        assert lines == expected
+        assert all(
+            len((output_dir / shard).read_text().splitlines()) <= 7
+            for shard in index["shards"]
+        )
+        # Each device's ranges hold exactly the lines that name it
+        assert index["devices"]
+        for alias in index["devices"]:
+            assert list(iter_device_lines(index_file, alias)) == [
+                line for line in lines if re.search(rf"{alias}\b", line)
+            ]
+
+
+def test_mangle_json_file_windows(
+    tmp_path,
+    monkeypatch,
+    example_device_pairs,
+    example_api_response,
+    example_pointers,
+):
+    from .. import filter_json
+
+    markers, _ = make_test_cases(example_device_pairs)
+    devices = list(extract_device_names(markers))
+    lines = []
+    for i, (marker, device) in enumerate(zip(markers, devices)):
+        lines.append(json.dumps(marker, separators=(",", ":")) + "\n")
+        lines += [make_response_line(example_api_response, device)] * 2
+        if i < len(markers) - 1:
+            # The last window is left open until the end of the file
+            end = {**marker, "event": {**marker["event"], "marker_type": "end"}}
+            lines.append(json.dumps(end, separators=(",", ":")) + "\n")
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text("".join(lines))
+
+    windows = load_resync_windows(str(input_file))
+    assert [window.device for window in windows] == devices
+    assert windows[-1].end == input_file.stat().st_size
+    assert (tmp_path / "input.jsonl.windows.json").exists()
+    assert load_resync_windows(str(input_file)) == windows
+    assert index_resync_windows(str(input_file)) == windows
+    index = json.loads((tmp_path / "input.jsonl.windows.json").read_text())
+    assert index["devices"] == devices
+
+    mangle_json_file(input_file, tmp_path / "full.jsonl", example_pointers)
+    full = (tmp_path / "full.jsonl").read_text().splitlines(True)
+    output_file = tmp_path / "output.jsonl"
+    # The device mapping is rebuilt from the index, not from another scan
+    monkeypatch.setattr(filter_json, "read_start_markers", None)
+    n_windows = mangle_json_file_windows(
+        str(input_file), output_file, example_pointers, [devices[1]]
+    )
+    assert n_windows == 1
+    assert output_file.read_text().splitlines(True) == full[4:8]
+
+
+def request_server(address, request, data=b""):
+    import socket
+
+    if isinstance(address, str):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(address)
+    else:
+        conn = socket.create_connection(address)
+    with conn:
+        conn.sendall(json.dumps(request).encode() + b"\n")
+
+        def send():
+            try:
+                conn.sendall(data)
+                conn.shutdown(socket.SHUT_WR)
+            except (BrokenPipeError, ConnectionResetError):
+                # The server closes early when it rejects the request
+                pass
+
+        # Send while reading, as the server streams lines back meanwhile
+        sender = threading.Thread(target=send)
+        sender.start()
+        chunks = []
+        while chunk := conn.recv(65536):
+            chunks.append(chunk)
+        sender.join()
+    return b"".join(chunks).decode()
+
+
+def test_mangle_service(
+    tmp_path, example_device_pairs, example_api_response, example_pointers
+):
+    markers, _ = make_test_cases(example_device_pairs)
+    lines = []
+    for marker, device in zip(markers, extract_device_names(markers)):
+        lines.append(json.dumps(marker, separators=(",", ":")) + "\n")
+        lines += [make_response_line(example_api_response, device)] * 100
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text("".join(lines))
+    mangle_json_file(input_file, tmp_path / "full.jsonl", example_pointers)
+    expected = (tmp_path / "full.jsonl").read_text()
+
+    service = MangleService(stats=MangleStats(), serve_root=str(tmp_path))
+    server = listen_socket(port=0)
+    socket_path = str(tmp_path / "mangle.sock")
+    unix_server = listen_socket(socket_path)
+    assert os.stat(socket_path).st_mode & 0o777 == 0o600
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=serve, args=(service, s, 2, stop))
+        for s in (server, unix_server)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        address = server.getsockname()
+        # Devices are learned from the stream's markers as they arrive
+        request = {"pointers": example_pointers}
+        data = input_file.read_bytes()
+        assert request_server(address, request, data) == expected
+
+        # Lines are sent back while the client keeps its stream open
+        import socket
+
+        with socket.create_connection(address) as conn:
+            conn.sendall((json.dumps(request) + "\n" + "".join(lines[:2])).encode())
+            conn.settimeout(5)
+            received = b""
+            while received.count(b"\n") < 2:
+                received += conn.recv(65536)
+        assert received.decode() == "".join(expected.splitlines(True)[:2])
+
+        # Files are not served over TCP, where any local user can connect
+        reply = request_server(address, {"input": str(input_file)})
+        assert "PermissionError" in json.loads(reply)["error"]
+
+        # Concurrent clients share the warm mapping and plans
+        results = [None] * 4
+
+        def run(i):
+            request = {"input": "input.jsonl", "pointers": example_pointers}
+            results[i] = request_server(socket_path, request)
+
+        clients = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        assert results == [expected] * 4
+        assert len(service._plans) == 1
+
+        output_file = tmp_path / "output.jsonl"
+        request["output"] = str(output_file)
+        reply = request_server(socket_path, {"input": str(input_file), **request})
+        assert json.loads(reply) == {"output": str(output_file)}
+        assert output_file.read_text() == expected
+        reply = request_server(socket_path, {"input": str(tmp_path / "missing")})
+        assert "FileNotFoundError" in json.loads(reply)["error"]
+        # Paths must stay inside the serve root
+        for path in ("../input.jsonl", "/etc/passwd", 5):
+            reply = request_server(socket_path, {"input": path})
+            assert "error" in json.loads(reply)
+        reply = request_server(socket_path, {"output": "../out.jsonl"})
+        assert "PermissionError" in json.loads(reply)["error"]
+        for bad_request in ({"pointers": 5}, {"pointers": ["$[?"]}, []):
+            reply = request_server(address, bad_request)
+            assert "error" in json.loads(reply)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert not os.path.exists(socket_path)
+    assert service.stats.counts["lines"] == len(lines) * 6 + 2
+
+
+def test_mangle_json_stream(
+    tmp_path,
+    monkeypatch,
+    example_device_pairs,
+    example_api_response,
+    example_pointers,
+):
+    markers, _ = make_test_cases(example_device_pairs)
+    lines = []
+    for marker, device in zip(markers, extract_device_names(markers)):
+        lines.append(json.dumps(marker, separators=(",", ":")) + "\n")
+        lines += [make_response_line(example_api_response, device)] * 10
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text("".join(lines))
+    mangle_json_file(input_file, tmp_path / "full.jsonl", example_pointers)
+    expected = (tmp_path / "full.jsonl").read_text()
+
+    # Devices are aliased as their start markers arrive on stdin
+    stdin = io.TextIOWrapper(io.BytesIO(input_file.read_bytes()))
+    stdout = io.TextIOWrapper(io.BytesIO())
+    monkeypatch.setattr(sys, "stdin", stdin)
+    monkeypatch.setattr(sys, "stdout", stdout)
+    mangle_json_stream("-", "-", example_pointers, flush_lines=7)
+    assert stdout.buffer.getvalue().decode() == expected
+
+
+def test_batched_writer():
+    class RecordingFile(io.BytesIO):
+        def __init__(self):
+            super().__init__()
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append(data)
+            return super().write(data)
+
+    # By default small lines are written in one block, not one by one
+    f = RecordingFile()
+    with BatchedWriter(f) as writer:
+        writer.writelines(["a\n"] * 1000)
+    assert f.writes == [b"a\n" * 1000]
+
+    f = RecordingFile()
+    with BatchedWriter(f, max_lines=3, max_bytes=None) as writer:
+        writer.writelines(["a\n"] * 7)
+        assert f.writes == [b"a\n" * 3] * 2
+    assert f.writes[-1] == b"a\n"
+    assert writer.bytes_written == 14
+
+    # A partial batch is flushed after max_ms without further lines
+    f = RecordingFile()
+    with BatchedWriter(f, max_ms=10, max_bytes=None) as writer:
+        writer.write("a\n")
+        deadline = time.monotonic() + 5
+        while not f.writes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert f.writes == [b"a\n"]
+
+
+def test_mangle_json_file_async(
+    tmp_path, example_device_pairs, example_nested_data, example_pointers
+):
+    input_data, _ = make_test_cases(example_device_pairs)
+    lines = [
+        json.dumps(entry) + "\n"
+        for entry in input_data + example_nested_data * 300
+    ]
+    input_files = [tmp_path / "input0.jsonl", tmp_path / "input1.jsonl"]
+    input_files[0].write_text("".join(lines))
+    input_files[1].write_text("".join(reversed(lines)))
+    for i, input_file in enumerate(input_files):
+        mangle_json_file(
+            input_file, tmp_path / f"serial{i}.jsonl", example_pointers
+        )
+
+    async def mangle_concurrently():
+        await asyncio.gather(
+            *(
+                mangle_json_file_async(
+                    input_file, tmp_path / f"async{i}.jsonl", example_pointers
+                )
+                for i, input_file in enumerate(input_files)
+            )
+        )
+        # Tail a copy of the first file as it grows
+        growing_file = tmp_path / "growing.jsonl"
+        offset, mappings = 0, {}
+        for part in (lines[:100], lines[100:]):
+            with open(growing_file, "a") as f:
+                f.writelines(part)
+            offset = await mangle_json_file_tail_async(
+                growing_file,
+                tmp_path / "tail.jsonl",
+                example_pointers,
+                offset,
+                mappings,
+            )
+        assert offset == growing_file.stat().st_size
+
+    asyncio.run(mangle_concurrently())
+    for i in range(2):
+        expected = (tmp_path / f"serial{i}.jsonl").read_bytes()
+        assert (tmp_path / f"async{i}.jsonl").read_bytes() == expected
+    assert (tmp_path / "tail.jsonl").read_bytes() == (
+        tmp_path / "serial0.jsonl"
+    ).read_bytes()
+
+
+def test_mangle_lines_pipeline_error(tmp_path):
+    output_file = tmp_path / "output.jsonl"
+    lines = ['{"a": 1}\n'] * 10 + ['{"a": nope}\n'] + ['{"a": 1}\n'] * 1000
+
+    async def run():
+        with open(output_file, "w") as f_out:
+            await mangle_lines_pipeline(
+                lines, f_out, {}, [], batch_size=3, queue_size=1
+            )
+
+    # A failing stage stops the others instead of leaving them blocked
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+
+
+def test_mangle_json_files(
+    tmp_path, example_device_pairs, example_nested_data, example_pointers
+):
+    input_data, _ = make_test_cases(example_device_pairs)
+    lines = [
+        json.dumps(entry, separators=(",", ":")) + "\n" for entry in input_data
+    ]
+    input_dir = tmp_path / "input"
+    (input_dir / "sub").mkdir(parents=True)
+    # Start markers are in one file and the devices are used in another
+    with open(input_dir / "markers.jsonl", "w") as f:
+        f.writelines(lines[:8])
+    with open_jsonl(input_dir / "sub" / "events.jsonl.gz", "w") as f:
+        f.writelines(lines[8:])
+    (input_dir / "notes.txt").write_text("Not JSONL")
+    with open(tmp_path / "combined.jsonl", "w") as f:
+        f.writelines(lines)
+    mangle_json_file(
+        tmp_path / "combined.jsonl", tmp_path / "combined_out.jsonl", []
+    )
+
+    output_dir = input_dir / "output"
+    base_dir, files = find_input_files(str(input_dir), exclude=output_dir)
+    assert files == [
+        str(input_dir / "markers.jsonl"),
+        str(input_dir / "sub" / "events.jsonl.gz"),
+    ]
+    assert mangle_json_files(files, base_dir, output_dir, [], 2) == (2, 0)
+    with open_jsonl(output_dir / "sub" / "events.jsonl.gz") as f:
+        output = (output_dir / "markers.jsonl").read_text() + f.read()
+    assert output == (tmp_path / "combined_out.jsonl").read_text()
+
+    # Outputs are not found as inputs, and up-to-date files are skipped
+    assert find_input_files(str(input_dir), exclude=output_dir)[1] == files
+    assert mangle_json_files(files, base_dir, output_dir, []) == (0, 2)
+    with open(input_dir / "markers.jsonl", "a") as f:
+        f.write(json.dumps(example_nested_data[0]) + "\n")
+    assert mangle_json_files(files, base_dir, output_dir, []) == (1, 1)
+    # A change of pointers makes every output stale
+    assert mangle_json_files(
+        files, base_dir, output_dir, example_pointers
+    ) == (2, 0)
+
+    # A new device leaves the aliases of the others, and their outputs, as
+    # they were
+    new_markers, _ = make_test_cases([("MD=CISCO_EPNM!ND=NEWLAB001", "")])
+    with open(input_dir / "sub" / "new.jsonl", "w") as f:
+        f.writelines(
+            json.dumps(entry, separators=(",", ":")) + "\n"
+            for entry in new_markers
+        )
+    files = find_input_files(str(input_dir), exclude=output_dir)[1]
+    assert len(files) == 3
+    assert mangle_json_files(
+        files, base_dir, output_dir, example_pointers
+    ) == (1, 2)
+    # Unless it comes first and takes the alias of another device
+    (input_dir / "sub" / "new.jsonl").rename(input_dir / "first.jsonl")
+    files = find_input_files(str(input_dir), exclude=output_dir)[1]
+    assert mangle_json_files(
+        files, base_dir, output_dir, example_pointers
+    ) == (3, 0)
+    manifest = json.loads((output_dir / BATCH_MANIFEST).read_text())
+    assert manifest["mapping"]["version"] == 1
+    assert "NEWLAB001" not in json.dumps(manifest)
+
+    base_dir, files = find_input_files(
+        str(input_dir / "**" / "*.gz"), exclude=output_dir
+    )
+    assert base_dir == str(input_dir)
+    assert files == [str(input_dir / "sub" / "events.jsonl.gz")]
+
+
+def test_profile_run(tmp_path, example_device_pairs, example_pointers):
+    input_data, _ = make_test_cases(example_device_pairs)
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text(
+        "".join(json.dumps(entry) + "\n" for entry in input_data)
+    )
+    profile_dir = tmp_path / "profiles"
+    # Directories that are not profiled runs are never pruned
+    (profile_dir / "important_data").mkdir(parents=True)
+
+    run_dirs = []
+    for i in range(3):
+        with profile_run(profile_dir, input_file, keep=2) as run_dir:
+            # Runs are profiled one at a time
+            with profile_run(profile_dir, input_file) as nested_dir:
+                assert nested_dir is None
+            mangle_json_file(
+                input_file, tmp_path / "output.jsonl", example_pointers
+            )
+        run_dirs.append(run_dir)
+
+    # Only the newest runs are kept
+    kept = [os.path.basename(run_dir) for run_dir in run_dirs[1:]]
+    assert sorted(p.name for p in profile_dir.iterdir()) == sorted(
+        ["important_data", *kept]
+    )
+    run_dir = profile_dir / os.path.basename(run_dirs[-1])
+    assert {p.name for p in run_dir.iterdir()} == {
+        "profile.prof",
+        "profile.txt",
+        "memory.txt",
+    }
+    assert "mangle_json_file" in (run_dir / "profile.txt").read_text()
+    assert "by function" in (run_dir / "memory.txt").read_text()
+
+
+@pytest.mark.parametrize("suffix", [".gz", ".bz2", ".xz"])
+def test_mangle_json_file_compressed(
+    tmp_path, suffix, example_device_pairs, example_api_response
+):
+    input_data, _ = make_test_cases(example_device_pairs)
+    lines = [
+        json.dumps(entry, separators=(",", ":")) + "\n"
+        for entry in input_data + [example_api_response] * 10
+    ]
+    plain_input = tmp_path / "input.jsonl"
+    plain_input.write_text("".join(lines))
+    # Compressed input is detected by its magic bytes, not its name
+    compressed_input = tmp_path / "input.data"
+    with open_jsonl(tmp_path / f"input.jsonl{suffix}", "w") as f:
+        f.writelines(lines)
+    (tmp_path / f"input.jsonl{suffix}").rename(compressed_input)
+
+    mangle_json_file(plain_input, tmp_path / "plain.jsonl", [])
+    expected = (tmp_path / "plain.jsonl").read_text()
+    for workers in (1, 3):
+        output_file = tmp_path / f"output{workers}.jsonl{suffix}"
+        mangle_json_file(compressed_input, output_file, [], workers=workers)
+        with open_jsonl(output_file) as f:
+            assert f.read() == expected
+        mangle_json_file(plain_input, output_file, [], workers=workers)
+        with open_jsonl(output_file) as f:
+            assert f.read() == expected
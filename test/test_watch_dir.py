@@ -0,0 +1,254 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+from watchdog.events import FileCreatedEvent, FileModifiedEvent
+
+from ..filter_json import ResultCache, mangle_json_file
+from ..watch_dir import CustomEventHandler
+from .utils import make_test_cases
+
+
+@pytest.fixture
+def dump_lines(example_device_pairs, example_api_response):
+    markers, _ = make_test_cases(example_device_pairs)
+    return [
+        json.dumps(entry, separators=(",", ":")) + "\n"
+        for entry in markers + [example_api_response] * 3
+    ]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    (tmp_path / "output").mkdir()
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    return input_dir
+
+
+def test_tail_state(tmp_path, input_dir, dump_lines):
+    input_file = input_dir / "dump.jsonl"
+    output_file = tmp_path / "output" / "dump.jsonl"
+    # A last line that is still being written is left for later
+    input_file.write_text("".join(dump_lines[:3]) + dump_lines[3][:10])
+    handler = CustomEventHandler()
+    handler._mangle_file(input_file)
+    state = handler._tail_states[input_file]
+    assert state.offset == len("".join(dump_lines[:3]))
+    assert state.inode == os.stat(input_file).st_ino
+
+    input_file.write_text("".join(dump_lines))
+    handler._mangle_file(input_file)
+    assert state.offset == os.path.getsize(input_file)
+    assert handler.totals.counts["lines"] == len(dump_lines)
+    mangle_json_file(input_file, tmp_path / "full.jsonl", [])
+    assert output_file.read_text() == (tmp_path / "full.jsonl").read_text()
+
+    # A truncated file is mangled from the start
+    input_file.write_text("".join(dump_lines[:3]))
+    handler._mangle_file(input_file)
+    assert handler._tail_states[input_file] is not state
+    mangle_json_file(input_file, tmp_path / "full.jsonl", [])
+    assert output_file.read_text() == (tmp_path / "full.jsonl").read_text()
+
+    # So is a file replaced by another, even when it is larger
+    replacement = input_dir / "dump.tmp"
+    replacement.write_text("".join(dump_lines * 2))
+    os.replace(replacement, input_file)
+    handler._mangle_file(input_file)
+    state = handler._tail_states[input_file]
+    assert state.inode == os.stat(input_file).st_ino
+    mangle_json_file(input_file, tmp_path / "full.jsonl", [])
+    assert output_file.read_text() == (tmp_path / "full.jsonl").read_text()
+
+    # A deleted file forgets its tail state
+    input_file.unlink()
+    handler._mangle_file(input_file)
+    assert input_file not in handler._tail_states
+
+
+def test_tail_rewrite_in_place(tmp_path, input_dir, dump_lines):
+    input_file = input_dir / "dump.jsonl"
+    output_file = tmp_path / "output" / "dump.jsonl"
+    input_file.write_text("".join(dump_lines[:3]))
+    handler = CustomEventHandler()
+    handler._mangle_file(input_file)
+    inode = os.stat(input_file).st_ino
+
+    # Written over from the start with longer lines, as `cp` does
+    padded = [
+        line.replace('"version":1', f'"version":1,"pad":"{"x" * 50}"')
+        for line in dump_lines
+    ]
+    with open(input_file, "r+") as f:
+        f.write("".join(padded))
+    assert os.stat(input_file).st_ino == inode
+    handler._mangle_file(input_file)
+    mangle_json_file(input_file, tmp_path / "full.jsonl", [])
+    assert output_file.read_text() == (tmp_path / "full.jsonl").read_text()
+
+    # Appending is still only a tail
+    with open(input_file, "a") as f:
+        f.write(padded[-1])
+    handler._mangle_file(input_file)
+    mangle_json_file(input_file, tmp_path / "full.jsonl", [])
+    assert output_file.read_text() == (tmp_path / "full.jsonl").read_text()
+    assert handler.totals.counts["lines"] == 3 + len(padded) + 1
+
+
+def test_debounce_coalesces_events(tmp_path, input_dir, dump_lines):
+    input_file = input_dir / "dump.jsonl"
+    input_file.write_text("".join(dump_lines))
+    handler = CustomEventHandler(debounce=0.2)
+    handler.start()
+    for _ in range(3):
+        handler.on_modified(FileModifiedEvent(str(input_file)))
+    wait_for(lambda: handler.stats["processed"])
+    handler.stop()
+
+    assert handler.stats["events"] == 3
+    assert handler.stats["coalesced"] == 2
+    assert handler.stats["queued"] == 1
+    assert handler.stats["processed"] == 1
+    assert (tmp_path / "output" / "dump.jsonl").exists()
+
+
+def test_full_queue_defers_file(input_dir):
+    input_file = input_dir / "dump.jsonl"
+    handler = CustomEventHandler(debounce=0, max_queue=1)
+    handler._queue.put(input_dir / "other.jsonl")
+    dispatcher = threading.Thread(target=handler._dispatch)
+    dispatcher.start()
+    try:
+        handler.on_modified(FileModifiedEvent(str(input_file)))
+        wait_for(lambda: handler.stats["deferred"])
+        assert input_file in handler._pending
+        assert input_file not in handler._busy
+
+        # Once there is room the file is queued after all
+        handler._queue.get()
+        wait_for(lambda: handler.stats["queued"])
+        assert handler._queue.get_nowait() == input_file
+        assert input_file not in handler._pending
+    finally:
+        with handler._condition:
+            handler._stopping = True
+            handler._condition.notify_all()
+        dispatcher.join()
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_stop_drains_queue(tmp_path, input_dir, dump_lines, pipeline):
+    names = [f"dump{i}.jsonl" for i in range(4)]
+    for name in names:
+        (input_dir / name).write_text("".join(dump_lines))
+    handler = CustomEventHandler(workers=2, debounce=0, pipeline=pipeline)
+    handler.start()
+    for name in names:
+        handler.on_created(FileCreatedEvent(str(input_dir / name)))
+    wait_for(lambda: handler.stats["queued"] == len(names))
+    handler.stop()
+
+    assert not any(thread.is_alive() for thread in handler._threads)
+    assert handler.stats["processed"] == len(names)
+    assert handler.queue_depth == 0
+    for name in names:
+        assert (tmp_path / "output" / name).exists()
+
+
+def test_result_cache(tmp_path, input_dir, dump_lines):
+    input_file = input_dir / "dump.jsonl"
+    output_file = tmp_path / "output" / "dump.jsonl"
+    input_file.write_text("".join(dump_lines))
+    handler = CustomEventHandler(cache=ResultCache(str(tmp_path / "cache")))
+    handler._mangle_file(input_file)
+    expected = output_file.read_text()
+    assert handler.totals.counts["cache_misses"] == 1
+
+    # The same content under a new inode is mangled from the start, so the
+    # cached output is reused
+    replacement = input_dir / "dump.tmp"
+    replacement.write_text("".join(dump_lines))
+    os.replace(replacement, input_file)
+    output_file.unlink()
+    handler._mangle_file(input_file)
+    assert handler.totals.counts["cache_hits"] == 1
+    assert output_file.read_text() == expected
+
+    # Appended lines are tailed rather than looked up
+    with open(input_file, "a") as f:
+        f.write(dump_lines[-1])
+    handler._mangle_file(input_file)
+    assert handler.totals.counts["cache_hits"] == 1
+    assert handler.totals.counts["cache_misses"] == 1
+    mangle_json_file(input_file, tmp_path / "full.jsonl", [])
+    assert output_file.read_text() == (tmp_path / "full.jsonl").read_text()
+
+
+def test_metrics_file(tmp_path, input_dir, dump_lines):
+    input_file = input_dir / "dump.jsonl"
+    input_file.write_text("".join(dump_lines))
+    metrics_file = tmp_path / "watch_dir.prom"
+    handler = CustomEventHandler(debounce=0, metrics_file=str(metrics_file))
+    handler.start()
+    handler.on_created(FileCreatedEvent(str(input_file)))
+    wait_for(lambda: handler.stats["processed"])
+    handler.stop()
+
+    metrics = dict(
+        line.rsplit(" ", 1)
+        for line in metrics_file.read_text().splitlines()
+        if not line.startswith("#")
+    )
+    assert metrics["filter_json_lines_total"] == str(len(dump_lines))
+    assert metrics["watch_dir_events_total"] == "1"
+    assert metrics["watch_dir_queued_total"] == "1"
+    assert metrics["watch_dir_queue_depth"] == "0"
+    assert not os.path.exists(f"{metrics_file}.tmp")
+
+
+def test_metrics_file_replaced_atomically(tmp_path):
+    metrics_file = tmp_path / "watch_dir.prom"
+    handler = CustomEventHandler(metrics_file=str(metrics_file))
+    handler.stats["events"] += 1
+    handler.write_metrics()
+
+    def metric_names(text):
+        return [line.split(" ")[0] for line in text.splitlines()]
+
+    expected = metric_names(metrics_file.read_text())
+    stop = threading.Event()
+    torn = []
+
+    def read():
+        while not stop.is_set():
+            text = metrics_file.read_text()
+            if metric_names(text) != expected:
+                torn.append(text)
+
+    def write():
+        for _ in range(10):
+            handler.write_metrics()
+
+    reader = threading.Thread(target=read)
+    writers = [threading.Thread(target=write) for _ in range(4)]
+    reader.start()
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    reader.join()
+
+    # Readers only ever see a whole file, however many threads write it
+    assert not torn
+    assert not os.path.exists(f"{metrics_file}.tmp")
@@ -3,6 +3,101 @@ import datetime
 import json
 
 
+def make_api_response():
+    """Returns an example ObjectChanged event from the API."""
+    return {
+        "version": 1,
+        "header": {
+            "envelopeId": "887b3ee5-978f-44e7-9261-8bc60914b4e6",
+            "roleIds": [],
+            "timestamp": "2025-05-20T12:05:56.705542Z",
+            "traceId": "08107431-b079-4f0e-91b0-e0c4f1f2d7e7",
+            "upstreamId": "1785f76f-1e22-43db-88fa-d124bdb26e78",
+        },
+        "event": {
+            "_type": "bp.v1.ObjectChanged",
+            "object_type": "/bpocore/api/v2/resources/put",
+            "op": "updated",
+            "object_id": "bf129225-1a26-11f0-abdf-1511c0e6270c___MD=CISCO_EPNM!ND=URDELAB080!CTP=name=PLINE-2-2-TX;lr=lr-optical-section",
+            "object_data": {
+                "discovered": True,
+                "orchState": "active",
+                "productId": "urn:cyaninc:bp:product:radciscoepnmerf:tpe",
+                "label": "MD=CISCO_EPNM!ND=URDELAB080!CTP=name=PLINE-2-2-TX;lr=lr-optical-section",
+                "properties": {
+                    "device": "MD=CISCO_EPNM!ND=URDELAB080",
+                    "structureType": "CTPServerToClient",
+                    "data": {
+                        "relationships": {
+                            "tpeDiscovered": {
+                                "data": {
+                                    "type": "tpeDiscovered",
+                                    "id": "MD=CISCO_EPNM!ND=URDELAB080!CTP=name=PLINE-2-2-TX;lr=lr-optical-section",
+                                }
+                            },
+                            "networkConstruct": {
+                                "data": {
+                                    "type": "networkConstructs",
+                                    "id": "MD=CISCO_EPNM!ND=URDELAB080",
+                                }
+                            },
+                            "equipment": {
+                                "data": {
+                                    "type": "equipment",
+                                    "id": "MD=CISCO_EPNM!ND=URDELAB080!EQ=name=PUNIT-2;partnumber=N/A!PC=PLINE-2-2-TX",
+                                }
+                            },
+                            "owningServerTpe": {
+                                "data": {
+                                    "id": "MD=CISCO_EPNM!ND=URDELAB080!PTP=name=PLINE-2-2-TX;lr=lr-optical-physical",
+                                    "type": "tpes",
+                                }
+                            },
+                        },
+                        "attributes": {
+                            "additionalAttributes": {
+                                "tp.directionality": "com:tp-source"
+                            },
+                            "displayAlias": "PLINE-2-2-TX",
+                            "userLabel": "",
+                            "cardType": "PLACE_HOLDER",
+                            "nativeName": "PLINE-2-2-TX",
+                            "structureType": "CTPServerToClient",
+                            "locations": [
+                                {
+                                    "managementType": "rest",
+                                    "neName": "URDELAB080",
+                                    "shelf": "1",
+                                    "slot": "PUNIT-2",
+                                    "port": "2",
+                                }
+                            ],
+                            "layerTerminations": [
+                                {
+                                    "layerRate": "OS",
+                                    "active": True,
+                                    "structureType": "exposed lone cp",
+                                    "terminationState": "layer termination cannot terminate",
+                                    "layerRateQualifier": "OS",
+                                }
+                            ],
+                            "state": "IS",
+                            "category": "CHANNEL_TX",
+                        },
+                        "type": "tpes",
+                        "id": "MD=CISCO_EPNM!ND=URDELAB080!CTP=name=PLINE-2-2-TX;lr=lr-optical-section",
+                    },
+                },
+                "autoClean": False,
+                "providerResourceId": "MD=CISCO_EPNM!ND=URDELAB080!CTP=name=PLINE-2-2-TX;lr=lr-optical-section",
+                "shared": False,
+                "resourceTypeId": "tosca.resourceTypes.TPE",
+                "resyncId": "9d71dde4-079a-42e3-9eba-b74c1a6111ae",
+            },
+        },
+    }
+
+
 def make_test_cases(devices):
     """
     Given a list of (device_name, obfuscated_name) tuples,
@@ -16,9 +111,10 @@ def make_test_cases(devices):
         # Generate some dummy but stable values
         envelope_id = str(uuid.uuid4())
         marker_id = str(uuid.uuid4())
+        start_time = datetime.datetime(2025, 5, 20, 12, 5, 51)
         timestamp = (
-            datetime.datetime(2025, 5, 20, 12, 5, 51 + i).isoformat() + "Z"
-        )
+            start_time + datetime.timedelta(seconds=i)
+        ).isoformat() + "Z"
         reason = f"{100 + (i * 10)} resource(s)"
 
         base_obj = {
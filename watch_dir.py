@@ -1,15 +1,176 @@
+import json
 import logging
+import os
+import queue
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Optional
 from watchdog.observers import Observer
 from watchdog.events import (
     FileSystemEventHandler,
     FileCreatedEvent,
     FileModifiedEvent,
 )
-from filter_json import mangle_json_file
+from contextlib import nullcontext
+from filter_json import (
+    DEFAULT_ALIAS_WIDTH,
+    DEFAULT_CACHE_BYTES,
+    DEFAULT_PROFILE_KEEP,
+    JSON_CODECS,
+    DeviceMappingStore,
+    DevicePathIndex,
+    HashMappingStore,
+    MangleStats,
+    ResultCache,
+    detect_compression,
+    is_jsonl_file,
+    load_device_path_index,
+    load_device_rules,
+    mangle_json_file,
+    mangle_json_file_async,
+    mangle_json_file_tail,
+    mangle_json_file_tail_async,
+    profile_run,
+    read_alias_key,
+    register_device_rules,
+    tail_fingerprint,
+)
+
+# Seconds before a file that did not fit on a full queue is tried again,
+# when the debounce window is shorter
+MIN_RETRY_INTERVAL = 0.1
+
+
+@dataclass
+class FileTailState:
+    """How far an input file has been processed.
+
+    Attributes:
+        inode (int): The inode of the file when it was first processed.
+        offset (int): The byte offset up to which the file has been mangled.
+        device_mappings (dict[str, str]): The device mapping built so far.
+        fingerprint (Optional[str]): The `tail_fingerprint` of the file at
+                                     the offset.
+    """
+
+    inode: int
+    offset: int = 0
+    device_mappings: dict = field(default_factory=dict)
+    fingerprint: Optional[str] = None
 
 
 class CustomEventHandler(FileSystemEventHandler):
+    """Queue changed JSONL files for mangling by a pool of worker threads.
+
+    Events for a file are coalesced until it has been quiet for the debounce
+    window, so a single copy that fires several events is mangled once. A
+    file is never queued twice or mangled by two workers at once. When the
+    queue is full the file stays pending and is queued again once another
+    debounce window has passed, so no change is lost. As a file is quiet
+    by the time it is mangled, a last line without a newline is mangled
+    too, once it holds a whole JSON value.
+
+    Mangling stats are logged per file and summed in `totals`. If a metrics
+    file is given, the totals and queue counters are written to it in the
+    Prometheus text format after every file.
+
+    If a profile directory is given, each file is mangled under
+    `profile_run`, one file at a time; files mangled by other workers in
+    the meantime are not profiled.
+
+    In pipeline mode, a single thread runs an event loop that mangles up to
+    `workers` files concurrently with `mangle_json_file_async`, each on its
+    own read, transform and write pipeline. Profiling does not apply there.
+
+    If a device path index is given, device names are only replaced at the
+    indexed paths of each event type.
+
+    If a result cache is given, files that are mangled from the start, such
+    as compressed files and files that were replaced, reuse the cached
+    output of identical content instead of being mangled again.
+    """
+
+    def __init__(
+        self,
+        mapping_store: Optional[DeviceMappingStore] = None,
+        workers: int = 1,
+        debounce: float = 0.5,
+        max_queue: int = 100,
+        codec: str = "json",
+        compress_level: Optional[int] = None,
+        metrics_file: Optional[str] = None,
+        profile_dir: Optional[str] = None,
+        profile_keep: int = DEFAULT_PROFILE_KEEP,
+        profile_interval: float = 1.0,
+        pipeline: bool = False,
+        device_paths: Optional[DevicePathIndex] = None,
+        cache: Optional[ResultCache] = None,
+    ):
+        super().__init__()
+        self.device_paths = device_paths
+        self.cache = cache
+        self.mapping_store = mapping_store
+        self.codec = codec
+        self.compress_level = compress_level
+        self.workers = workers
+        self.debounce = debounce
+        self.stats = Counter()
+        self.totals = MangleStats()
+        self.metrics_file = metrics_file
+        self.profile_dir = profile_dir
+        self.profile_keep = profile_keep
+        self.profile_interval = profile_interval
+        self.pipeline = pipeline
+        self._tail_states: dict[Path, FileTailState] = {}
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        # Due times of files waiting out the debounce window
+        self._pending: dict[Path, float] = {}
+        # Files that are queued or being mangled
+        self._busy: set[Path] = set()
+        self._condition = threading.Condition()
+        self._metrics_lock = threading.Lock()
+        self._stopping = False
+        self._threads: list[threading.Thread] = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        """Start the dispatcher and worker threads."""
+        if self.pipeline:
+            import asyncio
+
+            workers = [
+                threading.Thread(
+                    target=asyncio.run, args=(self._work_async(),), daemon=True
+                )
+            ]
+        else:
+            workers = [
+                threading.Thread(target=self._work, daemon=True)
+                for _ in range(self.workers)
+            ]
+        self._threads = [
+            threading.Thread(target=self._dispatch, daemon=True)
+        ] + workers
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop accepting files and wait for queued files to be mangled."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for _ in range(1 if self.pipeline else self.workers):
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
     def on_created(self, event):
         if isinstance(event, FileCreatedEvent):
             self._handle_mangling(event)
@@ -20,38 +181,560 @@ class CustomEventHandler(FileSystemEventHandler):
 
     def _handle_mangling(self, event):
         file_path = Path(event.src_path)
-        if file_path.suffix in ('.json', '.jsonl'):
-            filename = file_path.name
-            data_dir = file_path.parent.parent
-            output_dir = data_dir / "output"
-            mangle_json_file(file_path, output_dir / filename, [])
+        if is_jsonl_file(file_path):
+            with self._condition:
+                self.stats["events"] += 1
+                if file_path in self._pending:
+                    self.stats["coalesced"] += 1
+                self._pending[file_path] = time.monotonic() + self.debounce
+                self._condition.notify()
+
+    def _dispatch(self):
+        """Move files whose debounce window has passed onto the queue.
+
+        A file that does not fit on a full queue stays pending and is tried
+        again after another debounce window.
+        """
+        with self._condition:
+            while not self._stopping:
+                now = time.monotonic()
+                due_paths = [
+                    path
+                    for path, due in self._pending.items()
+                    if due <= now and path not in self._busy
+                ]
+                for path in due_paths:
+                    try:
+                        self._queue.put_nowait(path)
+                    except queue.Full:
+                        self.stats["deferred"] += 1
+                        self._pending[path] = now + max(
+                            self.debounce, MIN_RETRY_INTERVAL
+                        )
+                        logging.warning(
+                            f"Work queue full, deferred file '{path}'"
+                        )
+                        continue
+                    del self._pending[path]
+                    self._busy.add(path)
+                    self.stats["queued"] += 1
+                next_due = min(
+                    (
+                        due
+                        for path, due in self._pending.items()
+                        if due > now and path not in self._busy
+                    ),
+                    default=now + 1,
+                )
+                self._condition.wait(timeout=next_due - now)
+
+    def _work(self):
+        """Mangle files from the queue until a None sentinel is received."""
+        while (file_path := self._queue.get()) is not None:
+            outcome = "processed"
+            try:
+                self._mangle_file(file_path)
+            except Exception:
+                outcome = "failed"
+                logging.exception(f"Failed to process file '{file_path}'")
+            finally:
+                self._finish(file_path, outcome)
+
+    def _finish(self, file_path: Path, outcome: str):
+        """Count a mangled file and allow it to be queued again."""
+        with self._condition:
+            self.stats[outcome] += 1
+            self._busy.discard(file_path)
+            self._condition.notify()
+
+    def _get_tail_state(self, file_path: Path) -> FileTailState:
+        """Get the tail state of a file, resetting it if the file was
+        replaced, truncated or rewritten in place since it was last
+        processed."""
+        stat = os.stat(file_path)
+        state = self._tail_states.get(file_path)
+        replaced = state is not None and state.inode != stat.st_ino
+        truncated = state is not None and state.offset > stat.st_size
+        rewritten = False
+        if state is not None and not (replaced or truncated):
+            # The same inode may have been written over from the start
+            fingerprint = tail_fingerprint(file_path, state.offset)
+            rewritten = state.fingerprint not in (None, fingerprint)
+        if state is None or replaced or truncated or rewritten:
+            state = FileTailState(inode=stat.st_ino)
+            self._tail_states[file_path] = state
+        return state
+
+    def write_metrics(self):
+        """Write the totals and queue counters to the metrics file.
+
+        The file is replaced atomically so a collector never reads it half
+        written. Worker threads write it one at a time, as they share the
+        temporary file.
+        """
+        if self.metrics_file is None:
+            return
+        with self._condition:
+            text = self.totals.to_prometheus()
+            for name, value in sorted(self.stats.items()):
+                text += f"# TYPE watch_dir_{name}_total counter\n"
+                text += f"watch_dir_{name}_total {value}\n"
+        text += "# TYPE watch_dir_queue_depth gauge\n"
+        text += f"watch_dir_queue_depth {self.queue_depth}\n"
+        tmp_file = f"{self.metrics_file}.tmp"
+        with self._metrics_lock:
+            with open(tmp_file, "w") as f:
+                f.write(text)
+            os.replace(tmp_file, self.metrics_file)
+
+    def _mangle_file(self, file_path: Path):
+        stats = MangleStats()
+        profiler = nullcontext()
+        if self.profile_dir is not None:
+            profiler = profile_run(
+                self.profile_dir,
+                file_path.name,
+                self.profile_keep,
+                self.profile_interval,
+            )
+        with profiler as run_dir:
+            self._mangle_file_with_stats(file_path, stats)
+        if run_dir is not None:
+            logging.info(
+                f"Profile of file '{file_path}' written to '{run_dir}'"
+            )
+        self._record_stats(file_path, stats)
+
+    def _mangle_file_with_stats(self, file_path: Path, stats: MangleStats):
+        prepared = self._prepare_file(file_path)
+        if prepared is None:
+            return
+        output_file, state = prepared
+        if state is None:
+            # Compressed files cannot be tailed, so they are redone in full
+            mangle_json_file(
+                file_path,
+                output_file,
+                [],
+                mapping_store=self.mapping_store,
+                codec=self.codec,
+                compresslevel=self.compress_level,
+                stats=stats,
+                device_paths=self.device_paths,
+                cache=self.cache,
+            )
+            self._log_processed(file_path, output_file)
+            return
+        start = state.offset
+        state.offset = mangle_json_file_tail(
+            file_path,
+            output_file,
+            [],
+            state.offset,
+            state.device_mappings,
+            self.mapping_store,
+            self.codec,
+            self.compress_level,
+            stats,
+            device_paths=self.device_paths,
+            cache=self.cache,
+            partial_line=True,
+        )
+        state.fingerprint = tail_fingerprint(file_path, state.offset)
+        self._log_processed(file_path, output_file, start, state.offset)
+
+    async def _work_async(self):
+        """Mangle files from the queue on the asyncio pipeline, up to
+        `workers` at a time, until a None sentinel is received."""
+        import asyncio
+
+        slots = asyncio.Semaphore(self.workers)
+        tasks = set()
+        while True:
+            await slots.acquire()
+            file_path = await asyncio.to_thread(self._queue.get)
+            if file_path is None:
+                break
+            task = asyncio.create_task(self._mangle_file_async(file_path))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+        await asyncio.gather(*tasks)
+
+    async def _mangle_file_async(self, file_path: Path):
+        outcome = "processed"
+        try:
+            stats = MangleStats()
+            await self._mangle_file_with_stats_async(file_path, stats)
+            self._record_stats(file_path, stats)
+        except Exception:
+            outcome = "failed"
+            logging.exception(f"Failed to process file '{file_path}'")
+        finally:
+            self._finish(file_path, outcome)
+
+    async def _mangle_file_with_stats_async(
+        self, file_path: Path, stats: MangleStats
+    ):
+        prepared = self._prepare_file(file_path)
+        if prepared is None:
+            return
+        output_file, state = prepared
+        if state is None:
+            await mangle_json_file_async(
+                file_path,
+                output_file,
+                [],
+                mapping_store=self.mapping_store,
+                codec=self.codec,
+                compresslevel=self.compress_level,
+                stats=stats,
+                device_paths=self.device_paths,
+                cache=self.cache,
+            )
+            self._log_processed(file_path, output_file)
+            return
+        start = state.offset
+        state.offset = await mangle_json_file_tail_async(
+            file_path,
+            output_file,
+            [],
+            state.offset,
+            state.device_mappings,
+            self.mapping_store,
+            self.codec,
+            self.compress_level,
+            stats,
+            device_paths=self.device_paths,
+            cache=self.cache,
+            partial_line=True,
+        )
+        state.fingerprint = tail_fingerprint(file_path, state.offset)
+        self._log_processed(file_path, output_file, start, state.offset)
+
+    def _prepare_file(
+        self, file_path: Path
+    ) -> Optional[tuple[Path, Optional[FileTailState]]]:
+        """Get the output path of a file and its tail state.
+
+        The tail state is None for compressed files, which cannot be tailed
+        and are redone in full. Returns None if the file no longer exists.
+        """
+        output_file = file_path.parent.parent / "output" / file_path.name
+        try:
+            if detect_compression(file_path) is not None:
+                return output_file, None
+            return output_file, self._get_tail_state(file_path)
+        except FileNotFoundError:
+            self._tail_states.pop(file_path, None)
+            return None
+
+    def _log_processed(
+        self,
+        file_path: Path,
+        output_file: Path,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+    ):
+        if start is None:
             logging.info(
-                f"Processed file '{file_path}' and saved to '{output_dir}'"
+                f"Processed file '{file_path}' and saved to "
+                f"'{output_file.parent}'"
             )
+        elif end != start:
+            logging.info(
+                f"Processed bytes {start}-{end} of file "
+                f"'{file_path}' and saved to '{output_file.parent}'"
+            )
+
+    def _record_stats(self, file_path: Path, stats: MangleStats):
+        """Log the stats of a mangled file and add them to the totals."""
+        if not stats.counts["lines"] and not stats.counts["cache_hits"]:
+            return
+        logging.info(
+            f"Stats for file '{file_path}': {json.dumps(stats.as_dict())}"
+        )
+        with self._condition:
+            self.totals.merge(stats)
+        self.write_metrics()
 
 
-def log_filesystem_change(path="."):
+def log_filesystem_change(
+    path=".",
+    mapping_store=None,
+    workers=1,
+    debounce=0.5,
+    max_queue=100,
+    stats_interval=60,
+    codec="json",
+    compress_level=None,
+    metrics_file=None,
+    profile_dir=None,
+    profile_keep=DEFAULT_PROFILE_KEEP,
+    profile_interval=1.0,
+    pipeline=False,
+    device_paths=None,
+    cache=None,
+    cache_size=None,
+    hash_aliases=False,
+    alias_key_file=None,
+    alias_width=DEFAULT_ALIAS_WIDTH,
+):
     """Logs filesystem changes in the specified directory.
 
     Args:
         path (str): Directory path to monitor. Defaults to current directory.
+        mapping_store (str, optional): Path to a SQLite device mapping store
+            shared by all files and runs. Defaults to a mapping per file.
+        workers (int): Number of threads mangling files, or of files mangled
+            at once in pipeline mode. Defaults to 1.
+        debounce (float): Seconds a file must be quiet before it is mangled.
+        max_queue (int): Maximum number of files waiting to be mangled.
+        stats_interval (float): Seconds between queue statistics log lines.
+        codec (str): JSON library used to decode and encode lines.
+        compress_level (int, optional): Compression level for outputs of
+            .gz, .bz2 or .xz inputs, which are written in the same format.
+        metrics_file (str, optional): Path of a Prometheus textfile to keep
+            updated with mangling and queue metrics.
+        profile_dir (str, optional): Directory to dump cProfile and
+            tracemalloc reports of each mangled file to.
+        profile_keep (int): Number of profiled files to keep.
+        profile_interval (float): Seconds between tracemalloc samples, or 0
+            to skip them.
+        pipeline (bool): Whether to mangle files concurrently on asyncio
+            pipelines in one event loop instead of on worker threads.
+        device_paths (str, optional): Path of a JSON file of the paths that
+            hold device names per event type, as learned by filter_json.py.
+            Only those values are rewritten.
+        cache (str, optional): Directory of cached outputs to reuse for
+            files whose content was mangled before.
+        cache_size (int, optional): Bytes of cached outputs to keep.
+        hash_aliases (bool): Whether to derive each device alias from a
+            hash of its name instead of numbering devices, so that watchers
+            on other hosts agree on aliases without sharing a store.
+        alias_key_file (str, optional): File holding the secret key to hash
+            device names with HMAC-SHA256. Implies hashed aliases.
+        alias_width (int): Number of hexadecimal digits in hashed aliases.
     """
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s - %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
-    event_handler = CustomEventHandler()
+    if mapping_store is not None:
+        mapping_store = DeviceMappingStore(mapping_store)
+    elif hash_aliases or alias_key_file is not None:
+        mapping_store = HashMappingStore(
+            read_alias_key(alias_key_file), alias_width
+        )
+    if device_paths is not None:
+        device_paths = load_device_path_index(device_paths)
+    if cache is not None:
+        cache = ResultCache(cache, cache_size or DEFAULT_CACHE_BYTES)
+    event_handler = CustomEventHandler(
+        mapping_store,
+        workers,
+        debounce,
+        max_queue,
+        codec,
+        compress_level,
+        metrics_file,
+        profile_dir,
+        profile_keep,
+        profile_interval,
+        pipeline,
+        device_paths,
+        cache,
+    )
+    event_handler.start()
     observer = Observer()
     observer.schedule(event_handler, path, recursive=True)
     observer.start()
+    last_stats, last_logged = Counter(), time.monotonic()
     try:
         while observer.is_alive():
             observer.join(1)
+            now = time.monotonic()
+            if now - last_logged < stats_interval:
+                continue
+            if event_handler.stats != last_stats:
+                logging.info(
+                    f"Queue depth {event_handler.queue_depth}, "
+                    f"stats {dict(event_handler.stats)}"
+                )
+                last_stats = event_handler.stats.copy()
+                event_handler.write_metrics()
+            last_logged = now
     finally:
         observer.stop()
         observer.join()
+        event_handler.stop()
 
 
 if __name__ == "__main__":
-    log_filesystem_change(path="./data/input")
+    parser = ArgumentParser(description="Mangle JSONL files as they change.")
+    parser.add_argument(
+        "--path",
+        type=str,
+        required=False,
+        default="./data/input",
+        help="Input directory to watch.",
+    )
+    parser.add_argument(
+        "--mapping_store",
+        "-m",
+        type=str,
+        required=False,
+        help="SQLite file to keep device aliases stable across runs.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of threads mangling files, or of files mangled at "
+        "once with --pipeline.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Mangle up to --workers files concurrently on asyncio "
+        "pipelines instead of worker threads.",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        required=False,
+        default=0.5,
+        help="Seconds a file must be quiet before it is mangled.",
+    )
+    parser.add_argument(
+        "--max_queue",
+        type=int,
+        required=False,
+        default=100,
+        help="Maximum number of files waiting to be mangled.",
+    )
+    parser.add_argument(
+        "--codec",
+        "-c",
+        type=str,
+        required=False,
+        default="json",
+        choices=list(JSON_CODECS),
+        help="JSON library used to decode and encode lines. orjson is "
+        "faster but writes non-ASCII characters unescaped.",
+    )
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        required=False,
+        help="Compression level for .gz, .bz2 or .xz outputs.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        required=False,
+        help="Prometheus textfile to write mangling and queue metrics to.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        required=False,
+        help="Directory to dump cProfile and tracemalloc reports to.",
+    )
+    parser.add_argument(
+        "--profile_keep",
+        type=int,
+        required=False,
+        default=DEFAULT_PROFILE_KEEP,
+        help="Number of profiled files to keep in the profile directory.",
+    )
+    parser.add_argument(
+        "--profile_interval",
+        type=float,
+        required=False,
+        default=1.0,
+        help="Seconds between tracemalloc samples, or 0 to skip them.",
+    )
+    parser.add_argument(
+        "--device_paths",
+        type=str,
+        required=False,
+        help="JSON file of the paths that hold device names per event type, "
+        "as learned by filter_json.py. Only those values are rewritten.",
+    )
+    parser.add_argument(
+        "--device_rules",
+        type=str,
+        required=False,
+        help="JSON file of extra rules for extracting device names from "
+        "start markers, as a list of {vendor, key, chars} objects.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        required=False,
+        help="Directory of cached outputs, reused for files whose content, "
+        "device mapping and settings are unchanged.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        required=False,
+        default=DEFAULT_CACHE_BYTES // 2**20,
+        help="MiB of cached outputs to keep, evicting the least recently "
+        "used.",
+    )
+    parser.add_argument(
+        "--hash_aliases",
+        action="store_true",
+        help="Derive each device alias from a hash of its name, so that "
+        "watchers on other hosts agree on aliases without a mapping store.",
+    )
+    parser.add_argument(
+        "--alias_key_file",
+        type=str,
+        required=False,
+        help="File holding the secret key to hash device names with "
+        "HMAC-SHA256. Implies --hash_aliases.",
+    )
+    parser.add_argument(
+        "--alias_width",
+        type=int,
+        required=False,
+        default=DEFAULT_ALIAS_WIDTH,
+        help="Number of hexadecimal digits in hashed aliases.",
+    )
+    args = parser.parse_args()
+    if args.device_paths and not os.path.exists(args.device_paths):
+        parser.error(f"Device paths file '{args.device_paths}' not found")
+    if args.device_rules:
+        register_device_rules(load_device_rules(args.device_rules))
+    hash_aliases = args.hash_aliases or bool(args.alias_key_file)
+    if hash_aliases and args.mapping_store:
+        parser.error("Hashed aliases cannot be combined with --mapping_store")
+    if not 1 <= args.alias_width <= 64:
+        parser.error("--alias_width must be from 1 to 64")
+
+    log_filesystem_change(
+        path=args.path,
+        mapping_store=args.mapping_store,
+        workers=args.workers,
+        debounce=args.debounce,
+        max_queue=args.max_queue,
+        codec=args.codec,
+        compress_level=args.compress_level,
+        metrics_file=args.metrics_file,
+        profile_dir=args.profile,
+        profile_keep=args.profile_keep,
+        profile_interval=args.profile_interval,
+        pipeline=args.pipeline,
+        device_paths=args.device_paths,
+        cache=args.cache,
+        cache_size=args.cache_size * 2**20,
+        hash_aliases=args.hash_aliases,
+        alias_key_file=args.alias_key_file,
+        alias_width=args.alias_width,
+    )